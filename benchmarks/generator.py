@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Generate a synthetic Banktivity document for tests and benchmarks.
+
+Creates <document>.bank7/StoreContent/core.sql with the tables and columns the INSERTs in libs/Banktivity.py
+assume, the catalog tables (Z_PRIMARYKEY, ZCURRENCY, ZTRANSACTIONTYPE) and random but consistent data:
+accounts, categories, securities with price items, transactions with their line items, security line items
+and daily prices.
+
+    $ python3 benchmarks/generator.py /tmp/synthetic.bank7 --transactions 1000000 --securities 300 --price-days 1825
+
+This is not a document Banktivity can open (Z_METADATA and most of the model are missing), only a
+schema-compatible store for the library.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+import uuid
+
+
+CORE_DATA_EPOCH = 978307200
+
+SCHEMA = """
+CREATE TABLE Z_PRIMARYKEY (Z_ENT INTEGER PRIMARY KEY, Z_NAME VARCHAR, Z_SUPER INTEGER, Z_MAX INTEGER);
+CREATE TABLE ZCURRENCY (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPCODE VARCHAR, ZPNAME VARCHAR);
+CREATE TABLE ZTRANSACTIONTYPE (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPBASETYPE INTEGER, ZPNAME VARCHAR,
+    ZPUNIQUEID VARCHAR);
+CREATE TABLE ZACCOUNT (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPACCOUNTCLASS INTEGER, ZPDEBIT INTEGER,
+    ZPHIDDEN INTEGER, ZPTAXABLE INTEGER, ZPPARENTACCOUNT INTEGER, Z1_PPARENTACCOUNT INTEGER, ZTYPE INTEGER,
+    ZCURRENCY INTEGER, ZORGANIZATION INTEGER, ZPCREATIONTIME TIMESTAMP, ZPMODIFICATIONDATE TIMESTAMP,
+    ZPINTERESTRATE DECIMAL, ZPTHRESHOLDBALANCE DECIMAL, ZPFULLNAME VARCHAR, ZPNAME VARCHAR, ZPNOTE VARCHAR,
+    ZPUNIQUEID VARCHAR, ZPIMAGEID VARCHAR, ZPTAXCODE VARCHAR, ZPBANKACCOUNTNUMBER VARCHAR, ZPBANKROUTINGNUMBER VARCHAR,
+    ZPCOLORDATA BLOB);
+CREATE TABLE ZTRANSACTION (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPADJUSTMENT INTEGER,
+    ZPCHECKNUMBER INTEGER, ZPCLEARED INTEGER, ZPVOID INTEGER, ZPCURRENCY INTEGER, ZPFILEATTACHMENT INTEGER,
+    ZPTRANSACTIONTYPE INTEGER, ZPCREATIONTIME TIMESTAMP, ZPDATE TIMESTAMP, ZPMODIFICATIONDATE TIMESTAMP, ZPNOTE VARCHAR,
+    ZPTITLE VARCHAR, ZPUNIQUEID VARCHAR);
+CREATE TABLE ZLINEITEM (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPCLEARED INTEGER,
+    ZPINTRADAYSORTINDEX INTEGER, ZPACCOUNT INTEGER, Z1_PACCOUNT INTEGER, ZPSECURITYLINEITEM INTEGER,
+    ZPSTATEMENT INTEGER, ZPTRANSACTION INTEGER, ZPCREATIONTIME TIMESTAMP, ZPEXCHANGERATE DECIMAL,
+    ZPRUNNINGBALANCE DECIMAL, ZPTRANSACTIONAMOUNT DECIMAL, ZPMEMO VARCHAR, ZPUNIQUEID VARCHAR);
+CREATE TABLE ZSECURITY (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPEXCLUDEFROMQUOTEUPDATES INTEGER,
+    ZPISINDEX INTEGER, ZPRISKTYPE INTEGER, ZPTRADESINPENCE INTEGER, ZPTYPE INTEGER, ZPCURRENCY INTEGER,
+    ZPCREATIONTIME TIMESTAMP, ZPMODIFICATIONDATE TIMESTAMP, ZPCONTRACTSIZE DECIMAL, ZPPARVALUE DECIMAL, ZPCUSIP VARCHAR,
+    ZPNAME VARCHAR, ZPNOTE VARCHAR, ZPSYMBOL VARCHAR, ZPUNIQUEID VARCHAR);
+CREATE TABLE ZSECURITYLINEITEM (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPCOSTBASISMETHOD INTEGER,
+    ZPDISTRIBUTIONTYPE INTEGER, ZPLINEITEM INTEGER, ZPSECURITY INTEGER, ZPAMOUNT DECIMAL, ZPCOMMISSION DECIMAL,
+    ZPINCOME DECIMAL, ZPPRICEMULTIPLIER DECIMAL, ZPPRICEPERSHARE DECIMAL, ZPSHARES DECIMAL,
+    ZPINCOMECATEGORYLINEITEMID VARCHAR);
+CREATE TABLE ZSECURITYPRICEITEM (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPKNOWNDATERANGEBEGIN INTEGER,
+    ZPKNOWNDATERANGEEND INTEGER, ZPLATESTIMPORTDATE INTEGER, ZPSECURITYID VARCHAR);
+CREATE TABLE ZSECURITYPRICE (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER, ZPDATASOURCE INTEGER,
+    ZPDATE INTEGER, ZPSECURITYPRICEITEM INTEGER, ZPADJUSTEDCLOSEPRICE DECIMAL, ZPCLOSEPRICE DECIMAL,
+    ZPHIGHPRICE DECIMAL, ZPLOWPRICE DECIMAL, ZPOPENPRICE DECIMAL, ZPPREVIOUSCLOSEPRICE DECIMAL, ZPVOLUME DECIMAL);
+CREATE TABLE ZSECURITYLOT (Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, Z_OPT INTEGER);
+CREATE INDEX ZACCOUNT_ZPFULLNAME_INDEX ON ZACCOUNT (ZPFULLNAME);
+CREATE INDEX ZLINEITEM_ZPACCOUNT_INDEX ON ZLINEITEM (ZPACCOUNT);
+CREATE INDEX ZLINEITEM_ZPTRANSACTION_INDEX ON ZLINEITEM (ZPTRANSACTION);
+CREATE INDEX ZSECURITY_ZPSYMBOL_INDEX ON ZSECURITY (ZPSYMBOL);
+CREATE INDEX ZSECURITYLINEITEM_ZPLINEITEM_INDEX ON ZSECURITYLINEITEM (ZPLINEITEM);
+CREATE INDEX ZSECURITYLINEITEM_ZPSECURITY_INDEX ON ZSECURITYLINEITEM (ZPSECURITY);
+CREATE INDEX ZSECURITYPRICE_ZPSECURITYPRICEITEM_INDEX ON ZSECURITYPRICE (ZPSECURITYPRICEITEM);
+CREATE INDEX ZTRANSACTION_ZPDATE_INDEX ON ZTRANSACTION (ZPDATE);
+"""
+
+# Entity names in Z_PRIMARYKEY as used by libs/Banktivity.py. Category and PrimaryAccount are sub-entities of Account
+# stored in ZACCOUNT, so their Z_ENT (2 and 3) match what add_category() and add_account() write.
+ENTITIES = ['Account', 'Category', 'PrimaryAccount', 'Currency', 'LineItem', 'LineItemSource', 'Security',
+            'SecurityLineItem', 'SecurityLot', 'SecurityPrice', 'SecurityPriceItem', 'Transaction', 'TransactionType']
+SUB_ENTITIES = {'Category': 'Account', 'PrimaryAccount': 'Account'}
+CURRENCIES = ['RUB', 'USD', 'EUR']
+TRANSACTION_TYPES = ['Deposit', 'Withdrawal', 'Transfer', 'Check', 'Buy', 'Sell', 'Interest Inc.', 'Investment Inc.',
+                     'Dividend']
+CATEGORIES = ['Банк', 'Банк:Оплата за услуги', 'Налоги', 'Инвестиции', 'Инвестиции:Проценты',
+              'Инвестиции:Дивиденды', 'Продукты', 'Транспорт']
+# Accounts the importer writes to (see settings.ini), the rest are named "Счет N"
+IMPORTER_ACCOUNTS = [('Тинькофф - Брокер RUB', 'RUB'), ('Тинькофф - Брокер USD', 'USD'), ('Тинькофф - ИИС', 'RUB')]
+
+
+def generate_document(document, accounts=10, securities=50, transactions=10000, security_share=0.5,
+                      price_days=365, years=3, seed=1):
+    """Create the document. Returns a dict with the numbers of rows per table."""
+    random.seed(seed)
+    store = os.path.join(os.path.expanduser(document), 'StoreContent')
+    os.makedirs(store, exist_ok=True)
+    path = os.path.join(store, 'core.sql')
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    con.executescript(SCHEMA)
+    z_ents = {name: i for i, name in enumerate(ENTITIES, 1)}
+    con.executemany("INSERT INTO Z_PRIMARYKEY VALUES (?, ?, ?, 0)",
+                    [(z_ent, name, z_ents.get(SUB_ENTITIES.get(name), 0)) for name, z_ent in z_ents.items()])
+    con.executemany("INSERT INTO ZCURRENCY VALUES (?, ?, 1, ?, ?)",
+                    [(pk, z_ents['Currency'], code, code) for pk, code in enumerate(CURRENCIES, 1)])
+    con.executemany("INSERT INTO ZTRANSACTIONTYPE VALUES (?, ?, 1, 0, ?, ?)",
+                    [(pk, z_ents['TransactionType'], name, str(uuid.uuid4()))
+                     for pk, name in enumerate(TRANSACTION_TYPES, 1)])
+    transaction_type_pks = {name: pk for pk, name in enumerate(TRANSACTION_TYPES, 1)}
+
+    now = int(time.time()) - CORE_DATA_EPOCH
+    zaccount_rows = []
+    category_pks = {}
+    for name in CATEGORIES:
+        pk = len(zaccount_rows) + 1
+        parent = category_pks.get(name.split(':')[0]) if ':' in name else None
+        category_pks[name] = pk
+        zaccount_rows.append((pk, z_ents['Category'], 1, 6000, None, 0, None, parent, 2 if parent else None, None, None,
+                              None, now, now, None, None, name, name.split(':')[-1], None, str(uuid.uuid4()),
+                              'category-misc-expenses', None, None, None, None))
+    account_names = IMPORTER_ACCOUNTS + [(f"Счет {i}", random.choice(CURRENCIES))
+                                         for i in range(max(accounts - len(IMPORTER_ACCOUNTS), 0))]
+    account_pks = []
+    for name, currency in account_names[:max(accounts, 1)]:
+        pk = len(zaccount_rows) + 1
+        account_pks.append((pk, CURRENCIES.index(currency) + 1))
+        zaccount_rows.append((pk, z_ents['PrimaryAccount'], 1, 7, None, 0, None, None, None, 0,
+                              CURRENCIES.index(currency) + 1, 1, now, now, 0, 0, name, name, None, str(uuid.uuid4()),
+                              'category-misc-expenses', None, None, None, None))
+    con.executemany(f"INSERT INTO ZACCOUNT VALUES ({', '.join('?' * 25)})", zaccount_rows)
+
+    security_rows = []
+    for pk in range(1, securities + 1):
+        is_bond = pk % 3 == 0
+        security_rows.append((pk, z_ents['Security'], 1, None, 0, 2, None, 3 if is_bond else 1,
+                              random.randint(1, 2), now, now, 100, 1000, None, f"Security {pk}", None,
+                              f"RU{pk:010d}", str(uuid.uuid4())))
+    con.executemany(f"INSERT INTO ZSECURITY VALUES ({', '.join('?' * 18)})", security_rows)
+    con.executemany("INSERT INTO ZSECURITYPRICEITEM VALUES (?, ?, 1, NULL, NULL, NULL, ?)",
+                    [(row[0], z_ents['SecurityPriceItem'], row[-1]) for row in security_rows])
+
+    # Transactions are spread evenly over the last `years` years
+    period = int(years * 365 * 86400)
+    first_date = now - period
+
+    def transaction_rows():
+        for pk in range(1, transactions + 1):
+            zpdate = first_date + period * pk // max(transactions, 1) + random.randint(0, 3600)
+            account_pk, currency_pk = random.choice(account_pks)
+            is_security = securities > 0 and random.random() < security_share
+            if is_security:
+                transaction_type = random.choice(['Buy', 'Buy', 'Sell', 'Interest Inc.', 'Investment Inc.'])
+            else:
+                transaction_type = random.choice(['Deposit', 'Withdrawal'])
+            yield pk, zpdate, account_pk, currency_pk, is_security, transaction_type
+
+    zsecuritylineitem_pk = 0
+    batch_t, batch_li, batch_sli = [], [], []
+    for pk, zpdate, account_pk, currency_pk, is_security, transaction_type in transaction_rows():
+        batch_t.append((pk, z_ents['Transaction'], 1, None, 0, 0, 0, currency_pk, None,
+                        transaction_type_pks[transaction_type], zpdate, zpdate, zpdate, f"Transaction {pk}", None,
+                        str(uuid.uuid4())))
+        primary_pk, category_pk = 2 * pk - 1, 2 * pk
+        category_uniqueid = str(uuid.uuid4())
+        security_lineitem = None
+        amount = round(random.uniform(-5000, 5000), 2)
+        if is_security:
+            zsecuritylineitem_pk += 1
+            security_lineitem = zsecuritylineitem_pk
+            security_pk = random.randint(1, securities)
+            if transaction_type in ('Buy', 'Sell'):
+                shares = random.randint(1, 100) * (-1 if transaction_type == 'Sell' else 1)
+                price = round(random.uniform(1, 500), 2)
+                commission = round(-abs(price * shares) * 0.003, 2)
+                batch_sli.append((zsecuritylineitem_pk, z_ents['SecurityLineItem'], 1,
+                                  1 if transaction_type == 'Sell' else None, 1, primary_pk, security_pk,
+                                  -price * shares + commission, commission, 0, 1, price, shares, None))
+                amount = 0
+            else:
+                amount = abs(amount)
+                batch_sli.append((zsecuritylineitem_pk, z_ents['SecurityLineItem'], 1, None, 1, primary_pk,
+                                  security_pk, None, None, amount, 1, None, None, category_uniqueid))
+            category = None if transaction_type in ('Buy', 'Sell') else category_pks['Инвестиции:Проценты']
+        else:
+            category = random.choice(list(category_pks.values()))
+        batch_li.append((primary_pk, z_ents['LineItem'], 1, 1, 2 if is_security else 0, account_pk,
+                         z_ents['PrimaryAccount'], security_lineitem, None, pk, zpdate, 1, None, amount, None,
+                         str(uuid.uuid4())))
+        batch_li.append((category_pk, z_ents['LineItem'], 1, None, 0, category,
+                         z_ents['Category'] if category else None, None, None, pk, zpdate, 1, None, -amount, None,
+                         category_uniqueid))
+        if len(batch_t) >= 10000:
+            flush_transactions(con, batch_t, batch_li, batch_sli)
+    flush_transactions(con, batch_t, batch_li, batch_sli)
+
+    # Daily prices for the last price_days days. ZSECURITYPRICE.ZPDATE is days since the unix epoch.
+    last_day = (now + CORE_DATA_EPOCH) // 86400
+    price_pk = 0
+    batch = []
+    for security_pk in range(1, securities + 1):
+        close = random.uniform(10, 1000)
+        for day in range(last_day - price_days + 1, last_day + 1):
+            price_pk += 1
+            close = max(close * random.uniform(0.97, 1.03), 0.01)
+            batch.append((price_pk, z_ents['SecurityPrice'], 1, 0, day, security_pk, 0, close, close * 1.01,
+                          close * 0.99, close, 0, random.randint(0, 100000)))
+            if len(batch) >= 10000:
+                con.executemany(f"INSERT INTO ZSECURITYPRICE VALUES ({', '.join('?' * 13)})", batch)
+                batch.clear()
+    con.executemany(f"INSERT INTO ZSECURITYPRICE VALUES ({', '.join('?' * 13)})", batch)
+
+    counts = {
+        'Account': len(zaccount_rows),
+        'Transaction': transactions,
+        'LineItem': 2 * transactions,
+        'Security': securities,
+        'SecurityLineItem': zsecuritylineitem_pk,
+        'SecurityPrice': price_pk,
+        'SecurityPriceItem': securities,
+    }
+    con.executemany("UPDATE Z_PRIMARYKEY SET Z_MAX = ? WHERE Z_NAME = ?",
+                    [(z_max, name) for name, z_max in counts.items()])
+    con.commit()
+    con.execute("PRAGMA journal_mode = WAL")  # like Core Data stores
+    con.close()
+    return counts
+
+
+def flush_transactions(con, batch_t, batch_li, batch_sli):
+    con.executemany(f"INSERT INTO ZTRANSACTION VALUES ({', '.join('?' * 16)})", batch_t)
+    con.executemany(f"INSERT INTO ZLINEITEM VALUES ({', '.join('?' * 16)})", batch_li)
+    con.executemany(f"INSERT INTO ZSECURITYLINEITEM VALUES ({', '.join('?' * 14)})", batch_sli)
+    batch_t.clear()
+    batch_li.clear()
+    batch_sli.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('document', help="Path of the .bank7 document to create (overwritten if it exists)")
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--securities', type=int, default=50)
+    parser.add_argument('--transactions', type=int, default=10000,
+                        help="Number of transactions, each has 2 line items")
+    parser.add_argument('--security-share', type=float, default=0.5,
+                        help="Share of security transactions (with a security line item)")
+    parser.add_argument('--price-days', type=int, default=365, help="Days of prices per security")
+    parser.add_argument('--years', type=float, default=3, help="Transactions are spread over this many years")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = generate_document(args.document, args.accounts, args.securities, args.transactions,
+                               args.security_share, args.price_days, args.years, args.seed)
+    print(f"Generated {args.document} in {time.perf_counter() - started:.1f} s:")
+    for name, count in counts.items():
+        print(f"  {name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of Banktivity row modes on a wide result set.
+
+Fetches the same SELECT of a ZLINEITEM-like table with every row mode and with the old dict factory, and
+reports the time to fetch all rows and the memory the fetched rows take.
+
+    $ python3 benchmarks/row_modes.py --rows 200000 --columns 30
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.Banktivity import ROW_MODES, Banktivity  # noqa: E402
+
+
+def dict_factory(cursor, row):
+    # The row factory Banktivity used before row modes, for comparison
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+def create_table(con, rows, columns):
+    column_names = [f"ZCOLUMN{i}" for i in range(columns)]
+    con.execute(f"CREATE TABLE ZBENCH (Z_PK INTEGER PRIMARY KEY, {', '.join(column_names)})")
+    con.executemany(
+        f"INSERT INTO ZBENCH VALUES (?, {', '.join('?' * columns)})",
+        ((pk,) + tuple(pk * 0.5 if i % 2 else f"value {pk}" for i in range(columns)) for pk in range(1, rows + 1))
+    )
+    con.commit()
+
+
+def fetch_all(con, row_factory):
+    con.row_factory = row_factory
+    cur = con.cursor()
+    cur.execute("SELECT * FROM ZBENCH")
+    return cur.fetchall()
+
+
+def measure(con, row_factory):
+    # Time and memory are measured in separate passes as tracemalloc slows allocations down
+    started = time.perf_counter()
+    rows = fetch_all(con, row_factory)
+    elapsed = time.perf_counter() - started
+    del rows
+
+    tracemalloc.start()
+    rows = fetch_all(con, row_factory)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--columns', type=int, default=30)
+    args = parser.parse_args()
+
+    con = sqlite3.connect(':memory:')
+    create_table(con, args.rows, args.columns)
+
+    # Banktivity.row_factory() doesn't use the instance, so there's no need to open a document
+    factories = [('dict (old)', dict_factory)]
+    factories += [(row_mode, Banktivity.row_factory(None, row_mode)) for row_mode in ROW_MODES]
+
+    print(f"{args.rows} rows x {args.columns + 1} columns")
+    print(f"{'row mode':<12} {'seconds':>10} {'rows/s':>12} {'rows MiB':>10}")
+    for name, factory in factories:
+        elapsed, size = measure(con, factory)
+        print(f"{name:<12} {elapsed:>10.3f} {args.rows / elapsed:>12.0f} {size / 2 ** 20:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Benchmark suite of the Banktivity library on synthetic documents of growing size.
+
+For every size a document is generated with benchmarks/generator.py, then every benchmark opens it, runs the same
+number of operations and rolls back, so all benchmarks of a size see the same document. Reports operations per
+second per benchmark and size, i.e. how throughput scales with the size of the document.
+
+    $ python3 benchmarks/suite.py --sizes 10000,100000,1000000 --operations 1000 --csv results.csv
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from benchmarks.generator import generate_document  # noqa: E402
+from libs.Banktivity import Banktivity  # noqa: E402
+
+
+ACCOUNT = 'Тинькофф - Брокер RUB'
+INCOME_CATEGORY = 'Инвестиции:Проценты'
+
+
+def random_date(years):
+    moment = datetime.now().astimezone() - timedelta(seconds=random.randint(0, int(years * 365 * 86400)))
+    return moment.replace(microsecond=0).isoformat()
+
+
+def deposit(banktivity, years, n):
+    return {
+        'primaryaccount_zaccount_pk': banktivity.get_zaccount_pk(ACCOUNT),
+        'transaction_account_name': ACCOUNT,
+        'transaction_category_name': None,
+        'transaction_currency_code': 'RUB',
+        'transaction_type': random.choice(['Deposit', 'Withdrawal']),
+        'zpadjustment': None,
+        'zpchecknumber': 0,
+        'zpdate': random_date(years),
+        'zpnote': f"Benchmark operation {n}",
+        'zptitle': None,
+        'zptransactionamount': round(random.uniform(-5000, 5000), 2),
+    }
+
+
+def security_transaction(banktivity, years, n, securities):
+    transaction_data = deposit(banktivity, years, n)
+    transaction_data['zpsecurity'] = banktivity.get_zsecurity_by_symbol(f"RU{random.randint(1, securities):010d}")['Z_PK']
+    transaction_data['zpintradaysortindex'] = 2
+    if random.random() < 0.7:
+        transaction_data['transaction_type'] = random.choice(['Buy', 'Sell'])
+        transaction_data['zpshares'] = random.randint(1, 100) * (-1 if transaction_data['transaction_type'] == 'Sell' else 1)
+        transaction_data['zppricepershare'] = round(random.uniform(1, 500), 2)
+        transaction_data['commission_amount'] = round(-abs(transaction_data['zppricepershare'] * transaction_data['zpshares']) * 0.003, 2)
+        transaction_data['zpamount'] = -transaction_data['zppricepershare'] * transaction_data['zpshares'] + transaction_data['commission_amount']
+        transaction_data['zptransactionamount'] = 0
+    else:
+        transaction_data['transaction_type'] = 'Interest Inc.'
+        transaction_data['transaction_category_name'] = INCOME_CATEGORY
+        transaction_data['zptransactionamount'] = transaction_data['zpincome'] = abs(transaction_data['zptransactionamount'])
+        transaction_data['commission_amount'] = 0
+    return transaction_data
+
+
+def security_price(banktivity, price_days, securities):
+    return {
+        'zpsecurity_pk': banktivity.get_zsecurity_by_symbol(f"RU{random.randint(1, securities):010d}")['Z_PK'],
+        # Half of the days are already in the document (updates), the other half are older ones (inserts)
+        'zpdate': (datetime.now() - timedelta(days=random.randint(0, 2 * price_days))).strftime('%Y-%m-%d'),
+        'o': 100, 'h': 102, 'l': 99, 'c': 101, 'v': 1000,
+    }
+
+
+# Benchmarks get the Banktivity instance and the generator parameters and return (callable running the measured
+# operations, number of operations). Preparation of the input data is not measured.
+
+def bench_add_transaction(banktivity, args):
+    operations = [deposit(banktivity, args.years, n) for n in range(args.operations)]
+    return lambda: [banktivity.add_transaction(t) for t in operations], len(operations)
+
+
+def bench_add_security_transaction(banktivity, args):
+    operations = [security_transaction(banktivity, args.years, n, args.securities) for n in range(args.operations)]
+    return lambda: [banktivity.add_security_transaction(t) for t in operations], len(operations)
+
+
+# The bulk benchmarks write the same operations as add_transaction and add_security_transaction, to compare them
+def bench_add_transactions_bulk(banktivity, args):
+    operations = [deposit(banktivity, args.years, n) for n in range(args.operations)]
+    return lambda: banktivity.add_transactions_bulk(operations), len(operations)
+
+
+def bench_add_security_transactions_bulk(banktivity, args):
+    operations = [security_transaction(banktivity, args.years, n, args.securities) for n in range(args.operations)]
+    return lambda: banktivity.add_transactions_bulk(operations), len(operations)
+
+
+def preload_and_find(banktivity, find, operations):
+    # Like apply_plan(): the duplicate index is loaded for the date range of the operations once, then checked
+    banktivity.preload_duplicates(min(t['zpdate'] for t in operations), max(t['zpdate'] for t in operations))
+    return [find(t) for t in operations]
+
+
+def bench_find_primaryaccount_transaction_duplicate(banktivity, args):
+    # Includes loading the duplicate index for the days of the operations
+    operations = [deposit(banktivity, args.years, n) for n in range(args.operations)]
+    return lambda: preload_and_find(banktivity, banktivity.find_primaryaccount_transaction_duplicate,
+                                    operations), len(operations)
+
+
+def bench_find_security_transaction_duplicate(banktivity, args):
+    operations = [security_transaction(banktivity, args.years, n, args.securities) for n in range(args.operations)]
+    return lambda: preload_and_find(banktivity, banktivity.find_security_transaction_duplicate,
+                                    operations), len(operations)
+
+
+def bench_add_zsecurityprice(banktivity, args):
+    operations = [security_price(banktivity, args.price_days, args.securities) for n in range(args.operations)]
+    return lambda: [banktivity.add_zsecurityprice(price) for price in operations], len(operations)
+
+
+def bench_add_zsecurityprices(banktivity, args):
+    operations = [security_price(banktivity, args.price_days, args.securities) for n in range(args.operations)]
+    return lambda: banktivity.add_zsecurityprices(operations), len(operations)
+
+
+def bench_commit(banktivity, args):
+    # commit() of a session that added the operations in bulk
+    banktivity.add_transactions_bulk([deposit(banktivity, args.years, n) for n in range(args.operations)])
+    return banktivity.commit, 1
+
+
+BENCHMARKS = {
+    'add_transaction': bench_add_transaction,
+    'add_security_transaction': bench_add_security_transaction,
+    'add_transactions_bulk': bench_add_transactions_bulk,
+    'add_security_transactions_bulk': bench_add_security_transactions_bulk,
+    'find_primaryaccount_transaction_duplicate': bench_find_primaryaccount_transaction_duplicate,
+    'find_security_transaction_duplicate': bench_find_security_transaction_duplicate,
+    'add_zsecurityprice': bench_add_zsecurityprice,
+    'add_zsecurityprices': bench_add_zsecurityprices,
+    'commit': bench_commit,
+}
+
+
+def run_benchmark(document, name, args):
+    random.seed(args.seed)
+    banktivity = Banktivity(document)
+    run, operations = BENCHMARKS[name](banktivity, args)
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    banktivity.con.rollback()  # no-op after commit()
+    banktivity.con.close()
+    return elapsed, operations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000',
+                        help="Comma-separated numbers of transactions in the generated documents")
+    parser.add_argument('--operations', type=int, default=1000, help="Operations per benchmark")
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                        help=f"Comma-separated benchmarks to run, of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--securities', type=int, default=50)
+    parser.add_argument('--price-days', type=int, default=365)
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--directory', help="Where to generate the documents (a temporary directory by default)")
+    parser.add_argument('--csv', help="Also write results to this CSV file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = args.benchmarks.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"ERROR: Unknown benchmark {name}. Abort.")
+            exit(1)
+
+    results = []
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = args.directory or temporary_directory
+        for size in sizes:
+            document = os.path.join(directory, f"synthetic-{size}.bank7")
+            started = time.perf_counter()
+            generate_document(document, args.accounts, args.securities, size, price_days=args.price_days,
+                              years=args.years, seed=args.seed)
+            print(f"Generated {size} transactions in {time.perf_counter() - started:.1f} s")
+            for name in names:
+                elapsed, operations = run_benchmark(document, name, args)
+                results.append({'benchmark': name, 'transactions': size, 'operations': operations,
+                                'seconds': elapsed, 'ops_per_s': operations / elapsed})
+                print(f"  {name:<44} {operations:>8} ops {elapsed:>9.3f} s {operations / elapsed:>12.0f} ops/s")
+
+    # Scaling curves: ops/s of every benchmark by document size
+    print("")
+    print(f"{'ops/s by transactions':<44}" + ''.join(f"{size:>12}" for size in sizes))
+    for name in names:
+        ops_per_s = {result['transactions']: result['ops_per_s'] for result in results if result['benchmark'] == name}
+        print(f"{name:<44}" + ''.join(f"{ops_per_s[size]:>12.0f}" for size in sizes))
+
+    if args.csv:
+        with open(os.path.expanduser(args.csv), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,40 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
 import configparser
+import concurrent.futures
+import csv
 import dateutil
 import getpass
+import hashlib
 import io
+import json
 import keyring
 import logging
+import multiprocessing
+import os
 import pprint
 import pytz
+import sys
+import tempfile
+import threading
 from libs import Banktivity
+from libs.BalanceEngine import BalanceEngine
+from libs.LotEngine import LotEngine
+from libs.BrokerClient import BrokerClient
+from libs.CandleCache import CandleCache
+from libs.DuplicateIndex import isoformat_to_local_day, local_day_to_zpdate, zpdate_to_local_day
+from libs.ImportState import ImportState, read_watermarks
+from libs.InstrumentRegistry import InstrumentRegistry
+from libs.OperationsFile import OperationsFile
+from libs.SQLProfiler import SQLProfiler
 # Awethon/open-api-python-client
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime, time, timedelta
 from openapi_client import openapi
+from os.path import expanduser
+from time import perf_counter
+from types import SimpleNamespace
 from pytz import timezone
 
 
@@ -21,8 +44,31 @@ config.read('settings.ini')
 importer_config = config['importer-tinkoff-api']
 debug = importer_config.getboolean('Debug')
 dryrun = importer_config.getboolean('DryRun')
+work_on_copy = importer_config.getboolean('WorkOnCopy', fallback=False)
+# None when SQL profiling is off, otherwise the file to export the profile to ('' prints the summary)
+profile_output = importer_config.get('ProfileOutput', fallback='') if importer_config.getboolean('Profile', fallback=False) else None
 our_timezone = importer_config['Timezone']
 default_banktivity_document = importer_config['DefaultBanktivityDocument']
+# Sidecar SQLite file with data fetched from the broker (market candles, instruments), shared by all documents
+cache_file = importer_config.get('CacheFile', fallback='importer-tinkoff-api.cache.sqlite')
+instrument_cache_ttl_days = importer_config.getint('InstrumentCacheTTL', fallback=30)
+# Imports without explicit dates start from each account's watermark minus this overlap
+incremental_overlap = timedelta(hours=importer_config.getfloat('IncrementalOverlapHours', fallback=24))
+# Operations are fetched in windows of this many days (see operation_windows())
+operations_window_days = importer_config.getint('OperationsWindowDays', fallback=30)
+# Number of concurrent requests to the broker API in the prefetch stage
+concurrency = importer_config.getint('Concurrency', fallback=4)
+# The apply stage commits every CheckpointOperations transactions or CheckpointSeconds (see apply_plan())
+checkpoint_operations = importer_config.getint('CheckpointOperations', fallback=500)
+checkpoint_seconds = importer_config.getfloat('CheckpointSeconds', fallback=60)
+# Compute ZLINEITEM.ZPRUNNINGBALANCE of the imported transactions and the ones after them (see BalanceEngine)
+update_running_balances = importer_config.getboolean('UpdateRunningBalances', fallback=False)
+# Print the FIFO realized gains of the sells after an import that added trades (see LotEngine)
+report_security_lots = importer_config.getboolean('ReportSecurityLots', fallback=False)
+# Requests per minute per OpenAPI group (see BrokerClient) and retries of transient errors
+rate_limits = {group.strip(): int(limit) for group, limit in (
+    item.split(':') for item in importer_config.get('RateLimits', fallback='').split(',') if item.strip())}
+retries = importer_config.getint('Retries', fallback=5)
 # This dict resolves Tinkoff.Investments accounts into Banktivity account names
 account_type_to_names = {
     'Tinkoff': importer_config['BanktivityInvestmentAccountName'],
@@ -38,22 +84,18 @@ loggingLevel = logging.INFO
 if debug:
     loggingLevel = logging.DEBUG
 
-# Get Tinkoff Investments OpenAPI token
-token = keyring.get_password('adeg/banktivity-importer', 'tinkoff-api')
-if token is None or len(token) < OPENAPI_TOKEN_LENGTH:
-    token = getpass.getpass(prompt='Enter Tinkoff Investments OpenAPI token: ')
-    if len(token) < OPENAPI_TOKEN_LENGTH:
-        print("Unable to obtain a valid Tinkoff Investments OpenAPI token")
-        exit(1)
-
-
 # Global variables and objects
 banktivity = None
 broker_accounts = {}
 broker_portfolio = {}
 broker_operations = {}
-client = openapi.api_client(token)
-del token # if I can remove sensitive info from some part of the memory - I go for it
+# The broker client and the caches are created on first use (see get_client(), get_candle_cache() and
+# get_instruments()), so commands that don't need them and the apply workers (see apply_documents()) neither ask for
+# the OpenAPI token nor open the cache file
+client = None
+client_lock = threading.Lock()
+candle_cache = None
+instruments = None
 logging.basicConfig(filename='importer-tinkoff-api.log', level=loggingLevel, format="[%(levelname)s] %(funcName)s(): %(message)s")
 
 
@@ -61,22 +103,19 @@ def main():
     global banktivity, default_banktivity_document
 
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('command', help="either 'print' or 'import'")
+    parser.add_argument('command', help="either 'print', 'import' or 'reconcile'")
     parser.add_argument('collection',
-                        help="Tinkoff Broker Data collections: <all|accounts|portfolio|operations>")
+                        help="Tinkoff Broker Data collections: <all|accounts|portfolio|operations>. "
+                             "Import stages: <all|fetch|plan|apply>. Reconcile: <portfolio>")
     parser.add_argument(
         'period_start',
         nargs='?',
-        help="Начало временного промежутка, желательно в ISO-формате",
-        type=lambda s: timezone(our_timezone).localize(dateutil.parser.parse(s)),
-        default=datetime.now(tz=timezone(our_timezone)) - timedelta(days=90)
+        help="Начало временного промежутка, желательно в ISO-формате. Для import apply — файл плана",
     )
     parser.add_argument(
         'period_end',
         nargs='?',
         help="Конец временного промежутка, желательно в ISO-формате. Если не указано, то будет now()",
-        type=lambda s: timezone(our_timezone).localize(dateutil.parser.parse(s)),
-        default=datetime.now(tz=timezone(our_timezone))
     )
     parser.add_argument(
         'banktivity_document',
@@ -84,13 +123,91 @@ def main():
         default=default_banktivity_document
     )
     parser.add_argument('--log', dest='loglevel', help="")
+    parser.add_argument(
+        '--work-on-copy',
+        action='store_true',
+        default=work_on_copy,
+        help="Импортировать в копию core.sql и заменить ею документ по завершении (см. WorkOnCopy в settings.ini)"
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='',
+        default=profile_output,
+        metavar='FILE',
+        help="Профилировать SQL-запросы к документу и вывести сводку или сохранить ее в FILE (.csv или .json)"
+    )
+    parser.add_argument(
+        '--operations',
+        metavar='FILE',
+        help="import fetch: куда сохранить операции (по умолчанию operations.jsonl). "
+             "import all: сохранять операции в FILE, чтобы прерванная загрузка продолжилась (по умолчанию во "
+             "временный файл). import plan: взять операции из FILE вместо запроса к OpenAPI"
+    )
+    parser.add_argument(
+        '--documents',
+        nargs='+',
+        metavar='DOCUMENT',
+        help="import all/apply: импортировать в несколько документов параллельно, каждый в своем процессе. "
+             "Путь к документу или имя секции [document:ИМЯ] в settings.ini"
+    )
+    parser.add_argument(
+        '--plan',
+        metavar='FILE',
+        default='plan.jsonl',
+        help="import plan: куда сохранить план (по умолчанию plan.jsonl)"
+    )
+    parser.add_argument(
+        '--format',
+        choices=('pprint', 'jsonl', 'csv'),
+        default='pprint',
+        help="print: формат вывода. jsonl и csv выводятся по мере получения данных, по записи на строку"
+    )
     args = parser.parse_args()
 
+    if args.command == 'import' and args.collection == 'apply':
+        # import apply PLAN [DOCUMENT]
+        if args.period_start is None:
+            print("ERROR: Plan file is required for import apply. Abort.")
+            exit(1)
+        plan_file = args.period_start
+        args.banktivity_document = args.period_end or args.banktivity_document
+        args.period_start = args.period_end = None
+        documents = resolve_documents(args.documents or [args.banktivity_document])
+        incremental = False
+    elif args.command == 'reconcile':
+        # reconcile portfolio [DOCUMENT]
+        args.banktivity_document = args.period_start or args.banktivity_document
+        args.period_start = args.period_end = None
+    else:
+        # Without explicit dates accounts with a watermark are fetched from it (see ImportState), others for 90 days.
+        # print doesn't write to documents, so it doesn't read them
+        documents = []
+        account_starts = {}
+        incremental = args.command == 'import' and args.period_start is None
+        if args.command == 'import':
+            documents = resolve_documents(args.documents or [args.banktivity_document])
+        if incremental:
+            account_starts = {broker_account_id: operation_date - incremental_overlap for broker_account_id, operation_date
+                              in common_watermarks([document for document, _ in documents]).items()}
+        args.period_start = timezone(our_timezone).localize(dateutil.parser.parse(args.period_start)) if args.period_start else datetime.now(tz=timezone(our_timezone)) - timedelta(days=90)
+        args.period_end = timezone(our_timezone).localize(dateutil.parser.parse(args.period_end)) if args.period_end else datetime.now(tz=timezone(our_timezone))
+
     if args.command and args.collection:
-        fetch_accounts()
-        fetch_portfolio()
         if args.command == 'print':
-            if args.collection == 'accounts':
+            fetch_accounts()
+            fetch_portfolio()
+            if args.format != 'pprint':
+                # Records only, so the output can be piped into other tools
+                if args.collection == 'accounts':
+                    print_records((item.to_dict() for item in broker_accounts), args.format)
+                elif args.collection == 'portfolio':
+                    print_records((item.to_dict() for item in broker_portfolio), args.format)
+                elif args.collection == 'operations':
+                    print_records((dict(broker_account_id=broker_account_id, **op.to_dict()) for broker_account_id, op
+                                   in iter_all_operations(args.period_start, args.period_end)),
+                                  args.format, OPERATION_CSV_COLUMNS)
+            elif args.collection == 'accounts':
                 print("Accounts")
                 pprint.pprint(broker_accounts)
             elif args.collection == 'portfolio':
@@ -102,47 +219,117 @@ def main():
                     broker_account_id = item.broker_account_id
                     broker_account_type = item.broker_account_type
                     print("Account type " + broker_account_type + " with ID " + broker_account_id)
-                    response = client.operations.operations_get(
-                        _from=args.period_start.isoformat()
-                        , to=args.period_end.isoformat()
-                        , broker_account_id=broker_account_id
-                    )
                     print("Fetching operations for " + broker_account_id)
-                    for op in response.payload.operations:
+                    for op in iter_operations(broker_account_id, args.period_start, args.period_end):
                         pprint.pprint(op)
-        elif args.command == 'import' and args.collection == 'all':
+        elif args.command == 'import' and args.collection in ('all', 'fetch', 'plan', 'apply'):
+            # Stages: fetch (operations from the broker), plan (banktivity_transaction_data and prices, no document
+            # needed), apply (write the plan to the document). 'all' runs them all, fetching into a temporary file
+            # unless --operations is given.
+            if args.collection == 'apply':
+                started = perf_counter()
+                plan = read_jsonl(plan_file)
+                print(f"Loaded {len(plan)} plan items from {plan_file} in {perf_counter() - started:.1f} s")
+            else:
+                started = perf_counter()
+                temporary_file = None
+                if args.collection == 'plan' and args.operations:
+                    operations = read_operations(args.operations)
+                else:
+                    # Streamed to the file window by window, an interrupted fetch resumes from the completed windows.
+                    # 'all' goes through a file too, so planning reads one window at a time.
+                    fetch_accounts()
+                    fetch_portfolio()
+                    get_instruments().add_portfolio(broker_portfolio)
+                    operations_file = args.operations
+                    if operations_file is None and args.collection == 'fetch':
+                        operations_file = 'operations.jsonl'
+                    elif operations_file is None:
+                        fd, operations_file = tempfile.mkstemp(prefix='operations-', suffix='.jsonl')
+                        os.close(fd)
+                        temporary_file = operations_file
+                    fetch_operations_to_file(operations_file, args.period_start, args.period_end, account_starts)
+                    operations = read_operations(operations_file)
+                try:
+                    prefetch_market_data(operations)
+                    print(f"Fetch stage took {perf_counter() - started:.1f} s")
+                    if client is not None:
+                        client.report()
+                    if args.collection == 'fetch':
+                        return
+
+                    started = perf_counter()
+                    plan = plan_operations(operations)
+                    print(f"Plan stage took {perf_counter() - started:.1f} s")
+                finally:
+                    if temporary_file is not None:
+                        os.remove(temporary_file)
+                if args.collection == 'plan':
+                    write_jsonl(args.plan, plan)
+                    print(f"Saved {len(plan)} plan items to {args.plan}")
+                    return
+
+            if len(documents) == 1:
+                document, names = documents[0]
+                apply_document(document, plan_for_document(plan, names), args.work_on_copy, args.profile, incremental)
+            else:
+                apply_documents(documents, plan, args.work_on_copy, args.profile, incremental)
+        elif args.command == 'reconcile' and args.collection == 'portfolio':
+            fetch_accounts()
+            portfolios = fetch_account_portfolios()
+            get_client().report()
             banktivity = Banktivity.Banktivity(args.banktivity_document)
-            import_operations(args)
-
-            if not dryrun:
-                banktivity.commit()
+            started = perf_counter()
+            mismatches = reconcile_positions(portfolios)
+            print(f"Reconciled positions in {perf_counter() - started:.3f} s")
+            if mismatches:
+                exit(1)
         else:
             print("I don't know what to do. Probably unexpected combination of command line arguments given.")
 
 
-def get_portfolio_security_by_figi(figi):
-    elem_index = None
-    for i, dic in enumerate(broker_portfolio):
-        if dic.figi == figi:
-            elem_index = i
-            break
+def get_client():
+    """The broker client, asking for the OpenAPI token on first use. Thread-safe: the prefetch pool may be first."""
+    global client
+    with client_lock:
+        if client is None:
+            # Get Tinkoff Investments OpenAPI token
+            token = keyring.get_password('adeg/banktivity-importer', 'tinkoff-api')
+            if token is None or len(token) < OPENAPI_TOKEN_LENGTH:
+                token = getpass.getpass(prompt='Enter Tinkoff Investments OpenAPI token: ')
+                if len(token) < OPENAPI_TOKEN_LENGTH:
+                    print("Unable to obtain a valid Tinkoff Investments OpenAPI token")
+                    exit(1)
+            client = BrokerClient(openapi.api_client(token), limits=rate_limits, concurrency=concurrency,
+                                  retries=retries)
+            del token # if I can remove sensitive info from some part of the memory - I go for it
+    return client
 
-    if elem_index is not None:
-        return broker_portfolio[elem_index]
-    else:
-        return None
+
+def get_candle_cache():
+    global candle_cache
+    if candle_cache is None:
+        candle_cache = CandleCache(cache_file, timezone(our_timezone))
+    return candle_cache
+
+
+def get_instruments():
+    global instruments
+    if instruments is None:
+        instruments = InstrumentRegistry(cache_file, instrument_cache_ttl_days)
+    return instruments
 
 
 def fetch_accounts():
     global broker_accounts
-    response = client.user.user_accounts_get()
+    response = get_client().user.user_accounts_get()
     broker_accounts = response.payload.accounts.copy()
     logging.debug(f"Raw Tinkoff Investments account data:\n{pprint.pformat(broker_accounts)}")
 
 
 def fetch_portfolio():
     global broker_portfolio
-    response = client.portfolio.portfolio_get()
+    response = get_client().portfolio.portfolio_get()
     broker_portfolio = response.payload.positions
     '''
     {'average_position_price': {'currency': 'RUB', 'value': 0.0343},
@@ -160,19 +347,28 @@ def fetch_portfolio():
     logging.debug(f"Broker Portfolio raw data:\n{pprint.pformat(broker_portfolio)}")
 
 
+def fetch_account_portfolios():
+    """Dict of broker_account_id -> positions of the account (see fetch_portfolio())."""
+    portfolios = {}
+    for item in broker_accounts:
+        response = get_client().portfolio.portfolio_get(broker_account_id=item.broker_account_id)
+        portfolios[item.broker_account_id] = response.payload.positions
+        get_instruments().add_portfolio(response.payload.positions)
+    logging.debug(f"Broker portfolios raw data:\n{pprint.pformat(portfolios)}")
+    return portfolios
+
+
 def get_broker_security_by_figi(figi):
-    broker_security = get_portfolio_security_by_figi(figi)
+    # Portfolio, then the instrument cache, then the network (see InstrumentRegistry)
+    broker_security = get_instruments().get(figi, search_by_figi)
     if broker_security is None:
-        broker_security = search_by_figi(figi)
-        if broker_security.isin is None:
-            print(f"ERROR: Couldn't find broker security by figi {figi}.")
-            return None
+        print(f"ERROR: Couldn't find broker security by figi {figi}.")
 
     return broker_security
 
 
 def search_by_figi(figi):
-    response = client.market.market_search_by_figi_get(figi)
+    response = get_client().market.market_search_by_figi_get(figi)
     '''
     {
       "trackingId": "string",
@@ -194,33 +390,26 @@ def search_by_figi(figi):
     return response.payload
 
 
-def get_market_candle_by_figi_and_day(figi, datetime):
-    datetimefrom = datetime.replace(hour=0, minute=0, second=0)
-    datetimeto = datetime.replace(hour=23, minute=59, second=59)
-    response = client.market.market_candles_get(
-        figi=figi, _from=datetimefrom.isoformat(), to=datetimeto.isoformat(), interval='day'
+def fetch_market_candles(figi, first_day, last_day, interval='day'):
+    datetimefrom = timezone(our_timezone).localize(datetime.combine(first_day, time(0, 0, 0)))
+    datetimeto = timezone(our_timezone).localize(datetime.combine(last_day, time(23, 59, 59)))
+    response = get_client().market.market_candles_get(
+        figi=figi, _from=datetimefrom.isoformat(), to=datetimeto.isoformat(), interval=interval
     )
-    candles = response.payload.candles
     logging.debug(f"Fetching candles for {figi}:\n{pprint.pformat(response)}")
-    if len(candles) > 1:
-        print(
-            f"WARNING: More than 1 candle ({len(candles)}) returned for FIGI {figi} in the period from {datetimefrom} to {datetimeto}")
 
-    return response.payload.candles[0]
+    return response.payload.candles
 
 
-def get_zsecurity_by_figi(figi):
-    global broker_portfolio
-
-    broker_security = get_portfolio_security_by_figi(figi)
-    # If security couldn't be found in portfolio, search online
-    if broker_security is None:
-        broker_security = search_by_figi(figi)
-        if broker_security.isin is None:
-            print(f"ERROR: Couldn't find broker security by figi {figi}. Aborting.")
-            return None
+def get_market_candle_by_figi_and_day(figi, day_datetime):
+    day = day_datetime.astimezone(timezone(our_timezone)).date()
+    candle_cache = get_candle_cache()
+    candle = candle_cache.get(figi, day)
+    if candle is None:
+        candle_cache.ensure(figi, day, day, fetch_market_candles)
+        candle = candle_cache.get(figi, day)
 
-    return banktivity.get_zsecurity_by_symbol(broker_security.isin)
+    return candle
 
 
 def prepare_account_operation_data(broker_operation_data, account_transaction_data):
@@ -258,23 +447,27 @@ def prepare_account_operation_data(broker_operation_data, account_transaction_da
 # end of  prepare_account_operation_data()
 
 
-def prepare_security_operation_data(broker_operation_data, security_transaction_data):
+def prepare_security_operation_data(broker_operation_data, security_transaction_data, plan, planned_symbols):
+    """Fill security_transaction_data and add the security and price items the transaction needs to the plan.
+
+    The plan doesn't depend on a document: the security is referenced by its symbol (ISIN) in 'zpsymbol'. Its Z_PK,
+    name (the {zpname} placeholder in 'zpnote') and par value are resolved by resolve_transaction_data() when the plan
+    is applied.
+    """
     # Resolve figi into ticker symbol
     # Tinkoff broker operations references securities by figi, but Banktivity uses ticker symbols
-    zsecurity = get_zsecurity_by_figi(broker_operation_data.figi)
-
-    # if security not found in Banktivity — add it
-    if zsecurity is None:
-        broker_security = get_broker_security_by_figi(broker_operation_data.figi)
-        logging.debug(f"broker_security object:\n{broker_security}")
-        if broker_security is None:
-            print(
-                f"ERROR: Couldn't find broker security by FIGI {broker_operation_data.figi}. Can't continue. Aborting.")
-            exit(1)
+    broker_security = get_broker_security_by_figi(broker_operation_data.figi)
+    logging.debug(f"broker_security object:\n{broker_security}")
+    if broker_security is None:
+        print(
+            f"ERROR: Couldn't find broker security by FIGI {broker_operation_data.figi}. Can't continue. Aborting.")
+        exit(1)
 
+    # if security not found in Banktivity — it gets added when applying the plan
+    if broker_security.isin not in planned_symbols:
+        planned_symbols.add(broker_security.isin)
         new_zsecurity_data = {
-            'zptype': banktivity.get_zsecurity_zptype_by_name(broker_operation_data.instrument_type),
-            'currency': broker_security.average_position_price.currency if hasattr(broker_security, 'average_position_price') else broker_security.currency,
+            'currency': broker_security.currency,
             # will get converted into zpcurrency.z_pk by add_zsecurity()
             'zpdate': broker_operation_data.date.isoformat(),
             # important to pass full datetime w/ TZ as Banktivity stores unixepoch/UTC
@@ -290,8 +483,9 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
                 # TODO: find out how it's possible to get Bond par value from Tinkoff broker
                 'zpparvalue': 1000
             })
-        banktivity.add_zsecurity(new_zsecurity_data)
-        zsecurity = get_zsecurity_by_figi(broker_operation_data.figi)
+        # zptype is resolved from instrument_type when applying the plan
+        plan.append({'type': 'security', 'instrument_type': broker_operation_data.instrument_type,
+                     'data': new_zsecurity_data})
 
     # commission_amount: used in ZSECURITYLINEITEM
     # zpchecknumber: used in ZTRANSACTION
@@ -302,7 +496,7 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
     #   Used in ZLINEITEM. Checking accounts could be wrongly showing
     #   overdraft just because expense transactions got imported before
     #   deposits. Deprioritise expense transaction LineItems.
-    # zpsecurity: used in ZSECURITYLINEITEM, references ZSECURITY.Z_PK
+    # zpsymbol: resolved into zpsecurity (used in ZSECURITYLINEITEM, references ZSECURITY.Z_PK) when applying
     security_transaction_data.update({
         'transaction_currency_code': broker_operation_data.currency,
         'zpadjustment': None,
@@ -311,7 +505,8 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
         'zpdate': broker_operation_data.date.isoformat(),
         'zptitle': None,
         'zpintradaysortindex': 2,
-        'zpsecurity': zsecurity['Z_PK'],
+        'zpsymbol': broker_security.isin,
+        'instrument_type': broker_operation_data.instrument_type,
     })
 
     if broker_operation_data.operation_type == 'Buy' or broker_operation_data.operation_type == 'BuyCard' or broker_operation_data.operation_type == 'Sell':
@@ -325,45 +520,44 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
             print(f"ERROR: Unsupported Tinkoff broker operation type {broker_operation_data.operation_type}. Aborting.")
             exit(1)
 
-        # Tinkoff broker uses bond market prices in operations but Banktivity expects percentage of par value
+        # Tinkoff broker uses bond market prices in operations but Banktivity expects percentage of par value.
+        # zppricepershare is computed from broker_price and the par value when applying the plan.
         banktivity_zpamount = (-1 * broker_operation_data.price * banktivity_zpshares) + broker_operation_data.commission.value
-        if broker_operation_data.instrument_type == 'Bond':
-            security_transaction_data['zppricemultiplier'] = zsecurity['ZPPARVALUE']
-            banktivity_price_per_share = broker_operation_data.price / zsecurity['ZPPARVALUE']
-        else:
-            banktivity_price_per_share = broker_operation_data.price
 
         security_transaction_data.update({
             'transaction_category_name': None,  # no category for Buy or Sell
             'transaction_type': transaction_type,
-            'zpnote': f"{transaction_type} {broker_operation_data.quantity} of {broker_operation_data.instrument_type} {zsecurity['ZPNAME']} @ {broker_operation_data.price}",
+            'zpnote': f"{transaction_type} {broker_operation_data.quantity} of {broker_operation_data.instrument_type} {{zpname}} @ {broker_operation_data.price}",
             'zptransactionamount': 0,  # used in ZLINEITEM: this field is zero for security Buy/Sell transactions
             # used in ZSECURITYLINEITEM. Note that Tinkoff broker reports payment as the cost of the stock/bond transaction w/o commission. Banktivity records commission in ZPAMOUNT
             'zpamount': banktivity_zpamount,
-            'zppricepershare': banktivity_price_per_share,  # used in ZSECURITYLINEITEM
+            'broker_price': broker_operation_data.price,  # zppricepershare used in ZSECURITYLINEITEM
             'zpshares': banktivity_zpshares
         })
 
         security_dayprices = get_market_candle_by_figi_and_day(broker_operation_data.figi, broker_operation_data.date)
-        # Create or update ZSECURITYPRICE entry for the day of the transaction for transactions on the market
-        zsecurity_par_value = zsecurity['ZPPARVALUE'] if zsecurity['ZPPARVALUE'] is not None else 1
-        zsecurity_dayprices = {
-            'zpdate': security_transaction_data['zpdate'],
-            'zpsecurity_pk': zsecurity['Z_PK'],  # needed to look up ZSECURITYPRICEITEM.Z_PK
-            'c': security_dayprices.c / zsecurity_par_value,
-            'h': security_dayprices.h / zsecurity_par_value,
-            'l': security_dayprices.l / zsecurity_par_value,
-            'o': security_dayprices.o / zsecurity_par_value,
-            'v': security_dayprices.v
-        }
-        banktivity.add_zsecurityprice(zsecurity_dayprices)
+        if security_dayprices is None:
+            print(f"WARNING: No market candle for FIGI {broker_operation_data.figi} on {broker_operation_data.date.date()}. Security price is not updated.")
+        else:
+            # Create or update ZSECURITYPRICE entry for the day of the transaction for transactions on the market.
+            # Prices are divided by the par value when applying the plan.
+            plan.append({
+                'type': 'price',
+                'zpdate': security_transaction_data['zpdate'],
+                'zpsymbol': broker_security.isin,
+                'c': security_dayprices.c,
+                'h': security_dayprices.h,
+                'l': security_dayprices.l,
+                'o': security_dayprices.o,
+                'v': security_dayprices.v
+            })
 
     elif broker_operation_data.operation_type == 'BrokerCommission':
         transaction_type = 'Interest Inc.'
         security_transaction_data.update({
             'transaction_category_name': "Банк:Оплата за услуги",
             'transaction_type': transaction_type,
-            'zpnote': f"{broker_operation_data.operation_type} for {broker_operation_data.instrument_type} {zsecurity['ZPNAME']}",
+            'zpnote': f"{broker_operation_data.operation_type} for {broker_operation_data.instrument_type} {{zpname}}",
             # used in ZLINEITEM. zptransactionamount is zero for Buy/Sell transactions
             'zptransactionamount': broker_operation_data.payment,
         })
@@ -372,7 +566,7 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
         security_transaction_data.update({
             'transaction_category_name': "Налоги",
             'transaction_type': transaction_type,
-            'zpnote': f"{broker_operation_data.operation_type} on revenue for {broker_operation_data.instrument_type} {zsecurity['ZPNAME']}",
+            'zpnote': f"{broker_operation_data.operation_type} on revenue for {broker_operation_data.instrument_type} {{zpname}}",
             # used in ZLINEITEM. zptransactionamount is zero for Buy/Sell transactions
             'zptransactionamount': broker_operation_data.payment,
             'zpincome': broker_operation_data.payment,
@@ -382,7 +576,7 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
         security_transaction_data.update({
             'transaction_category_name': "Инвестиции:Проценты",
             'transaction_type': transaction_type,
-            'zpnote': f"{broker_operation_data.operation_type} on {broker_operation_data.instrument_type} {zsecurity['ZPNAME']}",
+            'zpnote': f"{broker_operation_data.operation_type} on {broker_operation_data.instrument_type} {{zpname}}",
             # used in ZLINEITEM. zptransactionamount is zero for Buy/Sell transactions
             'zptransactionamount': broker_operation_data.payment,
             'zpincome': broker_operation_data.payment,
@@ -399,7 +593,7 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
         security_transaction_data.update({
             'transaction_category_name': "Инвестиции:Дивиденды",
             'transaction_type': transaction_type,
-            'zpnote': f"Profit on {broker_operation_data.instrument_type} {zsecurity['ZPNAME']}",
+            'zpnote': f"Profit on {broker_operation_data.instrument_type} {{zpname}}",
             'zptransactionamount': 0,  # used in ZLINEITEM: this field is zero for security transactions
             'zpincome': broker_operation_data.payment, # used in ZSECURITYLINEITEM
         })
@@ -411,24 +605,341 @@ def prepare_security_operation_data(broker_operation_data, security_transaction_
     return True
 # end of  prepare_security_operation_data()
 
-def import_operations(args):
+def fetch_operations(broker_account_id, period_start, period_end):
+    response = get_client().operations.operations_get(
+        _from=period_start.isoformat()
+        , to=period_end.isoformat()
+        , broker_account_id=broker_account_id
+    )
+    return response.payload.operations
+
+
+def operation_windows(period_start, period_end):
+    """Split the period into consecutive (window_start, window_end) windows of OperationsWindowDays days."""
+    windows = []
+    window_start = period_start
+    while window_start < period_end:
+        window_end = min(window_start + timedelta(days=operations_window_days), period_end)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+def fetch_window_operations(broker_account_id, window_start, window_end, is_last):
+    """Operations of one window in date order. Windows are half-open except the last one, so an operation at the
+    boundary of two windows is returned once."""
+    operations = [op for op in fetch_operations(broker_account_id, window_start, window_end)
+                  if window_start <= op.date < window_end or (is_last and op.date == window_end)]
+    return sorted(operations, key=lambda op: op.date)
+
+
+def iter_operations(broker_account_id, period_start, period_end):
+    """Yield operations of the account in date order, fetching one window (see operation_windows()) at a time."""
+    windows = operation_windows(period_start, period_end)
+    for i, (window_start, window_end) in enumerate(windows):
+        yield from fetch_window_operations(broker_account_id, window_start, window_end, i == len(windows) - 1)
+
+
+def iter_all_operations(period_start, period_end):
+    """Yield (broker account ID, operation) of all broker accounts, account by account in date order.
+
+    Windows are fetched concurrently but yielded in order, and at most Concurrency windows are fetched ahead of the
+    one being yielded, so memory use doesn't grow with the period.
+    """
+    tasks = []
+    for item in broker_accounts:
+        windows = operation_windows(period_start, period_end)
+        tasks.extend((item.broker_account_id, window_start, window_end, i == len(windows) - 1)
+                     for i, (window_start, window_end) in enumerate(windows))
+    tasks = iter(tasks)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append((task[0], executor.submit(fetch_window_operations, *task)))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            broker_account_id, future = pending.popleft()
+            task = next(tasks, None)
+            if task is not None:
+                pending.append((task[0], executor.submit(fetch_window_operations, *task)))
+            for op in future.result():
+                yield broker_account_id, op
+
+
+def account_periods(period_start, period_end, account_starts=None):
+    """Broker account ID -> (start, end) of the period to fetch. account_starts overrides period_start for the
+    accounts in it (broker account ID -> datetime)."""
+    fmt = '%Y-%m-%d %H:%M:%S%z'
+    periods = {}
+    for item in broker_accounts:
+        account_start = (account_starts or {}).get(item.broker_account_id, period_start)
+        print(f"Fetching operations for Tinkoff.Investments account ID {item.broker_account_id} for the period from {account_start.strftime(fmt)} to {period_end.strftime(fmt)}")
+        periods[item.broker_account_id] = (account_start, period_end)
+    return periods
+
+
+def fetch_operations_to_file(path, period_start, period_end, account_starts=None):
+    """Fetch operations of all broker accounts into a JSONL file window by window: a 'fetch' line with the
+    parameters, an 'account' line per broker account, then 'operation' lines.
+
+    Windows are fetched concurrently and every window is appended to the file as soon as it is fetched, followed by
+    a 'window' line marking it complete, so only a window's worth of operations per thread is held in memory. If the
+    file was left by an interrupted fetch with the same parameters, the completed windows are kept and only the rest
+    is fetched. A 'fetched' line with the end of the period is appended once every window is in the file.
+    """
+    periods = account_periods(period_start, period_end, account_starts)
+    header = {'type': 'fetch', 'window_days': operations_window_days,
+              'period_starts': {broker_account_id: start.isoformat() for broker_account_id, (start, _) in periods.items()}}
+    windows = {broker_account_id: operation_windows(start, end) for broker_account_id, (start, end) in periods.items()}
+
+    completed = resume_operations_file(path, header, windows)
+    if completed is None:
+        completed = set()
+        write_jsonl(path, [header] + account_items())
+    elif completed:
+        print(f"Resuming the fetch into {path}: {len(completed)} windows fetched earlier")
+
+    fetched = 0
+    failed = 0
+    with open(expanduser(path), 'a') as f, concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for broker_account_id, account_windows in windows.items():
+            for i, (window_start, window_end) in enumerate(account_windows):
+                if (broker_account_id, window_start.isoformat()) not in completed:
+                    future = executor.submit(fetch_window_operations, broker_account_id, window_start, window_end,
+                                             i == len(account_windows) - 1)
+                    futures[future] = (broker_account_id, window_start, window_end)
+        for future in concurrent.futures.as_completed(futures):
+            broker_account_id, window_start, window_end = futures.pop(future)
+            try:
+                items = operation_items(broker_account_id, future.result())
+            except Exception as e:
+                # The other windows are still saved, the next run fetches the failed ones only
+                print(f"NOTICE: Couldn't fetch operations of account ID {broker_account_id} from {window_start.isoformat()} to {window_end.isoformat()}: {e}")
+                failed += 1
+                continue
+            items.append({'type': 'window', 'broker_account_id': broker_account_id,
+                          'window_start': window_start.isoformat(), 'window_end': window_end.isoformat()})
+            f.write(''.join(json.dumps(item, ensure_ascii=False, default=json_default) + "\n" for item in items))
+            f.flush()
+            fetched += len(items) - 1
+    print(f"Saved {fetched} operations to {path}")
+    if failed:
+        print(f"ERROR: {failed} windows of operations couldn't be fetched. Run the fetch again to resume. Abort.")
+        exit(1)
+    with open(expanduser(path), 'a') as f:
+        f.write(json.dumps({'type': 'fetched', 'period_end': period_end.isoformat()}) + "\n")
+
+
+def resume_operations_file(path, header, windows):
+    """Keep the complete windows of a file left by fetch_operations_to_file() with the same header.
+
+    Returns the set of (broker account ID, window start) of the windows kept, or None if there's nothing to resume.
+    Operations of incomplete windows and a line cut by the interruption are dropped, the file is rewritten with the
+    rest.
+    """
+    path = expanduser(path)
+    if not os.path.exists(path):
+        return None
+
+    def items():
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    return
+
+    first_item = next(items(), None)
+    if first_item != json.loads(json.dumps(header)):
+        return None
+
+    window_starts = {broker_account_id: [window_start for window_start, _ in account_windows]
+                     for broker_account_id, account_windows in windows.items()}
+    window_ends = {(broker_account_id, window_start.isoformat()): window_end
+                   for broker_account_id, account_windows in windows.items()
+                   for window_start, window_end in account_windows}
+    # A window is complete if it was fetched up to the same end (the last window ends later on every run)
+    completed = {(item['broker_account_id'], item['window_start']) for item in items()
+                 if item['type'] == 'window' and (item['broker_account_id'], item['window_start']) in window_ends
+                 and datetime.fromisoformat(item['window_end']) >= window_ends[(item['broker_account_id'], item['window_start'])]}
+
+    def window_of(item):
+        starts = window_starts[item['broker_account_id']]
+        i = bisect.bisect_right(starts, datetime.fromisoformat(item['operation']['date'])) - 1
+        return item['broker_account_id'], starts[max(i, 0)].isoformat()
+
+    kept = (item for item in items() if item['type'] == 'operation' and window_of(item) in completed
+            or item['type'] == 'window' and (item['broker_account_id'], item['window_start']) in completed)
+    write_jsonl(path + '.tmp', [header] + account_items())
+    with open(path + '.tmp', 'a') as f:
+        for item in kept:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    os.replace(path + '.tmp', path)
+    return completed
+
+
+def prefetch_market_data(operations):
+    """Fetch the instruments and candles plan_operations() needs and that are not cached yet.
+
+    Instruments referenced by the operations and candles for the days of Buy/Sell operations (one request per FIGI
+    and span of days, see CandleCache) are requested in a pool of Concurrency threads; the caches are written from
+    this thread only as SQLite connections can't be shared between threads.
+    """
+    done_operations = [op for account_operations in operations.values() for op in account_operations
+                       if op.status == 'Done' and op.figi is not None]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Instruments referenced by security operations
+        figis = {op.figi for op in done_operations}
+        instruments = get_instruments()
+        missing_figis = [figi for figi in figis if not instruments.cached(figi)[0]]
+        for figi, broker_security in zip(missing_figis, executor.map(search_by_figi, missing_figis)):
+            instruments.resolve(figi, broker_security)
+
+        # Candles for the days of Buy/Sell operations
+        candle_cache = get_candle_cache()
+        days_by_figi = {}
+        for op in done_operations:
+            if op.operation_type in ('Buy', 'BuyCard', 'Sell'):
+                day = op.date.astimezone(timezone(our_timezone)).date()
+                if candle_cache.get(op.figi, day) is None:
+                    days_by_figi.setdefault(op.figi, []).append(day)
+        spans = [(figi, span_first, span_last) for figi, days in days_by_figi.items()
+                 for span_first, span_last in candle_cache.missing_spans(figi, min(days), max(days))]
+        for (figi, span_first, span_last), candles in zip(
+                spans, executor.map(lambda span: fetch_market_candles(*span), spans)):
+            candle_cache.store(figi, span_first, span_last, candles)
+
+    print(f"Fetched {len(missing_figis)} instruments and {len(spans)} candle ranges not cached yet")
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return vars(value)
+
+
+def operation_from_json(value, key=None):
+    """Rebuild an operation read from JSON with attribute access and datetimes, like the objects of the API client."""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: operation_from_json(v, k) for k, v in value.items()})
+    if isinstance(value, list):
+        return [operation_from_json(item) for item in value]
+    if key in ('date', 'time') and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+# Columns of print operations --format csv, nested objects as dotted names (see flatten_record())
+OPERATION_CSV_COLUMNS = ['broker_account_id', 'id', 'date', 'operation_type', 'status', 'instrument_type', 'figi',
+                         'currency', 'payment', 'price', 'quantity', 'quantity_executed', 'commission.value',
+                         'commission.currency', 'is_margin_call', 'trades']
+
+
+def flatten_record(record, prefix=''):
+    """Flat dict of a record for CSV: nested dicts as dotted names, lists as JSON, datetimes in ISO format."""
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, f"{prefix}{key}."))
+        elif isinstance(value, list):
+            flat[prefix + key] = json.dumps(value, ensure_ascii=False, default=json_default)
+        elif isinstance(value, datetime):
+            flat[prefix + key] = value.isoformat()
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def print_records(records, output_format, columns=None):
+    """Write records (dicts) to stdout as JSON lines or CSV, each as soon as it comes. Without columns the CSV
+    columns are those of all records, which are read first."""
+    if output_format == 'jsonl':
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False, default=json_default) + "\n")
+        return
+
+    if columns is None:
+        records = [flatten_record(record) for record in records]
+        columns = list(dict.fromkeys(column for record in records for column in record))
+    else:
+        records = (flatten_record(record) for record in records)
+    writer = csv.DictWriter(sys.stdout, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+
+def write_jsonl(path, items):
+    with open(expanduser(path), 'w') as f:
+        for item in items:
+            f.write(json.dumps(item, ensure_ascii=False, default=json_default) + "\n")
+
+
+def read_jsonl(path):
+    with open(expanduser(path)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def account_items():
+    return [{'type': 'account', 'broker_account_id': item.broker_account_id,
+             'broker_account_type': item.broker_account_type} for item in broker_accounts]
+
+
+def operation_items(broker_account_id, operations):
+    return [{'type': 'operation', 'broker_account_id': broker_account_id,
+             'operation': op.to_dict() if hasattr(op, 'to_dict') else op} for op in operations]
+
+
+def read_operations(path):
+    """Operations saved by fetch_operations_to_file() as an OperationsFile: per account, read from the file in date
+    order one window at a time on every pass. Sets broker_accounts to the accounts in the file.
+
+    Files of an interrupted or failed fetch are refused: a plan of the windows fetched so far would move the
+    watermarks past the missing ones and later incremental imports would never fetch them.
+    """
+    global broker_accounts
+    operations = OperationsFile(path, operation_from_json)
+    incomplete_accounts = operations.incomplete_accounts()
+    if incomplete_accounts:
+        print(f"ERROR: Operations of broker accounts {', '.join(incomplete_accounts)} in {path} are incomplete, the "
+              f"fetch was interrupted or failed. Run the fetch again with the same arguments to complete it. Aborting.")
+        exit(1)
+    broker_accounts = [SimpleNamespace(broker_account_id=broker_account_id, broker_account_type=broker_account_type)
+                       for broker_account_id, broker_account_type in operations.accounts]
+    return operations
+
+
+def plan_operations(operations):
+    """Turn broker operations (broker account ID -> iterable of operations in date order, read once) into a plan: a
+    list of dicts to be written to a document by apply_plan().
+
+    o {'type': 'security', 'instrument_type', 'data'}: security to add if the document doesn't have it yet
+    o {'type': 'price', 'zpdate', 'zpsymbol', 'o', 'h', 'l', 'c', 'v'}: market prices of the day of a trade
+    o {'type': 'transaction', 'broker_account_id', 'operation_id', 'operation_type', 'data'}: the
+      banktivity_transaction_data of an operation, with references resolved by resolve_transaction_data()
+    o {'type': 'watermark', 'broker_account_id', 'operation_date', 'operation_id'}: the latest operation of an
+      account whose operations are all in the plan (see ImportState)
+    The plan doesn't depend on the document, so it can be applied to several documents.
+    """
     global broker_accounts, our_timezone
-    broker_account_id = ""
+    plan = []
+    planned_symbols = set()
     for item in broker_accounts:
         #pprint.pprint(item)
         broker_account_id = item.broker_account_id
         broker_account_type = item.broker_account_type
         print("Account type " + broker_account_type + " with ID " + broker_account_id)
 
-        fmt = '%Y-%m-%d %H:%M:%S%z'
-        print(f"Fetching operations for Tinkoff.Investments account ID {broker_account_id} for the period from {args.period_start.strftime(fmt)} to {args.period_end.strftime(fmt)}")
-        response = client.operations.operations_get(
-            _from=args.period_start.isoformat()
-            , to=args.period_end.isoformat()
-            , broker_account_id=broker_account_id
-        )
+        latest = None
+        for op in operations[broker_account_id]:
+            if latest is None or op.date > latest.date:
+                latest = op
 
-        for op in response.payload.operations:
             """
             {'commission': None,
              'currency': 'USD',
@@ -485,7 +996,7 @@ def import_operations(args):
             else:
                 print("NOTICE: Unsupported operation status " + op.status)
                 pprint.pprint(op)
-                return None
+                return plan
 
             # No need to add transactions for BrokerCommission as these are accounted in Buy/Sell transactions
             # TODO: check if there are non-buy/sell broker commission operations
@@ -493,20 +1004,14 @@ def import_operations(args):
                 continue
 
             # Determine Banktivity target account name
-            banktivity_target_account_name = ""
-            if broker_account_type == 'Tinkoff':
-                banktivity_target_account_name = account_type_to_names[broker_account_type] + ' ' + op.currency
-            elif broker_account_type == 'TinkoffIis':
-                banktivity_target_account_name = account_type_to_names[broker_account_type]
-            else:
+            banktivity_target_account_name = get_banktivity_account_name(broker_account_type, op.currency)
+            if banktivity_target_account_name is None:
                 print("ERROR: Unknown broker account type " + broker_account_type + ". Aborting.")
-                return None
-            banktivity_target_account_pk = banktivity.get_zaccount_pk(banktivity_target_account_name)
+                return plan
 
             # Set up generic data for Banktivity transaction
             banktivity_transaction_data = {
                 'transaction_account_name': banktivity_target_account_name,
-                'primaryaccount_zaccount_pk': banktivity_target_account_pk
             }
 
             logging.debug(f"Processing Tinkoff Investments OpenAPI operation:\n{pprint.pformat(op)}")
@@ -515,40 +1020,402 @@ def import_operations(args):
             # ServiceCommission Tinkoff broker operations do not have references to security (via FIGI), so should be filed as Withdrawals
             if op.operation_type == 'PayIn' or op.operation_type == 'ServiceCommission':
                 prepare_account_operation_data(op, banktivity_transaction_data)
-            else:
-                prepare_security_operation_data(op, banktivity_transaction_data)
+            elif prepare_security_operation_data(op, banktivity_transaction_data, plan, planned_symbols) is None:
+                continue
+
+            plan.append({
+                'type': 'transaction',
+                'broker_account_id': broker_account_id,
+                'operation_id': op.id,
+                'operation_type': op.operation_type,
+                'data': banktivity_transaction_data
+            })
 
-            logging.debug(
-                f"banktivity_transaction_data before add_transaction():\n{pprint.pformat(banktivity_transaction_data)}")
+        # Every operation of the account has been handled, the watermark can move past them
+        if latest is not None:
+            plan.append({
+                'type': 'watermark',
+                'broker_account_id': broker_account_id,
+                'operation_date': latest.date.isoformat(),
+                'operation_id': latest.id
+            })
 
-            if op.operation_type == 'PayIn' or op.operation_type == 'ServiceCommission':
-                duplicate_found = banktivity.find_primaryaccount_transaction_duplicate(banktivity_transaction_data)
-                if duplicate_found:
-                    pass
-                else:
-                    print(
-                        f"Adding broker {op.operation_type} operation to Banktivity account '{banktivity_target_account_name}' (Z_PK {str(banktivity_target_account_pk)}) as PrimaryAccount transaction {banktivity_transaction_data['transaction_type']}")
-                    banktivity.add_transaction(banktivity_transaction_data)
+    return plan
+# End of plan_operations()
+
+
+def get_banktivity_account_name(broker_account_type, currency):
+    """Banktivity account of a broker account's operations in the currency (see account_type_to_names), None for
+    unknown account types."""
+    if broker_account_type == 'Tinkoff':
+        return account_type_to_names[broker_account_type] + ' ' + currency
+    elif broker_account_type == 'TinkoffIis':
+        return account_type_to_names[broker_account_type]
+    return None
+
+
+def reconcile_positions(portfolios):
+    """Compare the securities held at the broker with the holdings in the document and print the mismatches.
+
+    Holdings come from one aggregate query (see Banktivity.get_security_holdings()) and are joined to the broker
+    positions by ISIN (ZPSYMBOL) in memory. Only the Banktivity accounts the broker accounts import into are compared.
+    Currency positions are cash and are skipped. Returns the number of mismatches.
+    """
+    holdings = banktivity.get_security_holdings()
+
+    broker_account_types = {item.broker_account_id: item.broker_account_type for item in broker_accounts}
+    compared_zaccount_pks = {
+        zaccount_pk for name, zaccount_pk in banktivity.zaccount_pks.items()
+        for broker_account_type in set(broker_account_types.values())
+        if name == account_type_to_names.get(broker_account_type)
+        or (broker_account_type == 'Tinkoff' and name.startswith(account_type_to_names['Tinkoff'] + ' '))}
+
+    positions = {}
+    names = {}
+    for broker_account_id, account_positions in portfolios.items():
+        for position in account_positions:
+            if position.instrument_type == 'Currency':
+                continue
+            price = position.average_position_price or position.expected_yield
+            currency = price.currency if price else None
+            account_name = get_banktivity_account_name(broker_account_types[broker_account_id], currency)
+            zaccount_pk = banktivity.get_zaccount_pk(account_name)
+            if zaccount_pk is None:
+                print(f"NOTICE: No Banktivity account '{account_name}' for {position.ticker} ({position.isin}) "
+                      f"of broker account {broker_account_id}")
+                continue
+            compared_zaccount_pks.add(zaccount_pk)
+            key = (zaccount_pk, position.isin)
+            positions[key] = positions.get(key, 0) + position.balance
+            names[key] = f"{position.name} ({position.ticker})"
+
+    account_names = {zaccount_pk: name for name, zaccount_pk in banktivity.zaccount_pks.items()}
+    mismatches = []
+    for key in sorted(set(positions) | {key for key in holdings if key[0] in compared_zaccount_pks},
+                      key=lambda key: (account_names.get(key[0], ''), key[1] or '')):
+        broker_balance = positions.get(key, 0)
+        banktivity_balance = holdings.get(key, 0)
+        if abs(broker_balance - banktivity_balance) > 1e-6:
+            mismatches.append((account_names.get(key[0]), key[1], names.get(key, ''), banktivity_balance, broker_balance))
+
+    if not mismatches:
+        print(f"Positions match: {len(positions)} positions at the broker")
+        return 0
+    print(f"{'banktivity':>14} {'broker':>14} {'difference':>14}  account / ISIN")
+    for account_name, zpsymbol, name, banktivity_balance, broker_balance in mismatches:
+        print(f"{banktivity_balance:>14.4f} {broker_balance:>14.4f} {broker_balance - banktivity_balance:>14.4f}  "
+              f"{account_name} / {zpsymbol} {name}")
+    print(f"Found {len(mismatches)} mismatching positions")
+    return len(mismatches)
+
+
+def get_zsecurity_by_symbol(zpsymbol):
+    zsecurity = banktivity.get_zsecurity_by_symbol(zpsymbol)
+    if zsecurity is None:
+        print(f"ERROR: Couldn't find security {zpsymbol} in Banktivity. Aborting.")
+        exit(1)
+    return zsecurity
+
+
+def resolve_transaction_data(transaction_data):
+    """banktivity_transaction_data of a plan item with the references into the document resolved."""
+    transaction_data = dict(transaction_data)
+    transaction_data['primaryaccount_zaccount_pk'] = banktivity.get_zaccount_pk(transaction_data['transaction_account_name'])
+    if 'zpsymbol' in transaction_data:
+        zsecurity = get_zsecurity_by_symbol(transaction_data.pop('zpsymbol'))
+        transaction_data['zpsecurity'] = zsecurity['Z_PK']
+        transaction_data['zpnote'] = transaction_data['zpnote'].replace('{zpname}', zsecurity['ZPNAME'])
+        if 'broker_price' in transaction_data:
+            broker_price = transaction_data.pop('broker_price')
+            if transaction_data['instrument_type'] == 'Bond':
+                transaction_data['zppricemultiplier'] = zsecurity['ZPPARVALUE']
+                transaction_data['zppricepershare'] = broker_price / zsecurity['ZPPARVALUE']
             else:
-                duplicate_found = banktivity.find_security_transaction_duplicate(banktivity_transaction_data)
-                if duplicate_found:
-                    pass
-                else:
-                    print(
-                        f"Adding broker {op.operation_type} transaction to Banktivity account '{banktivity_target_account_name}' (Z_PK {str(banktivity_target_account_pk)}) as Security transaction {banktivity_transaction_data['transaction_type']}")
-                    banktivity.add_security_transaction(banktivity_transaction_data)
+                transaction_data['zppricepershare'] = broker_price
+    return transaction_data
+
+
+def resolve_documents(items):
+    """List of (document path, account_type_to_names of the document) for --documents items: names of [document:NAME]
+    sections of settings.ini, with Path and optionally their own BanktivityInvestmentAccountName and
+    BanktivityInvestmentIISAccountName, or paths of documents using the names of the importer section."""
+    documents = []
+    for item in items:
+        section = config[f"document:{item}"] if config.has_section(f"document:{item}") else {}
+        names = {
+            'Tinkoff': section.get('BanktivityInvestmentAccountName', account_type_to_names['Tinkoff']),
+            'TinkoffIis': section.get('BanktivityInvestmentIISAccountName', account_type_to_names['TinkoffIis'])
+        }
+        documents.append((section.get('Path', item), names))
+    return documents
+
+
+def common_watermarks(documents):
+    """Per broker account, the earliest watermark of the documents. Accounts without a watermark in one of them are
+    left out, so they are fetched for the whole default period."""
+    watermarks = [read_watermarks(document) for document in documents]
+    return {broker_account_id: min(document_watermarks[broker_account_id][0] for document_watermarks in watermarks)
+            for broker_account_id in set.intersection(*(set(document_watermarks) for document_watermarks in watermarks))}
+
+
+def plan_for_document(plan, names):
+    """The plan with transactions moved to the document's accounts (names is its account_type_to_names). Plans are
+    made with the names of the importer section."""
+    if names == account_type_to_names:
+        return plan
+    document_plan = []
+    for item in plan:
+        if item['type'] == 'transaction':
+            account_name = item['data']['transaction_account_name']
+            if account_name == account_type_to_names['TinkoffIis']:
+                account_name = names['TinkoffIis']
+            elif account_name.startswith(account_type_to_names['Tinkoff'] + ' '):
+                account_name = names['Tinkoff'] + account_name[len(account_type_to_names['Tinkoff']):]
+            item = dict(item, data=dict(item['data'], transaction_account_name=account_name))
+        document_plan.append(item)
+    return document_plan
+
+
+def apply_document(document, plan, work_on_copy, profile, incremental=False):
+    """The apply stage: write the plan to the document in an import session. See apply_plan() for incremental."""
+    global banktivity
+    started = perf_counter()
+    profiler = SQLProfiler() if profile is not None else None
+    banktivity = Banktivity.Banktivity(document, profiler=profiler)
+    import_state = ImportState(banktivity, document)
+    with banktivity.import_session(work_on_copy=work_on_copy):
+        apply_plan(plan, import_state, plan_digest(plan), incremental)
+        if update_running_balances:
+            write_running_balances(plan)
+        if report_security_lots:
+            print_security_lots(plan)
+
+        if not dryrun:
+            banktivity.commit()
+    print(f"Apply stage took {perf_counter() - started:.1f} s")
+
+    if profiler:
+        profiler.report(profile)
+
+
+def apply_documents(documents, plan, work_on_copy, profile, incremental=False):
+    """Apply the plan to several documents at once, each in its own process: documents are separate SQLite files
+    with their own write locks, so the applies don't wait for each other.
+
+    Workers are spawned rather than forked, as this process holds SQLite connections and thread pools by then. They
+    re-import the module, which reads settings.ini but neither asks for the OpenAPI token nor opens the broker caches
+    (see get_client()), and open their own document connections in apply_document().
+    """
+    started = perf_counter()
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(documents),
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(apply_document, document, plan_for_document(plan, names), work_on_copy,
+                                   # Each document's profile goes to its own file
+                                   f"{document.rstrip('/')}.{profile}" if profile else profile, incremental): document
+                   for document, names in documents}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            if error is None:
+                print(f"Applied the plan to {futures[future]}")
+            else:
+                print(f"ERROR: Applying the plan to {futures[future]} failed: {error!r}")
+                failed.append(futures[future])
+    print(f"Apply stage for {len(documents)} documents took {perf_counter() - started:.1f} s")
+    if failed:
+        print(f"ERROR: The plan wasn't applied to {', '.join(failed)}. Aborting.")
+        exit(1)
+
+
+def write_running_balances(plan):
+    """Store running balances of the line items from the day of the earliest transaction in the plan on."""
+    transaction_days = [isoformat_to_local_day(item['data']['zpdate']) for item in plan if item['type'] == 'transaction']
+    if not transaction_days:
+        return
+    since = local_day_to_zpdate(min(transaction_days))
+    # Only the line items since then are loaded, the earlier ones are summed per account by SQLite
+    balance_engine = BalanceEngine(banktivity)
+    balance_engine.recompute(since)
+    updated = balance_engine.write_back(since)
+    print(f"Updated running balances of {updated} line items")
+
+
+def print_security_lots(plan):
+    """Print the FIFO realized gains of the sells from the day of the earliest trade in the plan on, replaying only
+    the securities traded since then."""
+    trade_days = [isoformat_to_local_day(item['data']['zpdate']) for item in plan
+                  if item['type'] == 'transaction' and item['data'].get('zpshares')]
+    if not trade_days:
+        return
+    since = local_day_to_zpdate(min(trade_days))
+    lot_engine = LotEngine(banktivity)
+    lot_engine.recompute(since)
+    symbols = {zsecurity['Z_PK']: zpsymbol for zpsymbol, zsecurity in banktivity.zsecurities.items()}
+    gains = lot_engine.realized_gains(since)
+    for gain in gains:
+        print(f"Sold {gain.shares} of {symbols.get(gain.zsecurity_pk, gain.zsecurity_pk)} on "
+              f"{zpdate_to_local_day(gain.sell_zpdate).isoformat()}: proceeds {gain.proceeds:.2f}, "
+              f"FIFO cost {gain.cost:.2f}, gain {gain.gain:.2f}")
+        if gain.uncovered_shares:
+            print(f"NOTICE: {gain.uncovered_shares} of the shares sold are not covered by buys in the document, "
+                  f"counted at zero cost")
+    print(f"{len(gains)} sells since {zpdate_to_local_day(since).isoformat()}, realized gain "
+          f"{sum(gain.gain for gain in gains):.2f}, {len(lot_engine.open_lots())} open lots of the securities traded")
+
+
+def find_duplicate(transaction_data):
+    """Take the transaction's match from the duplicate index (see DuplicateIndex). True if there was one."""
+    if 'zpsecurity' in transaction_data:
+        return banktivity.find_security_transaction_duplicate(transaction_data)
+    return banktivity.find_primaryaccount_transaction_duplicate(transaction_data)
+
+
+def plan_digest(plan):
+    """Identifier of a plan for the resume cursors of ImportState: a hash of its items."""
+    return hashlib.sha1(json.dumps(plan, ensure_ascii=False, sort_keys=True, default=json_default).encode()).hexdigest()
+
+
+def write_checkpoint(import_state, new_prices, new_transactions, new_transaction_items, new_watermarks):
+    """Write the batch of prices and transactions collected by apply_plan() with their ledger entries and
+    watermarks, in a SAVEPOINT: if anything fails, none of the batch is left in the transaction."""
+    with banktivity.savepoint('checkpoint'):
+        banktivity.add_zsecurityprices(new_prices)
+        ztransaction_pks = banktivity.add_transactions_bulk(new_transactions)
+        import_state.record([(item['broker_account_id'], item['operation_id'], ztransaction_pk)
+                             for item, ztransaction_pk in zip(new_transaction_items, ztransaction_pks)])
+        for item in new_watermarks:
+            import_state.advance_watermark(item['broker_account_id'], datetime.fromisoformat(item['operation_date']),
+                                           item['operation_id'])
+    for batch in (new_prices, new_transactions, new_transaction_items, new_watermarks):
+        batch.clear()
+
+
+def apply_plan(plan, import_state, plan_id, incremental=False):
+    """Write a plan made by plan_operations() to the Banktivity document: add missing securities, update prices and
+    add the transactions that are not in the document yet. Operations in the ledger of import_state were imported
+    earlier and are skipped without duplicate checks. With incremental (an import without dates) so are operations
+    up to the account watermarks; with dates they are checked, as the broker posts some operations (coupons, tax
+    corrections) late with earlier dates and dates may be given to re-import a period on purpose.
+
+    Prices and transactions are written in batches (see write_checkpoint()). Every CheckpointOperations transactions
+    or CheckpointSeconds the batch is written and committed with the resume cursor of the plan, so if the apply
+    stops half-way (e.g. on a security missing in the document) the committed part is kept and the next apply of the
+    same plan continues from the last checkpoint. The last batch is left for the caller to commit.
+    """
+    start = import_state.cursor(plan_id)
+    if start:
+        print(f"Resuming the plan from item {start} of {len(plan)} (applied and committed earlier)")
+    items = list(enumerate(plan))
+    # Operations applied before the cursor without a ledger entry (e.g. ID -1), added or found as duplicates
+    applied_earlier = [item for _, item in items[:start] if item['type'] == 'transaction' and
+                       not import_state.in_ledger(item['broker_account_id'], item['operation_id'])]
+    items = items[start:]
+
+    in_ledger = [item for _, item in items if item['type'] == 'transaction' and import_state.in_ledger(
+        item['broker_account_id'], item['operation_id'])]
+    if in_ledger:
+        print(f"Skipping {len(in_ledger)} operations imported earlier (found in the import ledger)")
+    skipped = {id(item) for item in in_ledger}
+    imported_earlier = [item for _, item in items if incremental and item['type'] == 'transaction' and
+                        id(item) not in skipped and
+                        import_state.is_imported(item['broker_account_id'],
+                                                 datetime.fromisoformat(item['data']['zpdate']), item['operation_id'])]
+    for item in imported_earlier:
+        print(f"Skipping broker {item['operation_type']} operation id {item['operation_id']} dated "
+              f"{item['data']['zpdate']}: not newer than the watermark of broker account {item['broker_account_id']}")
+    if imported_earlier:
+        print(f"Skipping {len(imported_earlier)} operations imported earlier (up to the account watermarks)")
+    skipped.update(id(item) for item in imported_earlier)
+    items = [(position, item) for position, item in items if id(item) not in skipped]
+
+    transaction_dates = [datetime.fromisoformat(item['data']['zpdate']) for item in
+                         [item for _, item in items] + applied_earlier + imported_earlier if item['type'] == 'transaction']
+    if transaction_dates:
+        # Transactions in the ledger belong to their operations and must not be taken as duplicates of new ones
+        banktivity.preload_duplicates(min(transaction_dates), max(transaction_dates),
+                                      import_state.ledger_ztransaction_pks())
+    # Operations applied before the cursor or skipped by the watermarks without a ledger entry: their transactions
+    # are taken from the duplicate index, or new identical operations of the same day would match them
+    for item in applied_earlier + imported_earlier:
+        if 'zpsymbol' not in item['data'] or banktivity.get_zsecurity_by_symbol(item['data']['zpsymbol']) is not None:
+            find_duplicate(resolve_transaction_data(item['data']))
+
+    new_transactions = []
+    new_transaction_items = []
+    new_prices = []
+    new_watermarks = []
+    last_checkpoint = perf_counter()
+    for position, item in items:
+        if len(new_transactions) >= checkpoint_operations or perf_counter() - last_checkpoint >= checkpoint_seconds:
+            write_checkpoint(import_state, new_prices, new_transactions, new_transaction_items, new_watermarks)
+            import_state.save_cursor(plan_id, position)
+            if not dryrun:
+                banktivity.commit()
+            print(f"Checkpoint: {position} of {len(plan)} plan items applied")
+            last_checkpoint = perf_counter()
+
+        if item['type'] == 'watermark':
+            new_watermarks.append(item)
+            continue
+
+        if item['type'] == 'security':
+            if banktivity.get_zsecurity_by_symbol(item['data']['zpsymbol']) is None:
+                banktivity.add_zsecurity(dict(item['data'], zptype=banktivity.get_zsecurity_zptype_by_name(item['instrument_type'])))
+            continue
+
+        if item['type'] == 'price':
+            zsecurity = get_zsecurity_by_symbol(item['zpsymbol'])
+            zsecurity_par_value = zsecurity['ZPPARVALUE'] if zsecurity['ZPPARVALUE'] is not None else 1
+            new_prices.append({
+                'zpdate': item['zpdate'],
+                'zpsecurity_pk': zsecurity['Z_PK'],  # needed to look up ZSECURITYPRICEITEM.Z_PK
+                'c': item['c'] / zsecurity_par_value,
+                'h': item['h'] / zsecurity_par_value,
+                'l': item['l'] / zsecurity_par_value,
+                'o': item['o'] / zsecurity_par_value,
+                'v': item['v']
+            })
+            continue
+
+        banktivity_transaction_data = resolve_transaction_data(item['data'])
+        banktivity_target_account_name = banktivity_transaction_data['transaction_account_name']
+        banktivity_target_account_pk = banktivity_transaction_data['primaryaccount_zaccount_pk']
+        logging.debug(
+            f"banktivity_transaction_data before add_transaction():\n{pprint.pformat(banktivity_transaction_data)}")
 
+        if 'zpsecurity' not in banktivity_transaction_data:
+            duplicate_found = find_duplicate(banktivity_transaction_data)
             if duplicate_found:
-                duplicate_notice_text = f"Possible duplicate found in Banktivity for broker operation id {op.id} dated {banktivity_transaction_data['zpdate']}, amount {banktivity_transaction_data['zptransactionamount']}, note {banktivity_transaction_data['zpnote']}. Skipping."
-                print(duplicate_notice_text)
-                duplicate_notice_detail = f"""{duplicate_notice_text}Details below:
-Broker operation data:
-{pprint.pformat(op)}
+                pass
+            else:
+                print(
+                    f"Adding broker {item['operation_type']} operation to Banktivity account '{banktivity_target_account_name}' (Z_PK {str(banktivity_target_account_pk)}) as PrimaryAccount transaction {banktivity_transaction_data['transaction_type']}")
+                new_transactions.append(banktivity_transaction_data)
+                new_transaction_items.append(item)
+        else:
+            duplicate_found = find_duplicate(banktivity_transaction_data)
+            if duplicate_found:
+                pass
+            else:
+                print(
+                    f"Adding broker {item['operation_type']} transaction to Banktivity account '{banktivity_target_account_name}' (Z_PK {str(banktivity_target_account_pk)}) as Security transaction {banktivity_transaction_data['transaction_type']}")
+                new_transactions.append(banktivity_transaction_data)
+                new_transaction_items.append(item)
+
+        if duplicate_found:
+            duplicate_notice_text = f"Possible duplicate found in Banktivity for broker operation id {item['operation_id']} dated {banktivity_transaction_data['zpdate']}, amount {banktivity_transaction_data['zptransactionamount']}, note {banktivity_transaction_data['zpnote']}. Skipping."
+            print(duplicate_notice_text)
+            duplicate_notice_detail = f"""{duplicate_notice_text}Details below:
+Plan item:
+{pprint.pformat(item)}
 Banktivity transaction prepared data:
 {pprint.pformat(banktivity_transaction_data)}
 """
-                logging.warn(duplicate_notice_detail)
-# End of import_operations()
+            logging.warning(duplicate_notice_detail)
+
+    write_checkpoint(import_state, new_prices, new_transactions, new_transaction_items, new_watermarks)
+    import_state.clear_cursor(plan_id)
+# End of apply_plan()
 
 if __name__ == "__main__":
     main()
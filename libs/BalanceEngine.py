@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+from datetime import timedelta
+from .DuplicateIndex import local_day_to_zpdate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Cash effect of a PrimaryAccount line item li with its security line item sli (LEFT JOINed). Buy/Sell line items
+# have a zero ZPTRANSACTIONAMOUNT and the trade's cash in ZPAMOUNT. Investment Inc. (dividend) line items have a zero
+# ZPTRANSACTIONAMOUNT too, a NULL ZPAMOUNT and the cash in ZPINCOME; Interest Inc. line items have the cash in both
+# ZPTRANSACTIONAMOUNT and ZPINCOME, so ZPINCOME only counts for line items without an amount of their own.
+SQL_CASH_AMOUNT = """COALESCE(li.ZPTRANSACTIONAMOUNT, 0) + COALESCE(
+            sli.ZPAMOUNT, CASE WHEN COALESCE(li.ZPTRANSACTIONAMOUNT, 0) = 0 THEN sli.ZPINCOME END, 0)"""
+
+
+class BalanceEngine():
+    """Running balances of all PrimaryAccount line items, computed with NumPy.
+
+    Banktivity writes ZLINEITEM.ZPRUNNINGBALANCE itself when it displays an account; the importer leaves it NULL.
+    The engine loads (account, date, intraday sort index, Z_PK, amount) of the line items into arrays, orders them
+    the way an account register does and computes the balances of all accounts at once: a cumulative sum over the
+    sorted amounts minus the sum at the start of each account's run.
+
+    The amount of a line item is its cash effect (see SQL_CASH_AMOUNT): ZPTRANSACTIONAMOUNT, plus the ZPAMOUNT of a
+    Buy/Sell security line item or the ZPINCOME of an Investment Inc. one.
+
+    o load() loads all line items. recompute(since) reloads only line items dated since then and carries the
+      balances of the earlier ones over; on an engine that hasn't loaded them, their totals per account are summed
+      by SQLite (see SQL_OPENING_BALANCES) and only the line items since then are loaded.
+    o balance_at() and balances_at() answer balance-at-date queries with a binary search, for days from the date
+      the engine was loaded since
+    o write_back() stores the balances in ZPRUNNINGBALANCE with one executemany()
+    """
+
+    SQL_LINEITEMS = f"""
+    SELECT
+          li.ZPACCOUNT
+        , t.ZPDATE
+        , COALESCE(li.ZPINTRADAYSORTINDEX, 0)
+        , li.Z_PK
+        , {SQL_CASH_AMOUNT}
+    FROM
+        ZLINEITEM li
+    JOIN
+        ZTRANSACTION t
+    ON (li.ZPTRANSACTION = t.Z_PK)
+    LEFT JOIN
+        ZSECURITYLINEITEM sli
+    ON (sli.ZPLINEITEM = li.Z_PK)
+    WHERE
+            li.Z1_PACCOUNT = ?
+        AND t.ZPDATE >= ?
+    """
+
+    SQL_OPENING_BALANCES = f"""
+    SELECT
+          li.ZPACCOUNT
+        , TOTAL({SQL_CASH_AMOUNT})
+    FROM
+        ZLINEITEM li
+    JOIN
+        ZTRANSACTION t
+    ON (li.ZPTRANSACTION = t.Z_PK)
+    LEFT JOIN
+        ZSECURITYLINEITEM sli
+    ON (sli.ZPLINEITEM = li.Z_PK)
+    WHERE
+            li.Z1_PACCOUNT = ?
+        AND t.ZPDATE < ?
+    GROUP BY
+        li.ZPACCOUNT
+    """
+
+    def __init__(self, banktivity):
+        if np is None:
+            print("ERROR: NumPy is required for running balances (pip3 install numpy). Aborting.")
+            exit(1)
+        self.banktivity = banktivity
+        self.account, self.zpdate, self.sort_index, self.z_pk, self.amount = self.arrays([])
+        self.balance = np.zeros(0)
+        self.account_starts = {}  # ZACCOUNT Z_PK -> (first, last + 1) positions of the account's line items
+        self.since = float('inf')  # ZPDATE the arrays have all line items since, nothing loaded yet
+        self.opening_balances = {}  # ZACCOUNT Z_PK -> total of the line items before self.since
+
+    def load_arrays(self, since):
+        cur = self.banktivity.cur
+        cur.execute(self.SQL_LINEITEMS, (self.banktivity.get_z_ent('PrimaryAccount'), since))
+        return self.arrays(cur.fetchall())
+
+    @staticmethod
+    def arrays(rows):
+        """(account, zpdate, sort_index, z_pk, amount) arrays of line item rows."""
+        columns = list(zip(*rows)) if rows else [(), (), (), (), ()]
+        return (np.array(columns[0], dtype=np.int64), np.array(columns[1], dtype=np.float64),
+                np.array(columns[2], dtype=np.int64), np.array(columns[3], dtype=np.int64),
+                np.array(columns[4], dtype=np.float64))
+
+    def load(self):
+        """Load all line items and compute their balances."""
+        return self.recompute(None)
+
+    def recompute(self, since=None):
+        """Recompute balances of the line items dated since the ZPDATE since (all of them if None), e.g. the date of
+        the earliest transaction an import added. Line items before it keep their balances, or are summed per account
+        by SQLite if the engine hasn't loaded them. Returns the number of line items recomputed."""
+        since = -float('inf') if since is None else since
+        if since < self.since:
+            keep = np.zeros(len(self.z_pk), dtype=bool)
+            self.since = since
+            self.opening_balances = {}
+            if since > -float('inf'):
+                cur = self.banktivity.cur
+                cur.execute(self.SQL_OPENING_BALANCES, (self.banktivity.get_z_ent('PrimaryAccount'), since))
+                self.opening_balances = {zaccount_pk: total for zaccount_pk, total in cur.fetchall()}
+        else:
+            keep = self.zpdate < since
+        new = self.load_arrays(since)
+        account, zpdate, sort_index, z_pk, amount = (
+            np.concatenate((old[keep], fresh)) for old, fresh in
+            zip((self.account, self.zpdate, self.sort_index, self.z_pk, self.amount), new))
+        balance = np.concatenate((self.balance[keep], np.zeros(len(new[0]))))
+
+        # Register order: account, date, intraday sort index, then Z_PK (the order the line items were added in)
+        order = np.lexsort((z_pk, sort_index, zpdate, account))
+        account, zpdate, sort_index, z_pk, amount, balance, kept = (
+            column[order] for column in (account, zpdate, sort_index, z_pk, amount, balance,
+                                         np.arange(len(order)) < keep.sum()))
+
+        starts = np.flatnonzero(np.r_[True, account[1:] != account[:-1]]) if len(account) else np.zeros(0, dtype=np.int64)
+        ends = np.r_[starts[1:], len(account)]
+
+        # Grouped cumulative sum: the running total of the fresh amounts restarted at every account, on top of the
+        # balance of the account's last kept line item (or its opening balance). Kept line items sort before the
+        # fresh ones of their account.
+        fresh_amount = np.where(kept, 0.0, amount)
+        totals = np.cumsum(fresh_amount)
+        group_offset = np.repeat(totals[starts] - fresh_amount[starts], ends - starts)
+        kept_count = np.add.reduceat(kept.astype(np.int64), starts) if len(starts) else np.zeros(0, dtype=np.int64)
+        opening_balances = np.array([self.opening_balances.get(int(zaccount_pk), 0.0)
+                                     for zaccount_pk in account[starts]], dtype=np.float64)
+        opening = np.where(kept_count > 0, balance[np.maximum(starts + kept_count - 1, 0)], opening_balances)
+        balance = np.where(kept, balance, totals - group_offset + np.repeat(opening, ends - starts))
+
+        self.account, self.zpdate, self.sort_index, self.z_pk, self.amount, self.balance = (
+            account, zpdate, sort_index, z_pk, amount, balance)
+        self.account_starts = {int(account[start]): (int(start), int(end)) for start, end in zip(starts, ends)}
+        return len(new[0])
+
+    def balance_at(self, zaccount_pk, day):
+        """Balance of the account at the end of the local day."""
+        opening_balance = float(self.opening_balances.get(zaccount_pk, 0.0))
+        if zaccount_pk not in self.account_starts:
+            return opening_balance
+        start, end = self.account_starts[zaccount_pk]
+        position = start + np.searchsorted(self.zpdate[start:end], local_day_to_zpdate(day + timedelta(days=1)))
+        return float(self.balance[position - 1]) if position > start else opening_balance
+
+    def balances_at(self, day):
+        """Dict of ZACCOUNT Z_PK -> balance at the end of the local day for all accounts."""
+        return {zaccount_pk: self.balance_at(zaccount_pk, day)
+                for zaccount_pk in set(self.account_starts) | set(self.opening_balances)}
+
+    def write_back(self, since=None):
+        """Store the balances of the line items dated since the ZPDATE since (all if None) in ZPRUNNINGBALANCE.
+        Written with the next Banktivity.commit(). Returns the number of line items updated."""
+        selected = self.zpdate >= since if since is not None else np.ones(len(self.z_pk), dtype=bool)
+        self.banktivity.cur.executemany("UPDATE ZLINEITEM SET ZPRUNNINGBALANCE = ? WHERE Z_PK = ?",
+                                        zip(self.balance[selected].tolist(), self.z_pk[selected].tolist()))
+        return int(selected.sum())
+# end class BalanceEngine()
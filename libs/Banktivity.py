@@ -1,27 +1,260 @@
 #!/usr/bin/env python3
-from datetime import datetime
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, time, timezone
 from os.path import expanduser
-import pprint
+import os
 import sqlite3
-import sys
 import uuid
+from .DuplicateIndex import DuplicateIndex, isoformat_to_local_day
+
+
+# Row modes of the connection (see Banktivity.row_factory()):
+# o tuple: plain tuples, the cheapest, columns by position only
+# o row: sqlite3.Row, columns by position or by name
+# o record: tuple subclass with __slots__ generated per query shape, columns by position, name or attribute
+ROW_MODES = ('tuple', 'row', 'record')
+
+
+def isoformat_to_unix_day(value):
+    """Days since the unix epoch (UTC) of an ISO-formatted date/datetime or a date/datetime, as stored in
+    ZSECURITYPRICE.ZPDATE. Same as strftime('%s', value)/(60*60*24) in SQLite: values without a timezone are UTC."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp()) // (60 * 60 * 24)
+
+
+def record_class(fields):
+    """Generate a record class for the column names of a query."""
+    base = namedtuple('Record', fields, rename=True)
+    index = {name: i for i, name in enumerate(fields)}
+
+    def __getitem__(self, key, _getitem=tuple.__getitem__, _index=index):
+        if key.__class__ is str:
+            key = _index[key]
+        return _getitem(self, key)
+
+    def keys(self):
+        return list(fields)
+
+    return type('Record', (base,), {'__slots__': (), '__getitem__': __getitem__, 'keys': keys})
+
+
+def record_factory():
+    """Row factory creating records of a class per query shape (see record_class())."""
+    classes = {}
+    last_description = None
+    last_class = None
+
+    def factory(cursor, row):
+        nonlocal last_description, last_class
+        # cursor.description is the same object for all rows of a statement
+        description = cursor.description
+        if description is not last_description:
+            fields = tuple(col[0] for col in description)
+            if fields not in classes:
+                classes[fields] = record_class(fields)
+            last_description = description
+            last_class = classes[fields]
+        return tuple.__new__(last_class, row)
+
+    return factory
 
 
 class Banktivity():
     con = None
     cur = None
 
-    def __init__(self, banktivity_file):
-        self.con = sqlite3.connect(expanduser(f"{banktivity_file}/StoreContent/core.sql"))
-        self.con.row_factory = self.dict_factory
-        #self.con.set_trace_callback(print)
-        self.cur = self.con.cursor()
+    # Entity name (see catalog in Z_PRIMARYKEY) -> table storing the entity records
+    Z_PK_TABLES = {
+        'Account': 'ZACCOUNT'
+        , 'Transaction': 'ZTRANSACTION'
+        , 'LineItem': 'ZLINEITEM'
+        , 'Security': 'ZSECURITY'
+        , 'SecurityLineItem': 'ZSECURITYLINEITEM'
+        , 'SecurityLot': 'ZSECURITYLOT'
+        , 'SecurityPrice': 'ZSECURITYPRICE'
+        , 'SecurityPriceItem': 'ZSECURITYPRICEITEM'
+    }
+
+    BUSY_TIMEOUT = 30000  # milliseconds
+
+    # Per-connection PRAGMAs for import_session(). Not persistent, restored when the session ends.
+    IMPORT_SESSION_PRAGMAS = {
+        'cache_size': -256 * 1024,  # negative is KiB: 256 MiB of page cache instead of the default 2 MiB
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 2,  # MEMORY
+        'synchronous': 1,  # NORMAL. OFF when working on a copy: a crash can only damage the copy
+    }
+
+    # ZSECURITY columns kept for every security in memory, see get_zsecurity_by_symbol()
+    ZSECURITY_COLUMNS = ('Z_PK', 'ZPNAME', 'ZPPARVALUE', 'ZPSYMBOL', 'ZPUNIQUEID', 'ZPCURRENCY', 'ZPTYPE')
+
+    SQL_ZTRANSACTION = """
+        INSERT INTO
+            ZTRANSACTION
+        VALUES (
+              :Z_PK
+            , :Z_ENT
+            , :Z_OPT
+            , :ZPADJUSTMENT
+            , :ZPCHECKNUMBER
+            , :ZPCLEARED
+            , :ZPVOID
+            , :ZPCURRENCY
+            , :ZPFILEATTACHMENT
+            , :ZPTRANSACTIONTYPE
+            , strftime('%s', :ZPCREATIONTIME)-978307200
+            , strftime('%s', :ZPDATE)-978307200
+            , strftime('%s', :ZPMODIFICATIONDATE)-978307200
+            , :ZPNOTE
+            , :ZPTITLE
+            , :ZPUNIQUEID
+        )
+        """
+
+    SQL_ZLINEITEM = """
+        INSERT INTO
+            ZLINEITEM
+        VALUES (
+              :Z_PK
+            , :Z_ENT
+            , :Z_OPT
+            , :ZPCLEARED
+            , :ZPINTRADAYSORTINDEX
+            , :ZPACCOUNT
+            , :Z1_PACCOUNT
+            , :ZPSECURITYLINEITEM
+            , :ZPSTATEMENT
+            , :ZPTRANSACTION
+            , strftime('%s', :ZPCREATIONTIME)-978307200
+            , :ZPEXCHANGERATE
+            , :ZPRUNNINGBALANCE
+            , :ZPTRANSACTIONAMOUNT
+            , :ZPMEMO
+            , :ZPUNIQUEID
+        )
+        """
+
+    SQL_ZSECURITYLINEITEM = """
+        INSERT INTO
+            ZSECURITYLINEITEM
+        VALUES (
+              :Z_PK
+            , :Z_ENT
+            , :Z_OPT
+            , :ZPCOSTBASISMETHOD
+            , :ZPDISTRIBUTIONTYPE
+            , :ZPLINEITEM
+            , :ZPSECURITY
+            , :ZPAMOUNT
+            , :ZPCOMMISSION
+            , :ZPINCOME
+            , :ZPPRICEMULTIPLIER
+            , :ZPPRICEPERSHARE
+            , :ZPSHARES
+            , :ZPINCOMECATEGORYLINEITEMID
+        )
+        """
+
+    def __init__(self, banktivity_file, row_mode='row', profiler=None):
+        self.core_sql_path = expanduser(f"{banktivity_file}/StoreContent/core.sql")
+        self.row_mode = row_mode
+        self.profiler = profiler  # SQLProfiler or None
+        self.duplicate_index = None
+        self.attachments = {}  # schema name -> path of an attached database, see attach()
+        self.attachment_suffix = ''  # '.import' while the attached databases are copies, see open_scratch_copy()
+        self.deferred = []  # (sql, rows) for attached databases, written by commit() after the document, see defer()
+        self.connect(self.core_sql_path)
+        self.load_lookup_cache()
+        self.duplicate_index = DuplicateIndex(self.cur)
+        self.z_max = {}  # entity name -> highest Z_PK assigned, see reserve_z_pks()
+        self.z_max_dirty = set()  # entities with Z_MAX to be stored by commit()
+        self.session_committed = False  # see import_session()
+
+    def connect(self, path):
+        self.con = sqlite3.connect(path)
+        self.con.row_factory = self.row_factory(self.row_mode)
+        # Wait for other writers (e.g. Banktivity syncing the document) instead of failing with "database is locked"
+        self.con.execute(f"PRAGMA busy_timeout = {self.BUSY_TIMEOUT}")
+        self.cur = self.profiler.cursor(self.con) if self.profiler else self.con.cursor()
+        if self.duplicate_index is not None:
+            self.duplicate_index.cur = self.cur
+        for schema, attachment_path in self.attachments.items():
+            self.con.execute(f"ATTACH DATABASE ? AS {schema}", (attachment_path + self.attachment_suffix,))
+
+    def attach(self, path, schema):
+        """Attach a sidecar SQLite database to the document's connection as schema. Call it before
+        import_session(): with work_on_copy, attached databases are copied and swapped back after the document.
+
+        SQLite doesn't order the commits of attached databases in WAL mode (and the scratch copy has no durable
+        journal at all), so sidecar state that describes the document should be written with defer(): it is
+        committed in a transaction of its own after the document's, and after a crash the sidecar can be behind the
+        document but not ahead of it.
+        """
+        self.attachments[schema] = path
+        self.con.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
 
-    def dict_factory(self, cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+    def defer(self, sql, rows):
+        """Queue an executemany() of sql with rows on an attached database until the next commit() of the
+        document. Dropped if the transaction (or the enclosing savepoint()) is rolled back."""
+        self.deferred.append((sql, rows))
+
+    def load_lookup_cache(self):
+        """Load the small catalog tables into memory once.
+
+        Importing a single operation used to resolve account names, currency codes, entity names and transaction
+        types with a query (or a correlated subquery) each. These tables are tiny and change only when this class
+        inserts into them, so they are read here once and kept current by add_zaccount() and add_zsecurity().
+        """
+        cur = self.cur
+
+        # ZPFULLNAME is not unique across ZACCOUNT. Keep the first (lowest Z_PK) row like fetchone() used to.
+        self.zaccount_pks = {}
+        cur.execute("SELECT Z_PK, ZPFULLNAME FROM ZACCOUNT ORDER BY Z_PK")
+        for z_pk, zpfullname in cur.fetchall():
+            self.zaccount_pks.setdefault(zpfullname, z_pk)
+
+        self.zcurrency_pks = {}
+        cur.execute("SELECT Z_PK, ZPCODE FROM ZCURRENCY ORDER BY Z_PK")
+        for z_pk, zpcode in cur.fetchall():
+            self.zcurrency_pks.setdefault(zpcode, z_pk)
+
+        cur.execute("SELECT Z_ENT, Z_NAME FROM Z_PRIMARYKEY")
+        self.z_ents = {z_name: z_ent for z_ent, z_name in cur.fetchall()}
+
+        self.ztransactiontype_pks = {}
+        cur.execute("SELECT Z_PK, ZPNAME FROM ZTRANSACTIONTYPE ORDER BY Z_PK")
+        for z_pk, zpname in cur.fetchall():
+            self.ztransactiontype_pks.setdefault(zpname, z_pk)
+
+        self.zsecurities = {}
+        cur.execute(f"SELECT {', '.join(self.ZSECURITY_COLUMNS)} FROM ZSECURITY ORDER BY Z_PK")
+        for row in cur.fetchall():
+            zsecurity = dict(zip(self.ZSECURITY_COLUMNS, row))
+            self.zsecurities.setdefault(zsecurity['ZPSYMBOL'], zsecurity)
+
+        # ZSECURITY.Z_PK -> ZSECURITYPRICEITEM.Z_PK
+        self.zsecuritypriceitem_pks = {}
+        cur.execute(
+            "SELECT s.Z_PK, spi.Z_PK FROM ZSECURITYPRICEITEM spi JOIN ZSECURITY s ON (spi.ZPSECURITYID = s.ZPUNIQUEID) ORDER BY spi.Z_PK")
+        for zsecurity_pk, zsecuritypriceitem_pk in cur.fetchall():
+            self.zsecuritypriceitem_pks.setdefault(zsecurity_pk, zsecuritypriceitem_pk)
+
+    def row_factory(self, row_mode):
+        """Row factory for the row mode (see ROW_MODES): None for plain tuples, sqlite3.Row or a record factory."""
+        if row_mode == 'tuple':
+            return None
+        elif row_mode == 'row':
+            return sqlite3.Row
+        elif row_mode == 'record':
+            return record_factory()
+        else:
+            raise ValueError(f"Unknown row mode {row_mode}, expected one of {', '.join(ROW_MODES)}")
 
     def update_z_max(self, table_name, record_name):
         cur = self.cur
@@ -30,51 +263,224 @@ class Banktivity():
         return cur.rowcount == 1
 
     def commit(self):
-        updated_tables = {
-            'ZACCOUNT': 'Account'
-            , 'ZTRANSACTION': 'Transaction'
-            , 'ZLINEITEM': 'LineItem'
-            , 'ZSECURITY': 'Security'
-            , 'ZSECURITYLINEITEM': 'SecurityLineItem'
-            , 'ZSECURITYLOT': 'SecurityLot'
-            , 'ZSECURITYPRICE': 'SecurityPrice'
-            , 'ZSECURITYPRICEITEM': 'SecurityPriceItem'
-        }
-        for table_name, record_name in updated_tables.items():
-            self.update_z_max(table_name, record_name)
+        """Store the highest Z_PK assigned during this session in Z_MAX of the touched entities and commit.
 
-        return self.con.commit()
+        All inserts get their Z_PK from reserve_z_pks(), so Z_MAX is known without scanning the tables and only
+        entities that got new records are updated. update_z_max() is still there to recompute Z_MAX from a table.
 
-    def get_zcurrency_pk(self, zpcode):
+        The statements queued with defer() are run and committed in a second transaction once the document is
+        committed.
+        """
         cur = self.cur
-        cur.execute("SELECT Z_PK FROM ZCURRENCY WHERE ZPCODE = ?", (zpcode,))
-        res = cur.fetchone()
-        if res is None:
-            return None
+        for record_name in sorted(self.z_max_dirty):
+            cur.execute("UPDATE Z_PRIMARYKEY SET Z_MAX = ? WHERE Z_NAME = ? AND Z_MAX < ?",
+                        (self.z_max[record_name], record_name, self.z_max[record_name]))
+        self.z_max_dirty.clear()
+        self.session_committed = True
+        self.con.commit()
+
+        if self.deferred:
+            deferred, self.deferred = self.deferred, []
+            for sql, rows in deferred:
+                cur.executemany(sql, rows)
+            self.con.commit()
+
+    @contextmanager
+    def savepoint(self, name):
+        """Run the block in a SAVEPOINT: its changes are rolled back if it fails, the changes made before it in the
+        transaction are kept for the next commit().
+
+        Only the database is rolled back. Z_PKs reserved in the block stay reserved (leaving a gap) and the lookup
+        caches keep what the block added, so the import is expected to stop after a failed block.
+        """
+        if not self.con.in_transaction:
+            # Without an enclosing transaction RELEASE would commit the savepoint
+            self.cur.execute("BEGIN")
+        self.cur.execute(f"SAVEPOINT {name}")
+        deferred_count = len(self.deferred)
+        try:
+            yield self
+        except BaseException:
+            del self.deferred[deferred_count:]
+            self.cur.execute(f"ROLLBACK TO {name}")
+            self.cur.execute(f"RELEASE {name}")
+            raise
+        self.cur.execute(f"RELEASE {name}")
+
+    def get_pragmas(self, names):
+        return {name: self.con.execute(f"PRAGMA {name}").fetchone()[0] for name in names}
+
+    def set_pragmas(self, pragmas):
+        for name, value in pragmas.items():
+            self.con.execute(f"PRAGMA {name} = {value}")
+
+    @contextmanager
+    def import_session(self, work_on_copy=False):
+        """Run an import with PRAGMAs tuned for bulk writes (IMPORT_SESSION_PRAGMAS).
+
+        Changes committed inside the session are kept, anything else is rolled back when the session ends or fails.
+
+        With work_on_copy, StoreContent/core.sql is copied to a scratch file with the sqlite backup API and the
+        import runs on the copy with synchronous = OFF. At the end the copy replaces core.sql with os.replace(), so
+        the document is either left as it was or has all the committed changes. If the import fails after a
+        commit(), the copy replaces the document too, so checkpoints committed by an interrupted import are not lost.
+        Other writers are kept out of the document for the whole session.
+
+            with banktivity.import_session(work_on_copy=True):
+                ...
+                banktivity.commit()
+        """
+        if work_on_copy:
+            self.open_scratch_copy()
+            pragmas = dict(self.IMPORT_SESSION_PRAGMAS, synchronous=0)
+        else:
+            pragmas = self.IMPORT_SESSION_PRAGMAS
+        saved_pragmas = self.get_pragmas(pragmas)
+        self.set_pragmas(pragmas)
+        self.session_committed = False
+
+        try:
+            yield self
+        except BaseException:
+            self.con.rollback()
+            self.deferred.clear()
+            if work_on_copy:
+                if self.session_committed:
+                    self.swap_scratch_copy()
+                else:
+                    self.discard_scratch_copy()
+            else:
+                self.set_pragmas(saved_pragmas)
+            raise
+
+        if self.con.in_transaction:
+            self.con.rollback()
+        self.deferred.clear()
+        if work_on_copy:
+            if self.session_committed:
+                self.swap_scratch_copy()
+            else:
+                self.discard_scratch_copy()
+        else:
+            self.set_pragmas(saved_pragmas)
 
-        return res['Z_PK']
+    def open_scratch_copy(self):
+        if self.con.in_transaction:
+            print("ERROR: Can't copy the document with uncommitted changes. Commit or roll back first. Aborting.")
+            exit(1)
 
-    def get_zaccount_pk(self, zaccount_name):
-        cur = self.cur
-        cur.execute("SELECT Z_PK FROM ZACCOUNT WHERE ZPFULLNAME = ?", (zaccount_name,))
-        res = cur.fetchone()
+        self.scratch_path = f"{self.core_sql_path}.import"
+        if os.path.exists(self.scratch_path):
+            os.remove(self.scratch_path)
+
+        # Hold the write lock on the document until the copy is swapped back, so nothing written to the document
+        # meanwhile gets lost. This is a separate connection: the backup can't read through a writing connection.
+        self.lock_con = sqlite3.connect(self.core_sql_path, isolation_level=None)
+        self.lock_con.execute(f"PRAGMA busy_timeout = {self.BUSY_TIMEOUT}")
+        self.lock_con.execute("BEGIN IMMEDIATE")
+
+        self.journal_mode = self.con.execute("PRAGMA journal_mode").fetchone()[0]
+        scratch_con = sqlite3.connect(self.scratch_path)
+        self.con.backup(scratch_con)
+        scratch_con.close()
+        self.con.close()
+
+        # Attached databases are imported into copies too and replace the originals after the document
+        for attachment_path in self.attachments.values():
+            if os.path.exists(attachment_path + '.import'):
+                os.remove(attachment_path + '.import')
+            if os.path.exists(attachment_path):
+                attachment_con = sqlite3.connect(attachment_path)
+                attachment_copy_con = sqlite3.connect(attachment_path + '.import')
+                attachment_con.backup(attachment_copy_con)
+                attachment_copy_con.close()
+                attachment_con.close()
+        self.attachment_suffix = '.import'
+
+        self.connect(self.scratch_path)
+        # Rollbacks (and savepoints) still need a journal, but it doesn't have to survive a crash
+        self.con.execute("PRAGMA journal_mode = MEMORY")
+
+    def discard_scratch_copy(self):
+        self.con.close()
+        os.remove(self.scratch_path)
+        for attachment_path in self.attachments.values():
+            if os.path.exists(attachment_path + '.import'):
+                os.remove(attachment_path + '.import')
+        self.attachment_suffix = ''
+        self.lock_con.rollback()
+        self.lock_con.close()
+        self.connect(self.core_sql_path)
+
+    def swap_scratch_copy(self):
+        # The copy goes back with the journal mode of the document (usually WAL for Core Data)
+        self.con.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        self.con.close()
+        with open(self.scratch_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        self.lock_con.rollback()
+        if self.journal_mode.lower() == 'wal':
+            self.lock_con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.lock_con.close()
+
+        # A WAL file left behind by another connection would be replayed over the new content
+        wal_path = f"{self.core_sql_path}-wal"
+        if os.path.exists(wal_path) and os.path.getsize(wal_path) > 0:
+            print(f"ERROR: {wal_path} is in use, is the document open in Banktivity? The imported copy is kept at {self.scratch_path}. Aborting.")
+            exit(1)
 
-        if res is None:
-            return None
+        os.replace(self.scratch_path, self.core_sql_path)
+        for path in (wal_path, f"{self.core_sql_path}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        dir_fd = os.open(os.path.dirname(self.core_sql_path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
-        return res['Z_PK']
+        for attachment_path in self.attachments.values():
+            os.replace(attachment_path + '.import', attachment_path)
+        self.attachment_suffix = ''
 
-    def get_zsecuritypriceitem_pk_by_zsecurity(self, zsecurity_pk: int) -> int:
-        cur = self.cur
-        cur.execute(
-            "SELECT spi.Z_PK FROM ZSECURITYPRICEITEM spi JOIN ZSECURITY s ON (spi.ZPSECURITYID = s.ZPUNIQUEID) WHERE s.Z_PK = ?",
-            (zsecurity_pk,))
-        res = cur.fetchone()
+        self.connect(self.core_sql_path)
 
-        if res is None:
-            return None
+    def reserve_z_pks(self, record_name, count):
+        """Reserve count consecutive Z_PKs for records of the entity and return the first one.
+
+        The highest Z_PK handed out is kept in memory, so only the first reservation per entity reads the table.
+        Rows inserted with reserved Z_PKs can be cross-linked before they are written.
+        """
+        if record_name not in self.z_max:
+            cur = self.cur
+            cur.execute(f"SELECT MAX(Z_PK) FROM {self.Z_PK_TABLES[record_name]}")
+            table_max = cur.fetchone()[0] or 0
+            cur.execute("SELECT Z_MAX FROM Z_PRIMARYKEY WHERE Z_NAME = ?", (record_name,))
+            res = cur.fetchone()
+            self.z_max[record_name] = max(table_max, res[0] or 0 if res is not None else 0)
+
+        first_z_pk = self.z_max[record_name] + 1
+        if count > 0:
+            self.z_max[record_name] += count
+            self.z_max_dirty.add(record_name)
+        return first_z_pk
+
+    def get_zcurrency_pk(self, zpcode):
+        return self.zcurrency_pks.get(zpcode)
+
+    def get_zaccount_pk(self, zaccount_name):
+        return self.zaccount_pks.get(zaccount_name)
 
-        return res['Z_PK']
+    def get_z_ent(self, z_name):
+        """Resolve entity name (see catalog in Z_PRIMARYKEY) into Z_ENT. None resolves into None (NULL)."""
+        return self.z_ents.get(z_name)
+
+    def get_ztransactiontype_pk(self, zpname):
+        return self.ztransactiontype_pks.get(zpname)
+
+    def get_zsecuritypriceitem_pk_by_zsecurity(self, zsecurity_pk: int) -> int:
+        return self.zsecuritypriceitem_pks.get(zsecurity_pk)
 
     def get_zsecurity_zptype_by_name(self, name):
         security_types = {
@@ -127,8 +533,9 @@ class Banktivity():
         if z_ent == 3:
             zcurrency = self.get_zcurrency_pk(account_data['currency_code'])
 
+        zaccount_pk = self.reserve_z_pks('Account', 1)
         self.cur.execute(SQL_ZACCOUNT_ADD, {
-            "Z_PK": None,
+            "Z_PK": zaccount_pk,
             "Z_ENT": z_ent,  # entry type (see catalog in Z_PRIMARYKEY)
             "Z_OPT": 1,  # (looks like how many times the entry was edited?)
             "ZPACCOUNTCLASS": account_data['zpaccountclass'],
@@ -157,7 +564,7 @@ class Banktivity():
             "ZPBANKROUTINGNUMBER": None,
             "ZPCOLORDATA": None})
 
-        zaccount_pk = self.cur.lastrowid
+        self.zaccount_pks.setdefault(account_data['zpfullname'], zaccount_pk)
         return zaccount_pk
 
     def add_account(self, account_data):
@@ -183,91 +590,30 @@ class Banktivity():
 
         return self.add_zaccount(2, category_data)  # 2 for Category
 
-    def add_ztransaction(self, transaction_data):
-        cur = self.cur
-
-        SQL_ZTRANSACTION = """
-        INSERT INTO
-            ZTRANSACTION
-        VALUES (
-              :Z_PK
-            , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z_ENT)
-            , :Z_OPT
-            , :ZPADJUSTMENT
-            , :ZPCHECKNUMBER
-            , :ZPCLEARED
-            , :ZPVOID
-            , :ZPCURRENCY
-            , :ZPFILEATTACHMENT
-            , (SELECT Z_PK FROM ZTRANSACTIONTYPE WHERE ZPNAME = :ZPTRANSACTIONTYPE_ZPNAME)
-            , strftime('%s', :ZPCREATIONTIME)-978307200
-            , strftime('%s', :ZPDATE)-978307200
-            , strftime('%s', :ZPMODIFICATIONDATE)-978307200
-            , :ZPNOTE
-            , :ZPTITLE
-            , :ZPUNIQUEID
-        )
-        """
-
-        zpcurrency = self.get_zcurrency_pk(transaction_data['transaction_currency_code'])
-
-        cur.execute(SQL_ZTRANSACTION, {
-            "Z_PK": None,
-            "Z_ENT": 'Transaction',  # entry type (see catalog in Z_PRIMARYKEY)
+    def ztransaction_values(self, transaction_data, ztransaction_pk):
+        return {
+            "Z_PK": ztransaction_pk,
+            "Z_ENT": self.get_z_ent('Transaction'),  # entry type (see catalog in Z_PRIMARYKEY)
             "Z_OPT": 1,  # (looks like how many times the entry was edited?)
             "ZPADJUSTMENT": transaction_data['zpadjustment'],  # 1 for Balance Adjustment entries, otherwise NULL
             "ZPCHECKNUMBER": transaction_data['zpchecknumber'],
             "ZPCLEARED": 0,
             "ZPVOID": 0,  # seems to be always zero
-            "ZPCURRENCY": zpcurrency,
+            "ZPCURRENCY": self.get_zcurrency_pk(transaction_data['transaction_currency_code']),
             "ZPFILEATTACHMENT": None,
-            "ZPTRANSACTIONTYPE_ZPNAME": transaction_data['transaction_type'],
+            "ZPTRANSACTIONTYPE": self.get_ztransactiontype_pk(transaction_data['transaction_type']),
             "ZPCREATIONTIME": transaction_data['zpcreationtime'] if 'zpcreationtime' in transaction_data else 'now',
             "ZPDATE": transaction_data['zpdate'],
             "ZPMODIFICATIONDATE": transaction_data['zpmodificationdate'] if 'zpmodificationdate' in transaction_data else 'now',
             "ZPNOTE": transaction_data['zpnote'],
             "ZPTITLE": transaction_data['zptitle'],
-            "ZPUNIQUEID": transaction_data['zpuniqueid'] if 'zpuniqueid' in transaction_data else str(
-                uuid.uuid5(uuid.NAMESPACE_DNS,
-                           "ztransaction_" + transaction_data['zpdate'] + transaction_data['zpnote']))})
-
-        ztransaction_pk = self.cur.lastrowid
-        return ztransaction_pk
-
-    def add_transaction(self, transaction_data):
-        cur = self.cur
-
-        ztransaction_pk = self.add_ztransaction(transaction_data)
-
-        SQL_ZLINEITEM = """
-        INSERT INTO
-            ZLINEITEM
-        VALUES (
-              :Z_PK
-            , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z_ENT)
-            , :Z_OPT
-            , :ZPCLEARED
-            , :ZPINTRADAYSORTINDEX
-            , :ZPACCOUNT
-            , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z1_PACCOUNT)
-            , :ZPSECURITYLINEITEM
-            , :ZPSTATEMENT
-            , :ZPTRANSACTION
-            , strftime('%s', :ZPCREATIONTIME)-978307200
-            , :ZPEXCHANGERATE
-            , :ZPRUNNINGBALANCE
-            , :ZPTRANSACTIONAMOUNT
-            , :ZPMEMO
-            , :ZPUNIQUEID
-        )
-        """
-
-        cur.execute("SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = ?", ('LineItemSource',))
-        z_primarykey_lineitemsource = cur.fetchone()['Z_ENT']
+            "ZPUNIQUEID": transaction_data['zpuniqueid'] if 'zpuniqueid' in transaction_data else str(uuid.uuid5(
+                uuid.NAMESPACE_DNS, "ztransaction_" + transaction_data['zpdate'] + transaction_data['zpnote']))}
 
+    def zlineitem_values(self, transaction_data, ztransaction_pk, zlineitem_pk):
+        """Values for the pair of ZLINEITEM rows of a transaction: the PrimaryAccount one and either the destination
+        account one (for Transfers) or the category one. Z_PKs are zlineitem_pk and zlineitem_pk + 1."""
         z_lineitem_zpaccount = self.get_zaccount_pk(transaction_data['transaction_account_name'])
-        if 'transaction_dest_account_name' in transaction_data:
-            z_lineitem_zpaccount_dest = self.get_zaccount_pk(transaction_data['transaction_dest_account_name'])
 
         # ZPACCOUNT for category ZLINEITEM should be NULL for security Buy/Sell transactions
         if transaction_data['transaction_category_name'] is None:
@@ -275,16 +621,17 @@ class Banktivity():
         else:
             z_lineitem_cat_zpaccount = self.get_zaccount_pk(transaction_data['transaction_category_name'])
 
-        SQL_ZLINEITEM1_VALUES = {
-            "Z_PK": None,
-            "Z_ENT": 'LineItem',  # resolved into integer in the query
+        # [1/2] LineItem in source account
+        primaryaccount_values = {
+            "Z_PK": zlineitem_pk,
+            "Z_ENT": self.get_z_ent('LineItem'),
             "Z_OPT": 1,  # (looks like how many times the entry was edited?)
             "ZPCLEARED": 1,  # for 1 entry it's 1, for memo entry it's NULL
             "ZPINTRADAYSORTINDEX": transaction_data[
                 'zpintradaysortindex'] if 'zpintradaysortindex' in transaction_data else 0,
             # default is 0 (the earliest), set by GUI
             "ZPACCOUNT": z_lineitem_zpaccount,
-            "Z1_PACCOUNT": 'PrimaryAccount',  # resolved into integer in the query
+            "Z1_PACCOUNT": self.get_z_ent('PrimaryAccount'),
             "ZPSECURITYLINEITEM": None,
             # references ZSECURITYLINEITEM.Z_PK for transactions in investment accounts. NULL for regular transactions.
             "ZPSTATEMENT": None,
@@ -297,21 +644,18 @@ class Banktivity():
             "ZPUNIQUEID": str(uuid.uuid4())
         }
 
-        # [1/2] add LineItem in source account
-        cur.execute(SQL_ZLINEITEM, SQL_ZLINEITEM1_VALUES)
-
         if transaction_data['transaction_type'] == 'Transfer':
-            # [2/2B] add LineItem in destination account
-            cur.execute(SQL_ZLINEITEM, {
-                "Z_PK": None,
-                "Z_ENT": 'LineItem',
+            # [2/2B] LineItem in destination account
+            second_values = {
+                "Z_PK": zlineitem_pk + 1,
+                "Z_ENT": self.get_z_ent('LineItem'),
                 "Z_OPT": 1,  # (looks like how many times the entry was edited?)
                 "ZPCLEARED": 1,  # for 1 entry it's 1, for memo entry it's NULL
                 "ZPINTRADAYSORTINDEX": transaction_data[
                     'zpintradaysortindex_dest'] if 'zpintradaysortindex_dest' in transaction_data else 0,
                 # default is 0 (the earliest), set by GUI
-                "ZPACCOUNT": z_lineitem_zpaccount_dest,
-                "Z1_PACCOUNT": 'PrimaryAccount',  # resolved into integer in the query
+                "ZPACCOUNT": self.get_zaccount_pk(transaction_data['transaction_dest_account_name']),
+                "Z1_PACCOUNT": self.get_z_ent('PrimaryAccount'),
                 "ZPSECURITYLINEITEM": None,
                 # references ZSECURITYLINEITEM.Z_PK for transactions in investment accounts. NULL for regular transactions.
                 "ZPSTATEMENT": None,
@@ -321,17 +665,17 @@ class Banktivity():
                 "ZPRUNNINGBALANCE": None,  # looks like this is auto-generated by the GUI
                 "ZPTRANSACTIONAMOUNT": transaction_data['zptransactionamount_dest'],
                 "ZPMEMO": None,
-                "ZPUNIQUEID": str(uuid.uuid4())})
+                "ZPUNIQUEID": str(uuid.uuid4())}
         else:
-            # [2/2C] add the category expense for
-            cur.execute(SQL_ZLINEITEM, {
-                "Z_PK": None,
-                "Z_ENT": 'LineItem',
+            # [2/2C] the category expense
+            second_values = {
+                "Z_PK": zlineitem_pk + 1,
+                "Z_ENT": self.get_z_ent('LineItem'),
                 "Z_OPT": 1,  # (looks like how many times the entry was edited?)
                 "ZPCLEARED": None,  # for 1 entry it's 1, for memo entry it's NULL
                 "ZPINTRADAYSORTINDEX": 0,  # always 0 unless (I guess) modified by GUI
                 "ZPACCOUNT": z_lineitem_cat_zpaccount,
-                "Z1_PACCOUNT": 'Category' if z_lineitem_cat_zpaccount else None,  # resolved into integer in the query
+                "Z1_PACCOUNT": self.get_z_ent('Category') if z_lineitem_cat_zpaccount else None,
                 "ZPSECURITYLINEITEM": None,
                 # references ZSECURITYLINEITEM.Z_PK for transactions in investment accounts. NULL for regular transactions.
                 "ZPSTATEMENT": None,
@@ -342,13 +686,72 @@ class Banktivity():
                 "ZPTRANSACTIONAMOUNT": -1 * transaction_data['zptransactionamount'],
                 # category LineItem's amount is always the opposite of the transaction LineItem's amount
                 "ZPMEMO": None,
-                "ZPUNIQUEID": str(uuid.uuid4())})
-        # [-] for
+                "ZPUNIQUEID": str(uuid.uuid4())}
 
+        return primaryaccount_values, second_values
+
+    def add_ztransaction(self, transaction_data):
+        ztransaction_pk = self.reserve_z_pks('Transaction', 1)
+        self.cur.execute(self.SQL_ZTRANSACTION, self.ztransaction_values(transaction_data, ztransaction_pk))
         return ztransaction_pk
 
+    def add_transaction(self, transaction_data):
+        return self.write_transactions([(transaction_data, False)])[0]
+
     # end add_transaction()
 
+    def add_transactions_bulk(self, transactions):
+        """Add many transactions at once. Returns the list of ZTRANSACTION.Z_PKs in the order of transactions.
+
+        Takes the same transaction_data dicts as add_transaction() and add_security_transaction(). Dicts with
+        'zpsecurity' are added as security transactions. All of them write through write_transactions(), so the
+        rows cost the same; a batch only saves the per-statement overhead of executing one INSERT per row.
+        """
+        return self.write_transactions(
+            [(transaction_data, 'zpsecurity' in transaction_data) for transaction_data in transactions])
+
+    def write_transactions(self, transactions):
+        """Write (transaction_data, is_security_transaction) pairs with one executemany() per table.
+
+        Z_PKs for all rows are reserved up front, so ZTRANSACTION, ZLINEITEM and ZSECURITYLINEITEM rows are linked to
+        each other in memory and nothing has to be read back or updated after the INSERTs.
+        """
+        if not transactions:
+            return []
+
+        ztransaction_pk = self.reserve_z_pks('Transaction', len(transactions))
+        zlineitem_pk = self.reserve_z_pks('LineItem', 2 * len(transactions))
+        security_transaction_count = sum(1 for _, is_security_transaction in transactions if is_security_transaction)
+        zsecuritylineitem_pk = self.reserve_z_pks('SecurityLineItem', security_transaction_count)
+
+        ztransaction_rows = []
+        zlineitem_rows = []
+        zsecuritylineitem_rows = []
+        for transaction_data, is_security_transaction in transactions:
+            ztransaction_rows.append(self.ztransaction_values(transaction_data, ztransaction_pk))
+            primaryaccount_values, second_values = self.zlineitem_values(
+                transaction_data, ztransaction_pk, zlineitem_pk)
+
+            if is_security_transaction:
+                zsecuritylineitem_rows.append(self.zsecuritylineitem_values(
+                    transaction_data, zsecuritylineitem_pk, primaryaccount_values, second_values))
+                # PrimaryAccount ZLINEITEM.ZPSECURITYLINEITEM references the ZSECURITYLINEITEM
+                primaryaccount_values['ZPSECURITYLINEITEM'] = zsecuritylineitem_pk
+                zsecuritylineitem_pk += 1
+
+            zlineitem_rows.append(primaryaccount_values)
+            zlineitem_rows.append(second_values)
+            ztransaction_pk += 1
+            zlineitem_pk += 2
+
+        cur = self.cur
+        cur.executemany(self.SQL_ZTRANSACTION, ztransaction_rows)
+        cur.executemany(self.SQL_ZLINEITEM, zlineitem_rows)
+        if zsecuritylineitem_rows:
+            cur.executemany(self.SQL_ZSECURITYLINEITEM, zsecuritylineitem_rows)
+
+        return [row['Z_PK'] for row in ztransaction_rows]
+
     def add_zsecurity(self, security_data):
         cur = self.cur
 
@@ -357,7 +760,7 @@ class Banktivity():
             ZSECURITY
         VALUES (
               :Z_PK
-            , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z_ENT)
+            , :Z_ENT
             , :Z_OPT
             , :ZPEXCLUDEFROMQUOTEUPDATES
             , :ZPISINDEX
@@ -377,9 +780,10 @@ class Banktivity():
         )
         """
 
-        cur.execute(SQL_ZSECURITY, {
-            "Z_PK": None,
-            "Z_ENT": 'Security',  # entry type (see catalog in Z_PRIMARYKEY)
+        ztransaction_pk = self.reserve_z_pks('Security', 1)
+        zsecurity_values = {
+            "Z_PK": ztransaction_pk,
+            "Z_ENT": self.get_z_ent('Security'),  # entry type (see catalog in Z_PRIMARYKEY)
             "Z_OPT": 1,  # (looks like how many times the entry was edited?)
             "ZPEXCLUDEFROMQUOTEUPDATES": None,
             "ZPISINDEX": 0,  # don't know what this for, seems to always be 0
@@ -401,10 +805,12 @@ class Banktivity():
             "ZPSYMBOL": security_data['zpsymbol'],
             "ZPUNIQUEID": str(
                 uuid.uuid5(uuid.NAMESPACE_DNS, "ztransaction_" + security_data['zpdate'] + security_data['zpsymbol']))
-        })
-        ztransaction_pk = self.cur.lastrowid
+        }
+        cur.execute(SQL_ZSECURITY, zsecurity_values)
 
-        zsecurity = self.get_zsecurity_by_symbol(security_data['zpsymbol'])
+        # The Z_PK is reserved and ZSECURITY_COLUMNS are all inserted as given, no need to read the row back
+        zsecurity = {column: zsecurity_values[column] for column in self.ZSECURITY_COLUMNS}
+        self.zsecurities.setdefault(zsecurity['ZPSYMBOL'], zsecurity)
 
         # Add ZSECURITYPRICEITEM. Gets created for every security in Banktivity the moment the price for it
         # learned the first time. Did not research how this is used, but probably by the quote fetch mechanism
@@ -414,7 +820,7 @@ class Banktivity():
             ZSECURITYPRICEITEM
         VALUES (
               :Z_PK
-            , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z_ENT)
+            , :Z_ENT
             , :Z_OPT=1
             , :ZPKNOWNDATERANGEBEGIN
             , :ZPKNOWNDATERANGEEND
@@ -423,116 +829,176 @@ class Banktivity():
         )
         """
 
+        zsecuritypriceitem_pk = self.reserve_z_pks('SecurityPriceItem', 1)
         cur.execute(SQL_ZSECURITYPRICEITEM, {
-            "Z_PK": None,
-            "Z_ENT": 'SecurityPriceItem',
+            "Z_PK": zsecuritypriceitem_pk,
+            "Z_ENT": self.get_z_ent('SecurityPriceItem'),
             "Z_OPT": 1,
             "ZPKNOWNDATERANGEBEGIN": None,
             "ZPKNOWNDATERANGEEND": None,
             "ZPLATESTIMPORTDATE": None,
             "ZPSECURITYID": zsecurity['ZPUNIQUEID']  # reference to ZSECURITY.ZPUNIQUEID
         })
+        self.zsecuritypriceitem_pks.setdefault(ztransaction_pk, zsecuritypriceitem_pk)
 
         return ztransaction_pk
     # end add_zsecurity()
 
-    def add_zsecurityprice(self, data):
+    def add_zsecurityprices(self, prices):
+        """Insert or update many ZSECURITYPRICE records at once. Returns the list of Z_PKs in the order of prices.
+
+        Takes the same dicts as add_zsecurityprice(). Price items are resolved from the cache, existing records are
+        found with one query per price item for the range of dates given, then new records are inserted and existing
+        ones updated with batched statements. If a date is given more than once for a security, the last one wins.
+        ZSECURITYPRICEITEM.ZPKNOWNDATERANGEBEGIN/END are left alone: their unit isn't confirmed.
+        """
         cur = self.cur
 
-        zpsecuritypriceitem_pk = self.get_zsecuritypriceitem_pk_by_zsecurity(data['zpsecurity_pk'])
-
-        # Check if ZSECURITYPRICE for the specified date already exists.
-        cur.execute("SELECT * FROM ZSECURITYPRICE WHERE ZPSECURITYPRICEITEM = ? AND ZPDATE = strftime('%s', ?)/(60*60*24)", (zpsecuritypriceitem_pk, data['zpdate']))
-        zsecurityprices = cur.fetchall()
-        rowcount_zsecurityprice = len(zsecurityprices)
-        if rowcount_zsecurityprice == 0:
-            # ZSECURITYPRICE.ZPDATE is an exception to ZPDATEs in other tables like ZTRANSACTION, ZLINEITEM, ZSECURITY.
-            # Values stored in ZPDATE in ZSECURITYPRICE are unixepoch/(60*60*24).
-            SQL_ZSECURITYPRICE = """
-            INSERT INTO
-                ZSECURITYPRICE
-            VALUES (
-                  :Z_PK
-                , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z_ENT)
-                , :Z_OPT
-                , :ZPDATASOURCE
-                , strftime('%s', :ZPDATE)/(60*60*24)
-                , :ZPSECURITYPRICEITEM
-                , :ZPADJUSTEDCLOSEPRICE
-                , :ZPCLOSEPRICE
-                , :ZPHIGHPRICE
-                , :ZPLOWPRICE
-                , :ZPOPENPRICE
-                , :ZPPREVIOUSCLOSEPRICE
-                , :ZPVOLUME
-            )
-            """
-
-            cur.execute(SQL_ZSECURITYPRICE, {
-                "Z_PK": None,
-                "Z_ENT": 'SecurityPrice',  # entry type (see catalog in Z_PRIMARYKEY)
-                "Z_OPT": 1,  # (looks like how many times the entry was edited?)
-                # Not sure about this one, observed 0s and 3s, so default at 0
-                "ZPDATASOURCE": 0,
-                # Here we expect string datetime, Banktivity expects unixepoch/(60*60*24). The "adapter" is in SQL.
-                "ZPDATE": data['zpdate'],
-                # ZSECURITYPRICE.ZPSECURITYPRICEITEM is the reference to ZSECURITYPRICEITEM.Z_PK
-                "ZPSECURITYPRICEITEM": zpsecuritypriceitem_pk,
-                "ZPADJUSTEDCLOSEPRICE": 0,
-                # ZPCLOSEPRICE matters the most as it affects the portfolio value. This is what changes when the security price is updated in the Portfolio section
-                "ZPCLOSEPRICE": data['c'],
-                "ZPHIGHPRICE": data['h'],
-                "ZPLOWPRICE": data['l'],
-                "ZPOPENPRICE": data['o'],
-                "ZPPREVIOUSCLOSEPRICE": 0,
-                "ZPVOLUME": data['v']
-            })
-            pk = self.cur.lastrowid
-        # end of if cur.rowcount == 0:
-        elif rowcount_zsecurityprice == 1:
-            pk = zsecurityprices[0]['Z_PK']
-            SQL_ZSECURITYPRICE = """
-            UPDATE
-                ZSECURITYPRICE
-            SET
-                  ZPADJUSTEDCLOSEPRICE = ?
-                , ZPCLOSEPRICE = ?
-                , ZPHIGHPRICE = ?
-                , ZPLOWPRICE = ?
-                , ZPOPENPRICE = ?
-                , ZPPREVIOUSCLOSEPRICE = ?
-                , ZPVOLUME = ?
-            WHERE
-                Z_PK = ?
-            """
-            cur.execute(SQL_ZSECURITYPRICE, (0, data['c'], data['h'], data['l'], data['o'], 0, data['v'], pk))
-            rows_affected = cur.rowcount
-            if rows_affected != 1:
-                print(f"UNEXPECTED ERROR: UPDATE ZSECURITYPRICE affected {rows_affected} rows instead of 1. Aborting.")
+        # ZSECURITYPRICE.ZPDATE is an exception to ZPDATEs in other tables like ZTRANSACTION, ZLINEITEM, ZSECURITY.
+        # Values stored in ZPDATE in ZSECURITYPRICE are unixepoch/(60*60*24).
+        keys = []
+        latest = {}  # (ZSECURITYPRICEITEM.Z_PK, ZPDATE) -> data
+        for data in prices:
+            zpsecuritypriceitem_pk = self.get_zsecuritypriceitem_pk_by_zsecurity(data['zpsecurity_pk'])
+            if zpsecuritypriceitem_pk is None:
+                print(f"ERROR: No ZSECURITYPRICEITEM for ZPSECURITY_PK {data['zpsecurity_pk']}. Aborting.")
                 exit(1)
-        # end of update existing ZSECURITYPRICE
-        else:
-            print(f"ERROR: Found {rowcount_zsecurityprice} ZSECURITYPRICE records for ZPSECURITY_PK {data['zpsecurity_pk']} for date {data['zpdate']}. Expected either 1 or 0. Aborting.")
+            key = (zpsecuritypriceitem_pk, isoformat_to_unix_day(data['zpdate']))
+            keys.append(key)
+            latest[key] = data
+
+        # Existing records for the range of dates of every price item
+        days_by_item = {}
+        for zpsecuritypriceitem_pk, zpdate in latest:
+            days_by_item.setdefault(zpsecuritypriceitem_pk, []).append(zpdate)
+        existing = {}
+        for zpsecuritypriceitem_pk, days in days_by_item.items():
+            cur.execute("SELECT ZPDATE, Z_PK FROM ZSECURITYPRICE WHERE ZPSECURITYPRICEITEM = ? AND ZPDATE BETWEEN ? AND ?",
+                        (zpsecuritypriceitem_pk, min(days), max(days)))
+            for zpdate, z_pk in cur.fetchall():
+                key = (zpsecuritypriceitem_pk, zpdate)
+                if key in existing and key in latest:
+                    print(f"ERROR: Found several ZSECURITYPRICE records for ZSECURITYPRICEITEM_PK {zpsecuritypriceitem_pk} for day {zpdate}. Expected either 1 or 0. Aborting.")
+                    exit(1)
+                existing[key] = z_pk
+
+        new_keys = [key for key in latest if key not in existing]
+        z_pks = {key: existing[key] for key in latest if key in existing}
+        first_z_pk = self.reserve_z_pks('SecurityPrice', len(new_keys))
+        z_pks.update(zip(new_keys, range(first_z_pk, first_z_pk + len(new_keys))))
+
+        SQL_ZSECURITYPRICE_INSERT = """
+        INSERT INTO
+            ZSECURITYPRICE
+        VALUES (
+              :Z_PK
+            , :Z_ENT
+            , :Z_OPT
+            , :ZPDATASOURCE
+            , :ZPDATE
+            , :ZPSECURITYPRICEITEM
+            , :ZPADJUSTEDCLOSEPRICE
+            , :ZPCLOSEPRICE
+            , :ZPHIGHPRICE
+            , :ZPLOWPRICE
+            , :ZPOPENPRICE
+            , :ZPPREVIOUSCLOSEPRICE
+            , :ZPVOLUME
+        )
+        """
+        z_ent = self.get_z_ent('SecurityPrice')  # entry type (see catalog in Z_PRIMARYKEY)
+        cur.executemany(SQL_ZSECURITYPRICE_INSERT, [{
+            "Z_PK": z_pks[key],
+            "Z_ENT": z_ent,
+            "Z_OPT": 1,  # (looks like how many times the entry was edited?)
+            # Not sure about this one, observed 0s and 3s, so default at 0
+            "ZPDATASOURCE": 0,
+            "ZPDATE": key[1],
+            # ZSECURITYPRICE.ZPSECURITYPRICEITEM is the reference to ZSECURITYPRICEITEM.Z_PK
+            "ZPSECURITYPRICEITEM": key[0],
+            "ZPADJUSTEDCLOSEPRICE": 0,
+            # ZPCLOSEPRICE matters the most as it affects the portfolio value. This is what changes when the security price is updated in the Portfolio section
+            "ZPCLOSEPRICE": latest[key]['c'],
+            "ZPHIGHPRICE": latest[key]['h'],
+            "ZPLOWPRICE": latest[key]['l'],
+            "ZPOPENPRICE": latest[key]['o'],
+            "ZPPREVIOUSCLOSEPRICE": 0,
+            "ZPVOLUME": latest[key]['v']
+        } for key in new_keys])
+
+        SQL_ZSECURITYPRICE_UPDATE = """
+        UPDATE
+            ZSECURITYPRICE
+        SET
+              ZPADJUSTEDCLOSEPRICE = ?
+            , ZPCLOSEPRICE = ?
+            , ZPHIGHPRICE = ?
+            , ZPLOWPRICE = ?
+            , ZPOPENPRICE = ?
+            , ZPPREVIOUSCLOSEPRICE = ?
+            , ZPVOLUME = ?
+        WHERE
+            Z_PK = ?
+        """
+        updated_keys = [key for key in latest if key in existing]
+        cur.executemany(SQL_ZSECURITYPRICE_UPDATE, [
+            (0, latest[key]['c'], latest[key]['h'], latest[key]['l'], latest[key]['o'], 0, latest[key]['v'], z_pks[key])
+            for key in updated_keys])
+        if updated_keys and cur.rowcount != len(updated_keys):
+            print(f"UNEXPECTED ERROR: UPDATE ZSECURITYPRICE affected {cur.rowcount} rows instead of {len(updated_keys)}. Aborting.")
             exit(1)
 
-        return pk
+        return [z_pks[key] for key in keys]
+    # end add_zsecurityprices()
+
+    def add_zsecurityprice(self, data):
+        return self.add_zsecurityprices([data])[0]
     # end add_zsecurityprice()
 
     def get_zsecurity_by_symbol(self, zpsymbol):
-        cur = self.cur
-        cur.execute(
-            "SELECT * FROM ZSECURITY WHERE ZPSYMBOL = ?",
-            (zpsymbol,)
-        )
-        return cur.fetchone()
+        """Dict with ZSECURITY_COLUMNS of the security or None."""
+        return self.zsecurities.get(zpsymbol)
+
+    def get_security_holdings(self):
+        """Dict of (ZACCOUNT Z_PK, ZSECURITY.ZPSYMBOL) -> shares held, summed over all security line items by a
+        single aggregate query. Positions closed to zero are left out."""
+        self.cur.execute("""
+        SELECT
+              li.ZPACCOUNT
+            , s.ZPSYMBOL
+            , SUM(sli.ZPSHARES)
+        FROM
+            ZSECURITYLINEITEM sli
+        JOIN
+            ZLINEITEM li
+        ON (sli.ZPLINEITEM = li.Z_PK)
+        JOIN
+            ZSECURITY s
+        ON (sli.ZPSECURITY = s.Z_PK)
+        WHERE
+            sli.ZPSHARES IS NOT NULL
+        GROUP BY
+            li.ZPACCOUNT, s.ZPSYMBOL
+        HAVING
+            ABS(SUM(sli.ZPSHARES)) > 1e-9
+        """)
+        return {(zaccount_pk, zpsymbol): shares for zaccount_pk, zpsymbol, shares in self.cur.fetchall()}
+
+    def preload_duplicates(self, period_start, period_end, excluded_ztransaction_pks=()):
+        """Load existing line items for the import window into the duplicate index (see DuplicateIndex).
+
+        period_start and period_end are datetimes (or ISO-formatted strings) of the import window. Checks for days
+        outside of the window still work, the days get loaded on demand. Transactions with excluded_ztransaction_pks
+        (e.g. of the operations in the import ledger) are not matched.
+        """
+        self.duplicate_index.exclude(excluded_ztransaction_pks)
+        self.duplicate_index.load(isoformat_to_local_day(period_start), isoformat_to_local_day(period_end))
 
     def find_primaryaccount_transaction_duplicate(self, transaction_data):
         """Find the PrimaryAccount transaction matching supplied data by some criteria.
 
-        Caveats:
-        Note that the current algo is a bit unsafe as it fails in situations when multiple transactions are
-        present in the same date and with the same amount. For example, if there are 3 deposits in the same
-        day for 1000 ₽, only the first one will be added.
+        Transactions are matched by account, local day and amount. Every match is counted once: if there are 3
+        deposits in the same day for 1000 ₽ and Banktivity has only one of them, the other two are not duplicates.
 
         For reference — Banktivity transaction prepared data:
         {'primaryaccount_zaccount_pk': 248,
@@ -547,51 +1013,17 @@ class Banktivity():
          'zptitle': None,
          'zptransactionamount': 10000.0}
         """
-        __method__ = "find_primaryaccount_transaction_duplicate()"
-        cur = self.cur
-
-        SQL_QUERY = """
-        SELECT
-            *
-        FROM
-            ZLINEITEM li
-        JOIN
-            ZTRANSACTION t
-        ON (li.ZPTRANSACTION = t.Z_PK)
-        WHERE
-                ZPACCOUNT = :ZACCOUNT_PK
-            AND DATE(978307200+ZPDATE, 'unixepoch', 'localtime') = strftime('%Y-%m-%d', :ZPDATE)
-            AND ZPTRANSACTIONAMOUNT  = :ZPTRANSACTIONAMOUNT
-        """
-        SQL_VALUES = {
-            "ZACCOUNT_PK": transaction_data['primaryaccount_zaccount_pk'],
-            "ZPDATE": transaction_data['zpdate'],
-            "ZPTRANSACTIONAMOUNT": transaction_data['zptransactionamount']
-        }
-#        print(f"{__method__} [debug] prepared SQL query: {SQL_QUERY}")
-#        pprint.pprint(SQL_VALUES)
-        cur.execute(SQL_QUERY, SQL_VALUES)
-        existing_data = cur.fetchall()
-        rowcount = len(existing_data)
-        if rowcount == 0:
-            return False
-        elif rowcount == 1:
-#            print(f"NOTICE: Existing Banktivity transaction found matching key parameters.")
-#            pprint.pprint(existing_data[0])
-#            print()
-            return True
-        else:
-            print(
-                f"ERROR: Found {rowcount} ZSECURITYPRICE+ZLINEITEM+ZTRANSACTION joined records for data specified. Expected either 1 or 0. Aborting.")
-            print("Input transaction data:")
-            pprint.pprint(transaction_data)
-            print("Data found in Banktivity DB:")
-            pprint.pprint(existing_data)
-            exit(1)
+        return self.duplicate_index.take_primaryaccount_item(
+            transaction_data['primaryaccount_zaccount_pk'],
+            isoformat_to_local_day(transaction_data['zpdate']),
+            transaction_data['zptransactionamount']
+        )
 
     def find_security_transaction_duplicate(self, transaction_data):
         """Find the security transaction matching supplied data by some criteria.
 
+        Like find_primaryaccount_transaction_duplicate(), every matching ZSECURITYLINEITEM is counted once.
+
         For reference — Banktivity transaction prepared data:
             transaction_data = {'zpamount': -49663.68,
              'commission_amount': -146.42,
@@ -610,77 +1042,35 @@ class Banktivity():
              'zptitle': None,
              'zptransactionamount': 0}
         """
-        __method__ = "find_security_transaction_duplicate()"
-        cur = self.cur
-
-        SQL_QUERY = """
-        SELECT
-            *
-        FROM
-            ZSECURITYLINEITEM sli
-        JOIN
-            ZLINEITEM li
-        ON (sli.ZPLINEITEM = li.Z_PK)
-        JOIN
-            ZTRANSACTION t
-        ON (li.ZPTRANSACTION = t.Z_PK)
-        WHERE
-                ZPSECURITY = :ZSECURITY_PK
-            AND ZPACCOUNT = :ZACCOUNT_PK
-            AND DATE(978307200+ZPDATE, 'unixepoch', 'localtime') = strftime('%Y-%m-%d', :ZPDATE)
-            AND ZPAMOUNT = :ZPAMOUNT
-            AND ZPCOMMISSION = :ZPCOMMISSION
-            AND ZPINCOME = :ZPINCOME
-            AND ZPPRICEPERSHARE = :ZPPRICEPERSHARE
-            AND ZPSHARES = :ZPSHARES
-        """
-        SQL_VALUES = {
-            "ZSECURITY_PK": transaction_data['zpsecurity'],
-            "ZACCOUNT_PK": transaction_data['primaryaccount_zaccount_pk'],
-            "ZPDATE": transaction_data['zpdate']
-        }
         if transaction_data['transaction_type'] == 'Buy' or transaction_data['transaction_type'] == 'Sell':
-            SQL_VALUES.update({
-                # negative for Buy, positive for Sell, else NULL. Also: Banktivity accounts share buy/sell amount PLUS commission amount in ZPAMOUNT
-                # WARNING: the formula below depends on the correct sign (+/-) given in transaction_data['zpshares']!!!
-                "ZPAMOUNT": transaction_data['zpamount'],
-                "ZPCOMMISSION": transaction_data['commission_amount'],  # non-null negative or NULL
-                "ZPINCOME": 0,
-                "ZPPRICEPERSHARE": transaction_data['zppricepershare'],  # NULL for dividends
-                "ZPSHARES": transaction_data['zpshares'],  # quantity of notes purchased/sold
-            })
+            # negative for Buy, positive for Sell, else NULL. Also: Banktivity accounts share buy/sell amount PLUS commission amount in ZPAMOUNT
+            # WARNING: the formula below depends on the correct sign (+/-) given in transaction_data['zpshares']!!!
+            zpamount = transaction_data['zpamount']
+            zpcommission = transaction_data['commission_amount']  # non-null negative or NULL
+            zpincome = 0
+            zppricepershare = transaction_data['zppricepershare']  # NULL for dividends
+            zpshares = transaction_data['zpshares']  # quantity of notes purchased/sold
         elif transaction_data['transaction_type'] == 'Investment Inc.' or transaction_data[
             'transaction_type'] == 'Interest Inc.' or transaction_data['transaction_type'] == 'Dividend':
-                SQL_QUERY = SQL_QUERY.replace('= :ZPAMOUNT', 'IS NULL')
-                SQL_QUERY = SQL_QUERY.replace('= :ZPCOMMISSION', 'IS NULL')
-                SQL_QUERY = SQL_QUERY.replace('= :ZPPRICEPERSHARE', 'IS NULL')
-                SQL_QUERY = SQL_QUERY.replace('= :ZPSHARES', 'IS NULL')
-                SQL_VALUES.update({
-                    "ZPINCOME": transaction_data['zpincome']  # positive for dividends etc. or 0
-                })
+            zpamount = None
+            zpcommission = None
+            zpincome = transaction_data['zpincome']  # positive for dividends etc. or 0
+            zppricepershare = None
+            zpshares = None
         else:
             print(f"ERROR: Unsupported transaction_type ({transaction_data['transaction_type']}). Abort.")
             exit(1)
 
-#        print(f"{__method__} [debug] prepared SQL query: {SQL_QUERY}")
-#        pprint.pprint(SQL_VALUES)
-        cur.execute(SQL_QUERY, SQL_VALUES)
-        existing_data = cur.fetchall()
-        rowcount = len(existing_data)
-        if rowcount == 0:
-            return False
-        elif rowcount == 1:
-#            print(f"NOTICE: Existing Banktivity transaction found matching key parameters.")
-#            pprint.pprint(existing_data[0])
-#            print()
-            return True
-        else:
-            print(f"ERROR: Found {rowcount} ZSECURITYPRICE+ZLINEITEM+ZTRANSACTION joined records for data specified. Expected either 1 or 0. Aborting.")
-            print("Input transaction data:")
-            pprint.pprint(transaction_data)
-            print("Data found in Banktivity DB:")
-            pprint.pprint(existing_data)
-            exit(1)
+        return self.duplicate_index.take_security_item(
+            transaction_data['zpsecurity'],
+            transaction_data['primaryaccount_zaccount_pk'],
+            isoformat_to_local_day(transaction_data['zpdate']),
+            zpamount,
+            zpcommission,
+            zpincome,
+            zppricepershare,
+            zpshares
+        )
 
     def add_security_transaction(self, transaction_data):
         """The do-it-all method for adding security-related transactions.
@@ -692,57 +1082,26 @@ class Banktivity():
         o Add ZLINEITEM for the category (even if it's not specified)
         o Add ZSECURITYLINEITEM with some data of the whole security transaction. References ZLINEITEM.Z_PK.
         """
-        cur = self.cur
-        __method__ = "add_security_transaction()"
+        return self.write_transactions([(transaction_data, True)])[0]
+    # end add_security_transaction()
 
-        # [1/4] This adds ZTRANSACTION and the corresponding ZLINEITEM entries for account and category
-        ztransaction_pk = self.add_transaction(transaction_data)
+    def zsecuritylineitem_values(self, transaction_data, zsecuritylineitem_pk, primaryaccount_zlineitem_values,
+                                 category_zlineitem_values):
+        __method__ = "zsecuritylineitem_values()"
 
-        # [2/4] Add ZSECURITYLINEITEM
-        # Get Z_PK of PrimaryAccount ZLINEITEM
-        cur.execute(
-            "SELECT Z_PK FROM ZLINEITEM WHERE ZPTRANSACTION = ? AND ZPACCOUNT = ?",
-            (ztransaction_pk, self.get_zaccount_pk(transaction_data['transaction_account_name']))
-        )
-        primaryaccount_zlineitem_z_pk = cur.fetchone()['Z_PK']
-        # Get ZPUNIQUEID of Category ZLINEITEM
+        # ZPUNIQUEID of Category ZLINEITEM
         categoryaccount_zlineitem_zpuniqueid = None
         if transaction_data['transaction_type'] == 'Investment Inc.' or transaction_data[
             'transaction_type'] == 'Interest Inc.' or transaction_data['transaction_type'] == 'Dividend':
-            cur.execute(
-                "SELECT ZPUNIQUEID FROM ZLINEITEM WHERE ZPTRANSACTION = ? AND Z_PK != ?",
-                (ztransaction_pk, primaryaccount_zlineitem_z_pk)
-            )
-            categoryaccount_zlineitem_zpuniqueid = cur.fetchone()['ZPUNIQUEID']
-
-        SQL_ZSECURITYLINEITEM = """
-        INSERT INTO
-            ZSECURITYLINEITEM
-        VALUES (
-              :Z_PK
-            , (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = :Z_ENT)
-            , :Z_OPT
-            , :ZPCOSTBASISMETHOD
-            , :ZPDISTRIBUTIONTYPE
-            , :ZPLINEITEM
-            , :ZPSECURITY
-            , :ZPAMOUNT
-            , :ZPCOMMISSION
-            , :ZPINCOME
-            , :ZPPRICEMULTIPLIER
-            , :ZPPRICEPERSHARE
-            , :ZPSHARES
-            , :ZPINCOMECATEGORYLINEITEMID
-        )
-        """
+            categoryaccount_zlineitem_zpuniqueid = category_zlineitem_values['ZPUNIQUEID']
 
         SQL_VALUES = {
-            "Z_PK": None,
-            "Z_ENT": 'SecurityLineItem',  # entry type (see catalog in Z_PRIMARYKEY)
+            "Z_PK": zsecuritylineitem_pk,
+            "Z_ENT": self.get_z_ent('SecurityLineItem'),  # entry type (see catalog in Z_PRIMARYKEY)
             "Z_OPT": 1,  # (looks like how many times the entry was edited?)
             "ZPCOSTBASISMETHOD": None,  # used for Sell transactions
             "ZPDISTRIBUTIONTYPE": 1,  # Seems to always be 1
-            "ZPLINEITEM": primaryaccount_zlineitem_z_pk,  # points to the PrimaryAccount ZLINEITEM.Z_PK
+            "ZPLINEITEM": primaryaccount_zlineitem_values['Z_PK'],  # points to the PrimaryAccount ZLINEITEM.Z_PK
             "ZPSECURITY": transaction_data['zpsecurity'],  # points to ZPSECURITY.Z_PK
             "ZPPRICEMULTIPLIER": transaction_data['zppricemultiplier'] if 'zppricemultiplier' in transaction_data else 1,  # used for Bonds
             "ZPINCOMECATEGORYLINEITEMID": categoryaccount_zlineitem_zpuniqueid
@@ -774,14 +1133,5 @@ class Banktivity():
                 "ZPSHARES": transaction_data['zpshares'],  # quantity of notes purchased/sold. Must be negative for Sell transactions
             })
 
-        cur.execute(SQL_ZSECURITYLINEITEM, SQL_VALUES)
-        zsecuritylineitem_z_pk = self.cur.lastrowid
-        # End of [2/4] Add ZSECURITYLINEITEM
-
-        # [3/4] Update PrimaryAccount ZLINEITEM.ZPSECURITYLINEITEM to reference to Z_PK of ZSECURITYITEM just inserted
-        cur.execute(
-            "UPDATE ZLINEITEM SET ZPSECURITYLINEITEM = ? WHERE Z_PK = ?",
-            (zsecuritylineitem_z_pk, primaryaccount_zlineitem_z_pk)
-        )
-    # end add_security_transaction()
+        return SQL_VALUES
 # end class Banktivity()
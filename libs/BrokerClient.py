@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+from time import monotonic, perf_counter, sleep
+import logging
+import math
+import random
+import threading
+import urllib3
+
+
+class TokenBucket():
+    """Thread-safe token bucket: rate_per_minute tokens are added evenly over a minute, up to capacity."""
+
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+# end class TokenBucket()
+
+
+class BrokerClient():
+    """Tinkoff Investments OpenAPI client (openapi.api_client()) with rate limits, retries and request statistics.
+
+    Used exactly like the wrapped client: client.market.market_candles_get(...) etc. Every call
+    o waits for a token of its API group (user, portfolio, operations, market), so bursts of concurrent requests
+      stay within the broker's per-minute limits,
+    o is retried on 429, 5xx and connection errors with exponential backoff and full jitter (or after Retry-After if
+      the broker sends one),
+    o is counted with its latency per endpoint, see report().
+
+    All API groups share the connection pool of the wrapped client, sized to the number of concurrent requests so
+    connections are kept alive and reused instead of being dropped when more threads than pooled connections run.
+    """
+
+    # Requests per minute per API group, from the limits published for OpenAPI
+    DEFAULT_LIMITS = {'user': 100, 'portfolio': 120, 'operations': 120, 'market': 120}
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, client, limits=None, concurrency=4, retries=5, backoff=0.5, max_backoff=30):
+        self.client = client
+        self.limits = dict(self.DEFAULT_LIMITS, **(limits or {}))
+        self.buckets = {group: TokenBucket(limit, capacity=max(1, concurrency)) for group, limit in self.limits.items()}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.samples = {}  # endpoint -> list of [seconds, attempts, failed]
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.configure_pool(concurrency)
+
+    def configure_pool(self, maxsize):
+        """Size the urllib3 pool of the client's ApiClient to maxsize connections. Pools are created on the first
+        request, so this only has to change the arguments they are created with."""
+        for group in self.limits:
+            api_client = getattr(getattr(self.client, group, None), 'api_client', None)
+            pool_manager = getattr(getattr(api_client, 'rest_client', None), 'pool_manager', None)
+            if pool_manager is not None:
+                pool_manager.connection_pool_kw['maxsize'] = maxsize
+                pool_manager.connection_pool_kw['block'] = False
+            else:
+                logging.debug(f"No connection pool found for the {group} API, leaving it as is")
+
+    def __getattr__(self, group):
+        if group.startswith('_') or group in ('client', 'limits'):
+            raise AttributeError(group)
+        if group not in self.limits:
+            return getattr(self.client, group)
+        if group not in self.groups:
+            self.groups[group] = ApiGroup(self, group, getattr(self.client, group))
+        return self.groups[group]
+
+    def is_transient(self, e):
+        return getattr(e, 'status', None) in self.RETRY_STATUSES or isinstance(
+            e, (urllib3.exceptions.HTTPError, ConnectionError, TimeoutError))
+
+    def retry_delay(self, e, attempt):
+        headers = getattr(e, 'headers', None) or {}
+        retry_after = headers.get('Retry-After') if hasattr(headers, 'get') else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, group, name, method, *args, **kwargs):
+        endpoint = f"{group}.{name}"
+        started = perf_counter()
+        attempt = 0
+        failed = True
+        try:
+            while True:
+                self.buckets[group].acquire()
+                try:
+                    result = method(*args, **kwargs)
+                    failed = False
+                    return result
+                except Exception as e:
+                    if attempt >= self.retries or not self.is_transient(e):
+                        raise
+                    delay = self.retry_delay(e, attempt)
+                    logging.info(f"{endpoint} failed ({getattr(e, 'status', None) or type(e).__name__}), retrying in {delay:.1f} s")
+                    attempt += 1
+                    sleep(delay)
+        finally:
+            with self.lock:
+                self.samples.setdefault(endpoint, []).append([perf_counter() - started, attempt + 1, failed])
+
+    def statistics(self):
+        """List of dicts with statistics per endpoint, the most expensive first. Time includes waiting for rate
+        limits and retries."""
+        statistics = []
+        for endpoint, samples in self.samples.items():
+            seconds = sorted(sample[0] for sample in samples)
+            statistics.append({
+                'endpoint': endpoint,
+                'calls': len(samples),
+                'requests': sum(sample[1] for sample in samples),
+                'failed': sum(1 for sample in samples if sample[2]),
+                'total_s': sum(seconds),
+                'mean_ms': 1000 * sum(seconds) / len(seconds),
+                'p95_ms': 1000 * seconds[max(math.ceil(0.95 * len(seconds)) - 1, 0)],
+            })
+        statistics.sort(key=lambda item: item['total_s'], reverse=True)
+        return statistics
+
+    def summary(self):
+        lines = [f"{'total s':>10} {'calls':>8} {'requests':>8} {'failed':>8} {'mean ms':>8} {'p95 ms':>8}  endpoint"]
+        for item in self.statistics():
+            lines.append(f"{item['total_s']:>10.3f} {item['calls']:>8} {item['requests']:>8} {item['failed']:>8} "
+                         f"{item['mean_ms']:>8.1f} {item['p95_ms']:>8.1f}  {item['endpoint']}")
+        return "\n".join(lines)
+
+    def report(self):
+        if self.samples:
+            print("OpenAPI requests:")
+            print(self.summary())
+# end class BrokerClient()
+
+
+class ApiGroup():
+    """Proxy of an API group of the client (client.market etc.) running its methods through BrokerClient.call()."""
+
+    def __init__(self, broker_client, group, api):
+        self.broker_client = broker_client
+        self.group = group
+        self.api = api
+
+    def __getattr__(self, name):
+        method = getattr(self.api, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            return self.broker_client.call(self.group, name, method, *args, **kwargs)
+        return call
+# end class ApiGroup()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from os.path import expanduser
+import os
+import sqlite3
+
+
+Candle = namedtuple('Candle', ['o', 'h', 'l', 'c', 'v'])
+
+
+class CandleCache():
+    """On-disk store of broker market candles in a sidecar SQLite file, keyed by FIGI, interval and day.
+
+    Besides the candles, the store keeps the spans of days it has already fetched for every FIGI and interval, so
+    days without a candle (weekends, holidays) are known to be empty and never asked for again. Fetching goes through
+    missing_spans() and store(): only days not covered yet are requested, in spans no longer than the broker allows
+    per request. Candles of the current day are incomplete: they are kept in memory for the run only.
+
+    Days are calendar days in the timezone given to the constructor (the importer's Timezone).
+    """
+
+    # Longest range of days the broker returns candles of the interval for in one request
+    MAX_SPAN_DAYS = {'day': 365, 'week': 2 * 365, 'month': 10 * 365}
+
+    def __init__(self, path, tz):
+        path = expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.tz = tz
+        self.today_candles = {}  # (figi, interval) -> candle of the current day or None, not persisted
+        self.con = sqlite3.connect(path)
+        self.con.executescript("""
+        CREATE TABLE IF NOT EXISTS candles (
+              figi TEXT NOT NULL
+            , interval TEXT NOT NULL
+            , day TEXT NOT NULL
+            , o REAL
+            , h REAL
+            , l REAL
+            , c REAL
+            , v REAL
+            , PRIMARY KEY (figi, interval, day)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS candle_spans (
+              figi TEXT NOT NULL
+            , interval TEXT NOT NULL
+            , first_day TEXT NOT NULL
+            , last_day TEXT NOT NULL
+            , PRIMARY KEY (figi, interval, first_day)
+        ) WITHOUT ROWID;
+        """)
+
+    def today(self):
+        return datetime.now(tz=self.tz).date()
+
+    def spans(self, figi, interval):
+        """Covered spans of days as a sorted list of (first_day, last_day) dates."""
+        cur = self.con.execute(
+            "SELECT first_day, last_day FROM candle_spans WHERE figi = ? AND interval = ? ORDER BY first_day",
+            (figi, interval))
+        return [(date.fromisoformat(first_day), date.fromisoformat(last_day)) for first_day, last_day in cur]
+
+    def missing_spans(self, figi, first_day, last_day, interval='day'):
+        """Spans of days from first_day to last_day inclusive that are not covered yet, split into spans the broker
+        accepts in one request. Days after today are left out, so is today once fetched during the run."""
+        today = self.today()
+        last_day = min(last_day, today if (figi, interval) not in self.today_candles else today - timedelta(days=1))
+        gaps = []
+        day = first_day
+        for span_first, span_last in self.spans(figi, interval):
+            if span_last < day:
+                continue
+            if span_first > last_day:
+                break
+            if span_first > day:
+                gaps.append((day, span_first - timedelta(days=1)))
+            day = span_last + timedelta(days=1)
+        if day <= last_day:
+            gaps.append((day, last_day))
+
+        max_span = timedelta(days=self.MAX_SPAN_DAYS[interval] - 1)
+        missing = []
+        for gap_first, gap_last in gaps:
+            while gap_first <= gap_last:
+                missing.append((gap_first, min(gap_first + max_span, gap_last)))
+                gap_first += max_span + timedelta(days=1)
+        return missing
+
+    def store(self, figi, first_day, last_day, candles, interval='day'):
+        """Store candles fetched for the span of days and mark the span as covered up to yesterday.
+
+        candles are broker candle objects with o, h, l, c, v and time (timezone-aware datetime) attributes.
+        """
+        today = self.today()
+        rows = []
+        for candle in candles:
+            day = candle.time.astimezone(self.tz).date()
+            if day < today:
+                rows.append((figi, interval, day.isoformat(), candle.o, candle.h, candle.l, candle.c, candle.v))
+            elif day == today:
+                self.today_candles[(figi, interval)] = Candle(candle.o, candle.h, candle.l, candle.c, candle.v)
+        if first_day <= today <= last_day:
+            self.today_candles.setdefault((figi, interval), None)
+        self.con.executemany("INSERT OR REPLACE INTO candles VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        last_day = min(last_day, today - timedelta(days=1))
+        if first_day <= last_day:
+            # Merge the span with the overlapping and adjacent ones
+            merged = []
+            for span_first, span_last in sorted(self.spans(figi, interval) + [(first_day, last_day)]):
+                if merged and span_first <= merged[-1][1] + timedelta(days=1):
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], span_last))
+                else:
+                    merged.append((span_first, span_last))
+            self.con.execute("DELETE FROM candle_spans WHERE figi = ? AND interval = ?", (figi, interval))
+            self.con.executemany("INSERT INTO candle_spans VALUES (?, ?, ?, ?)",
+                                 [(figi, interval, span_first.isoformat(), span_last.isoformat())
+                                  for span_first, span_last in merged])
+        self.con.commit()
+
+    def ensure(self, figi, first_day, last_day, fetch, interval='day'):
+        """Fetch the days not covered yet from first_day to last_day with fetch(figi, span_first, span_last,
+        interval), which returns the list of broker candles. Returns the number of requests made."""
+        missing = self.missing_spans(figi, first_day, last_day, interval)
+        for span_first, span_last in missing:
+            self.store(figi, span_first, span_last, fetch(figi, span_first, span_last, interval), interval)
+        return len(missing)
+
+    def get(self, figi, day, interval='day'):
+        """Candle for the day or None if there's none in the store."""
+        if day == self.today():
+            return self.today_candles.get((figi, interval))
+        row = self.con.execute("SELECT o, h, l, c, v FROM candles WHERE figi = ? AND interval = ? AND day = ?",
+                               (figi, interval, day.isoformat())).fetchone()
+        return Candle(*row) if row is not None else None
+# end class CandleCache()
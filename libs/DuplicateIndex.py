@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+
+# Core Data stores dates as seconds since 2001-01-01 00:00:00 UTC
+CORE_DATA_EPOCH = 978307200
+
+
+def zpdate_to_local_day(zpdate):
+    """Local calendar day of a ZTRANSACTION.ZPDATE value, same as DATE(978307200+ZPDATE, 'unixepoch', 'localtime')."""
+    return datetime.fromtimestamp(CORE_DATA_EPOCH + zpdate).date()
+
+
+def isoformat_to_local_day(value):
+    """Local calendar day of an ISO-formatted date/datetime (as used in transaction_data['zpdate']) or a datetime."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone()
+        return value.date()
+    return value
+
+
+def local_day_to_zpdate(day):
+    """ZPDATE value of the local midnight starting the given day."""
+    return datetime.combine(day, time()).timestamp() - CORE_DATA_EPOCH
+
+
+class DuplicateIndex():
+    """Hashed multiset of the line items already present in Banktivity for a range of days.
+
+    Duplicate checks used to scan every line item of an account with DATE(...) = strftime(...) predicates that
+    SQLite can't use an index for. Instead, existing line items are loaded once per range of local days with a plain
+    ZPDATE range (boundaries are computed here) and counted by key:
+    o PrimaryAccount line items: (account, local day, amount)
+    o Security line items: (security, account, local day, amount, commission, income, price per share, shares)
+
+    The importer loads the whole date range of its operations with one load() (see
+    Banktivity.preload_duplicates()) before the first check. A check for a day outside the loaded days loads just
+    that day, so checks spread over many days without a preload issue two queries per day.
+
+    Every check consumes one match, so three deposits of 1000 ₽ on the same day are recognised as three duplicates
+    if Banktivity already has three of them and as one duplicate plus two new transactions if it has only one.
+    Transactions added during the run are not counted: operations from the broker are distinct by definition.
+
+    Transactions of operations the importer skips without a check (e.g. the ones in the import ledger) must not be
+    counted either, or a new identical operation would take their match: pass their Z_PKs to exclude() before the
+    first load().
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.loaded_days = set()
+        self.excluded_ztransaction_pks = set()
+        self.primaryaccount_items = Counter()
+        self.security_items = Counter()
+
+    def exclude(self, ztransaction_pks):
+        """Leave the line items of these ZTRANSACTION Z_PKs out of the days loaded from now on."""
+        self.excluded_ztransaction_pks.update(ztransaction_pks)
+
+    def load(self, first_day, last_day):
+        """Load line items for local days from first_day to last_day inclusive. Days loaded earlier are skipped."""
+        day = first_day
+        while day <= last_day:
+            if day in self.loaded_days:
+                day += timedelta(days=1)
+                continue
+            # Load the longest run of days not loaded yet with a single pair of range queries
+            run_begin = day
+            while day <= last_day and day not in self.loaded_days:
+                self.loaded_days.add(day)
+                day += timedelta(days=1)
+            self._load_range(run_begin, day)
+
+    def _load_range(self, first_day, end_day):
+        """Load line items for local days from first_day to end_day exclusive."""
+        cur = self.cur
+        # Local day of a ZPDATE by a binary search in the day boundaries, cheaper than a datetime per row
+        days = [first_day + timedelta(days=i) for i in range((end_day - first_day).days + 1)]
+        boundaries = [local_day_to_zpdate(day) for day in days]
+        zpdate_begin, zpdate_end = boundaries[0], boundaries[-1]
+
+        cur.execute("""
+        SELECT
+              t.Z_PK
+            , li.ZPACCOUNT
+            , t.ZPDATE
+            , li.ZPTRANSACTIONAMOUNT
+        FROM
+            ZTRANSACTION t
+        JOIN
+            ZLINEITEM li
+        ON (li.ZPTRANSACTION = t.Z_PK)
+        WHERE
+                t.ZPDATE >= ?
+            AND t.ZPDATE < ?
+            AND li.Z1_PACCOUNT = (SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = 'PrimaryAccount')
+        """, (zpdate_begin, zpdate_end))
+        excluded = self.excluded_ztransaction_pks
+        for ztransaction_pk, zpaccount, zpdate, zptransactionamount in cur.fetchall():
+            if ztransaction_pk in excluded:
+                continue
+            self.primaryaccount_items[(zpaccount, days[bisect_right(boundaries, zpdate) - 1], zptransactionamount)] += 1
+
+        cur.execute("""
+        SELECT
+              t.Z_PK
+            , sli.ZPSECURITY
+            , li.ZPACCOUNT
+            , t.ZPDATE
+            , sli.ZPAMOUNT
+            , sli.ZPCOMMISSION
+            , sli.ZPINCOME
+            , sli.ZPPRICEPERSHARE
+            , sli.ZPSHARES
+        FROM
+            ZTRANSACTION t
+        JOIN
+            ZLINEITEM li
+        ON (li.ZPTRANSACTION = t.Z_PK)
+        JOIN
+            ZSECURITYLINEITEM sli
+        ON (sli.ZPLINEITEM = li.Z_PK)
+        WHERE
+                t.ZPDATE >= ?
+            AND t.ZPDATE < ?
+        """, (zpdate_begin, zpdate_end))
+        for row in cur.fetchall():
+            if row[0] in excluded:
+                continue
+            _, zpsecurity, zpaccount, zpdate, zpamount, zpcommission, zpincome, zppricepershare, zpshares = row
+            self.security_items[(
+                zpsecurity, zpaccount, days[bisect_right(boundaries, zpdate) - 1], zpamount, zpcommission, zpincome, zppricepershare,
+                zpshares
+            )] += 1
+
+    def _take(self, items, day, key):
+        if day not in self.loaded_days:
+            # Fallback for a day outside the preloaded range
+            self.load(day, day)
+
+        if items[key] > 0:
+            items[key] -= 1
+            return True
+
+        return False
+
+    def take_primaryaccount_item(self, zaccount_pk, day, amount):
+        """Consume one existing PrimaryAccount line item matching the key. Returns True if there was one."""
+        return self._take(self.primaryaccount_items, day, (zaccount_pk, day, amount))
+
+    def take_security_item(self, zsecurity_pk, zaccount_pk, day, amount, commission, income, price_per_share, shares):
+        """Consume one existing security line item matching the key. Returns True if there was one."""
+        return self._take(self.security_items, day, (
+            zsecurity_pk, zaccount_pk, day, amount, commission, income, price_per_share, shares))
+# end class DuplicateIndex()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+from datetime import datetime
+from os.path import expanduser
+import os
+import sqlite3
+
+
+def sidecar_path(banktivity_file):
+    """Path of the importer's sidecar file of a document: next to the .bank7 bundle, not inside it."""
+    return expanduser(banktivity_file).rstrip('/') + '.importer.sqlite'
+
+
+def read_watermarks(banktivity_file):
+    """Watermarks of the document without opening it (see ImportState.watermarks()). Empty if there's no sidecar."""
+    path = sidecar_path(banktivity_file)
+    if not os.path.exists(path):
+        return {}
+    con = sqlite3.connect(path)
+    try:
+        return {broker_account_id: (datetime.fromisoformat(operation_date), operation_id)
+                for broker_account_id, operation_date, operation_id in con.execute(
+                    "SELECT broker_account_id, operation_date, operation_id FROM watermarks")}
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        con.close()
+
+
+class ImportState():
+    """Importer state of a Banktivity document, kept in a sidecar SQLite file next to the document.
+
+    The sidecar is attached to the document's connection (see Banktivity.attach()). State changes are written with
+    Banktivity.defer(), after the imported data is committed, so the state is never ahead of the document.
+
+    o watermarks: per broker account, the date and ID of the latest operation imported. Imports without explicit
+      dates start from the watermark (minus an overlap) and skip the operations up to it.
+    o ledger: (broker account, operation ID) -> ZTRANSACTION Z_PK and ZPUNIQUEID of the transaction the operation
+      was imported as. Operations in the ledger are skipped with a dict lookup, without the duplicate checks.
+    o cursors: per plan (identified by a hash of its items), the position in the plan up to which it has been
+      applied and committed. An interrupted apply of the same plan continues from there.
+    """
+
+    SCHEMA = 'importer'
+
+    def __init__(self, banktivity, banktivity_file):
+        self.banktivity = banktivity
+        banktivity.attach(sidecar_path(banktivity_file), self.SCHEMA)
+        banktivity.cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.SCHEMA}.watermarks (
+              broker_account_id TEXT PRIMARY KEY
+            , operation_date TEXT NOT NULL
+            , operation_id TEXT NOT NULL
+            , updated_at TEXT NOT NULL
+        )
+        """)
+        banktivity.cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.SCHEMA}.ledger (
+              broker_account_id TEXT NOT NULL
+            , operation_id TEXT NOT NULL
+            , ztransaction_pk INTEGER NOT NULL
+            , ztransaction_zpuniqueid TEXT NOT NULL
+            , imported_at TEXT NOT NULL
+            , PRIMARY KEY (broker_account_id, operation_id)
+        ) WITHOUT ROWID
+        """)
+        banktivity.cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.SCHEMA}.ledger_ztransaction_pk ON ledger (ztransaction_pk)")
+        banktivity.cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.SCHEMA}.cursors (
+              plan_id TEXT PRIMARY KEY
+            , position INTEGER NOT NULL
+            , updated_at TEXT NOT NULL
+        )
+        """)
+
+        self.watermarks = {}  # broker account ID -> (operation datetime, operation ID)
+        banktivity.cur.execute(f"SELECT broker_account_id, operation_date, operation_id FROM {self.SCHEMA}.watermarks")
+        for broker_account_id, operation_date, operation_id in banktivity.cur.fetchall():
+            self.watermarks[broker_account_id] = (datetime.fromisoformat(operation_date), operation_id)
+        self.ledger = {}  # (broker account ID, operation ID) -> ZTRANSACTION Z_PK
+        banktivity.cur.execute(f"SELECT broker_account_id, operation_id, ztransaction_pk FROM {self.SCHEMA}.ledger")
+        for broker_account_id, operation_id, ztransaction_pk in banktivity.cur.fetchall():
+            self.ledger[(broker_account_id, operation_id)] = ztransaction_pk
+
+    def is_imported(self, broker_account_id, operation_date, operation_id):
+        """True if the operation is not newer than the account's watermark, i.e. a previous incremental import has
+        seen it. Imports with explicit dates don't use it: operations posted late with earlier dates would be lost."""
+        if broker_account_id not in self.watermarks:
+            return False
+        watermark_date, watermark_id = self.watermarks[broker_account_id]
+        return operation_date < watermark_date or (operation_date == watermark_date and operation_id == watermark_id)
+
+    def advance_watermark(self, broker_account_id, operation_date, operation_id):
+        """Move the account's watermark to the operation unless it is already further. Written after the next
+        Banktivity.commit()."""
+        if broker_account_id in self.watermarks and self.watermarks[broker_account_id][0] >= operation_date:
+            return
+        self.watermarks[broker_account_id] = (operation_date, operation_id)
+        self.banktivity.defer(
+            f"INSERT OR REPLACE INTO {self.SCHEMA}.watermarks VALUES (?, ?, ?, ?)",
+            [(broker_account_id, operation_date.isoformat(), operation_id, datetime.now().astimezone().isoformat())])
+
+    @staticmethod
+    def has_ledger_key(operation_id):
+        """Some operations (e.g. PayIn) come with ID -1 and can't be told apart by it: they are not in the ledger."""
+        return operation_id is not None and not operation_id.startswith('-')
+
+    def in_ledger(self, broker_account_id, operation_id):
+        return (broker_account_id, operation_id) in self.ledger
+
+    def ledger_ztransaction_pks(self):
+        """Z_PKs of the transactions in the ledger: their operations are known, so they are nobody else's duplicate."""
+        return set(self.ledger.values())
+
+    def record(self, entries):
+        """Add (broker account ID, operation ID, ZTRANSACTION Z_PK) entries of the transactions just added to the
+        ledger. Written after the next Banktivity.commit()."""
+        entries = [entry for entry in entries if self.has_ledger_key(entry[1])]
+        if not entries:
+            return
+        ztransaction_pks = [ztransaction_pk for _, _, ztransaction_pk in entries]
+        # Z_PKs of a batch are reserved in one run, a single range lookup gets their ZPUNIQUEIDs
+        self.banktivity.cur.execute("SELECT Z_PK, ZPUNIQUEID FROM ZTRANSACTION WHERE Z_PK BETWEEN ? AND ?",
+                                    (min(ztransaction_pks), max(ztransaction_pks)))
+        zpuniqueids = dict(self.banktivity.cur.fetchall())
+        imported_at = datetime.now().astimezone().isoformat()
+        self.banktivity.defer(
+            f"INSERT OR REPLACE INTO {self.SCHEMA}.ledger VALUES (?, ?, ?, ?, ?)",
+            [(broker_account_id, operation_id, ztransaction_pk, zpuniqueids[ztransaction_pk], imported_at)
+             for broker_account_id, operation_id, ztransaction_pk in entries])
+        for broker_account_id, operation_id, ztransaction_pk in entries:
+            self.ledger[(broker_account_id, operation_id)] = ztransaction_pk
+
+    def cursor(self, plan_id):
+        """Position in the plan to continue from, 0 if the plan hasn't been partially applied."""
+        self.banktivity.cur.execute(f"SELECT position FROM {self.SCHEMA}.cursors WHERE plan_id = ?", (plan_id,))
+        row = self.banktivity.cur.fetchone()
+        return row[0] if row is not None else 0
+
+    def save_cursor(self, plan_id, position):
+        """Record that the plan items before position are applied. Written after the next Banktivity.commit()."""
+        self.banktivity.defer(f"INSERT OR REPLACE INTO {self.SCHEMA}.cursors VALUES (?, ?, ?)",
+                              [(plan_id, position, datetime.now().astimezone().isoformat())])
+
+    def clear_cursor(self, plan_id):
+        self.banktivity.defer(f"DELETE FROM {self.SCHEMA}.cursors WHERE plan_id = ?", [(plan_id,)])
+# end class ImportState()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+from collections import namedtuple
+from os.path import expanduser
+import os
+import sqlite3
+import time
+
+
+Instrument = namedtuple('Instrument', ['figi', 'ticker', 'isin', 'name', 'currency', 'instrument_type'])
+
+
+def instrument_from_broker(broker_security):
+    """Instrument from a broker portfolio position or a search-by-FIGI result."""
+    if getattr(broker_security, 'average_position_price', None) is not None:
+        currency = broker_security.average_position_price.currency
+    else:
+        currency = getattr(broker_security, 'currency', None)
+    instrument_type = getattr(broker_security, 'instrument_type', None) or getattr(broker_security, 'type', None)
+    return Instrument(broker_security.figi, broker_security.ticker, broker_security.isin, broker_security.name,
+                      currency, instrument_type)
+
+
+class InstrumentRegistry():
+    """Broker instruments indexed by FIGI, ISIN and ticker, backed by a persistent FIGI cache with a TTL.
+
+    The registry is filled from the portfolio first. Instruments not held any more are looked up in the cache
+    (a table in the sidecar SQLite file shared with CandleCache) and only when missing or older than the TTL searched
+    for over the network. Every FIGI is resolved at most once per run, including the ones that couldn't be found.
+    """
+
+    def __init__(self, path, ttl_days=30):
+        path = expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.by_figi = {}  # FIGI -> Instrument or None if the broker doesn't know it
+        self.by_isin = {}
+        self.by_ticker = {}
+        self.con = sqlite3.connect(path)
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS instruments (
+              figi TEXT PRIMARY KEY
+            , ticker TEXT
+            , isin TEXT
+            , name TEXT
+            , currency TEXT
+            , instrument_type TEXT
+            , fetched_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """)
+
+    def index(self, instrument):
+        self.by_figi[instrument.figi] = instrument
+        if instrument.isin is not None:
+            self.by_isin.setdefault(instrument.isin, instrument)
+        if instrument.ticker is not None:
+            self.by_ticker.setdefault(instrument.ticker, instrument)
+
+    def store(self, instruments):
+        """Index instruments fetched from the broker and save them in the cache."""
+        instruments = list(instruments)
+        for instrument in instruments:
+            self.index(instrument)
+        now = time.time()
+        self.con.executemany("INSERT OR REPLACE INTO instruments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [tuple(instrument) + (now,) for instrument in instruments])
+        self.con.commit()
+
+    def add_portfolio(self, positions):
+        self.store(instrument_from_broker(position) for position in positions)
+
+    def cached(self, figi):
+        """(found, instrument) from memory or from the cache if not expired, without going to the network."""
+        if figi in self.by_figi:
+            return True, self.by_figi[figi]
+        row = self.con.execute(
+            "SELECT figi, ticker, isin, name, currency, instrument_type FROM instruments WHERE figi = ? AND fetched_at >= ?",
+            (figi, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return False, None
+        instrument = Instrument(*row)
+        self.index(instrument)
+        return True, instrument
+
+    def resolve(self, figi, broker_security):
+        """Register the result of a search by FIGI. broker_security is None or without ISIN if not found."""
+        if broker_security is None or broker_security.isin is None:
+            self.by_figi[figi] = None
+            return None
+        instrument = instrument_from_broker(broker_security)
+        self.store([instrument])
+        return instrument
+
+    def get(self, figi, search):
+        """Instrument by FIGI or None if the broker doesn't know it. search(figi) is called on a cache miss and
+        returns the broker's search result."""
+        found, instrument = self.cached(figi)
+        if found:
+            return instrument
+        return self.resolve(figi, search(figi))
+
+    def get_by_isin(self, isin):
+        return self.by_isin.get(isin)
+
+    def get_by_ticker(self, ticker):
+        return self.by_ticker.get(ticker)
+# end class InstrumentRegistry()
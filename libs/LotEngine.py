@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+from collections import deque, namedtuple
+
+
+Trade = namedtuple('Trade', ['zsecuritylineitem_pk', 'zpdate', 'shares', 'amount'])
+Lot = namedtuple('Lot', ['zaccount_pk', 'zsecurity_pk', 'buy_zsecuritylineitem_pk', 'buy_zpdate', 'shares', 'cost'])
+RealizedGain = namedtuple('RealizedGain', ['zaccount_pk', 'zsecurity_pk', 'sell_zsecuritylineitem_pk', 'sell_zpdate',
+                                           'shares', 'proceeds', 'cost', 'gain', 'matches', 'uncovered_shares'])
+
+
+class LotEngine():
+    """FIFO matching of security sells to buys, per (account, security).
+
+    Security line items with shares are replayed in register order (date, intraday sort index, Z_PK). Buys add a lot
+    to the pair's deque, sells take shares from the oldest lots first, the way Banktivity does for
+    ZPCOSTBASISMETHOD = 1 (FIFO). Cost and proceeds come from ZPAMOUNT, so commissions are included in both.
+
+    o open_lots(): lots still held
+    o realized_gains(): a RealizedGain per sell, with the (buy Z_PK, shares) it was matched with in matches. Shares
+      sold that no lot covered (history before the document, short sales) are counted in uncovered_shares at zero
+      cost.
+    o recompute(since): replays only the pairs with trades since the ZPDATE since, each from its last snapshot
+      before the first affected trade. Before a load() it loads the whole history of those pairs only.
+
+    Lots are not written to the document: the ZSECURITYLOT layout isn't documented.
+    """
+
+    # A copy of a pair's queue is kept every SNAPSHOT_INTERVAL trades to restart the replay from
+    SNAPSHOT_INTERVAL = 64
+
+    SQL_TRADES = """
+    SELECT
+          li.ZPACCOUNT
+        , sli.ZPSECURITY
+        , sli.Z_PK
+        , t.ZPDATE
+        , sli.ZPSHARES
+        , COALESCE(sli.ZPAMOUNT, -sli.ZPSHARES * sli.ZPPRICEPERSHARE * COALESCE(sli.ZPPRICEMULTIPLIER, 1))
+    FROM
+        ZSECURITYLINEITEM sli
+    JOIN
+        ZLINEITEM li
+    ON (sli.ZPLINEITEM = li.Z_PK)
+    JOIN
+        ZTRANSACTION t
+    ON (li.ZPTRANSACTION = t.Z_PK)
+    WHERE
+            sli.ZPSHARES IS NOT NULL
+        AND sli.ZPSHARES != 0
+        AND {condition}
+    ORDER BY
+        t.ZPDATE, COALESCE(li.ZPINTRADAYSORTINDEX, 0), sli.Z_PK
+    """
+
+    # Trades since the ZPDATE parameter
+    SQL_TRADES_SINCE = SQL_TRADES.format(condition="t.ZPDATE >= ?")
+
+    # All trades of the pairs that have trades since the ZPDATE parameter
+    SQL_PAIR_TRADES = SQL_TRADES.format(condition="""(li.ZPACCOUNT, sli.ZPSECURITY) IN (
+            SELECT li.ZPACCOUNT, sli.ZPSECURITY
+            FROM ZSECURITYLINEITEM sli
+            JOIN ZLINEITEM li ON (sli.ZPLINEITEM = li.Z_PK)
+            JOIN ZTRANSACTION t ON (li.ZPTRANSACTION = t.Z_PK)
+            WHERE sli.ZPSHARES IS NOT NULL AND sli.ZPSHARES != 0 AND t.ZPDATE >= ?
+        )""")
+
+    def __init__(self, banktivity):
+        self.banktivity = banktivity
+        self.trades = {}  # (account, security) -> list of Trade in register order
+        self.snapshots = {}  # (account, security) -> list of (trade index, queue copy)
+        self.queues = {}  # (account, security) -> deque of [buy Z_PK, buy ZPDATE, shares left, cost per share]
+        self.gains = {}  # (account, security) -> list of (trade index, RealizedGain)
+        self.loaded = False  # all pairs loaded, see load()
+
+    def load(self):
+        """Load all trades and replay them."""
+        return self.recompute(None)
+
+    def recompute(self, since=None):
+        """Reload the trades dated since the ZPDATE since (all if None), e.g. the date of the earliest transaction an
+        import added, and replay the affected pairs. Before a load() all trades of the affected pairs are loaded and
+        the other pairs are left out. Returns the number of pairs replayed."""
+        cur = self.banktivity.cur
+        whole_pairs = since is None or not self.loaded
+        if since is None:
+            cur.execute(self.SQL_TRADES_SINCE, (-float('inf'),))
+        else:
+            cur.execute(self.SQL_TRADES_SINCE if self.loaded else self.SQL_PAIR_TRADES, (since,))
+        new_trades = {}
+        for zaccount_pk, zsecurity_pk, zsecuritylineitem_pk, zpdate, zpshares, zpamount in cur.fetchall():
+            new_trades.setdefault((zaccount_pk, zsecurity_pk), []).append(
+                Trade(zsecuritylineitem_pk, zpdate, zpshares, zpamount))
+
+        affected = set(new_trades)
+        if since is None:
+            self.trades, self.snapshots, self.queues, self.gains = {}, {}, {}, {}
+            self.loaded = True
+        else:
+            affected |= {pair for pair, trades in self.trades.items() if trades and trades[-1].zpdate >= since}
+
+        for pair in affected:
+            trades = self.trades.get(pair, [])
+            first = 0 if whole_pairs else next(
+                (i for i, trade in enumerate(trades) if trade.zpdate >= since), len(trades))
+            self.trades[pair] = trades[:first] + new_trades.get(pair, [])
+            self.replay(pair, first)
+        return len(affected)
+
+    def replay(self, pair, first):
+        """Replay the pair's trades from index first on, starting from the last snapshot before it."""
+        snapshots = [snapshot for snapshot in self.snapshots.get(pair, []) if snapshot[0] <= first]
+        start, queue = snapshots[-1] if snapshots else (0, ())
+        queue = deque(list(lot) for lot in queue)
+        self.snapshots[pair] = snapshots
+        gains = [gain for gain in self.gains.get(pair, []) if gain[0] < start]
+
+        zaccount_pk, zsecurity_pk = pair
+        trades = self.trades[pair]
+        for i in range(start, len(trades)):
+            if i % self.SNAPSHOT_INTERVAL == 0 and (not snapshots or snapshots[-1][0] < i):
+                snapshots.append((i, tuple(tuple(lot) for lot in queue)))
+            trade = trades[i]
+            if trade.shares > 0:
+                queue.append([trade.zsecuritylineitem_pk, trade.zpdate, trade.shares, -trade.amount / trade.shares])
+                continue
+
+            to_sell = -trade.shares
+            cost = 0.0
+            matches = []
+            while to_sell > 0 and queue:
+                lot = queue[0]
+                shares = min(lot[2], to_sell)
+                cost += shares * lot[3]
+                matches.append((lot[0], shares))
+                lot[2] -= shares
+                to_sell -= shares
+                if lot[2] <= 0:
+                    queue.popleft()
+            gains.append((i, RealizedGain(zaccount_pk, zsecurity_pk, trade.zsecuritylineitem_pk, trade.zpdate,
+                                          -trade.shares, trade.amount, cost, trade.amount - cost, matches, to_sell)))
+
+        self.queues[pair] = queue
+        self.gains[pair] = gains
+
+    def open_lots(self):
+        return [Lot(zaccount_pk, zsecurity_pk, buy_zsecuritylineitem_pk, buy_zpdate, shares, shares * cost_per_share)
+                for (zaccount_pk, zsecurity_pk), queue in self.queues.items()
+                for buy_zsecuritylineitem_pk, buy_zpdate, shares, cost_per_share in queue]
+
+    def realized_gains(self, first_zpdate=None, last_zpdate=None):
+        """RealizedGains of the sells dated from first_zpdate to last_zpdate inclusive (all if None), in date order."""
+        gains = [gain for pair_gains in self.gains.values() for _, gain in pair_gains
+                 if (first_zpdate is None or gain.sell_zpdate >= first_zpdate)
+                 and (last_zpdate is None or gain.sell_zpdate <= last_zpdate)]
+        return sorted(gains, key=lambda gain: gain.sell_zpdate)
+# end class LotEngine()
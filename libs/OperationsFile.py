@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+from datetime import datetime
+from os.path import expanduser
+import json
+
+
+class OperationsFile():
+    """Broker operations of a JSONL file written by the importer's fetch_operations_to_file(), read window by window.
+
+    The file is indexed on open instead of loaded: a block is a run of 'operation' lines of one account, i.e. one
+    fetched window, and the index keeps its offset and the date of its first operation. Windows don't overlap, so the
+    blocks of an account sorted by that date give its operations in date order, and only one block is held in memory
+    at a time.
+
+    o accounts: (broker account ID, broker account type) of the 'account' lines
+    o operations[broker_account_id]: a new iterator over the account's operations in date order, each read from the
+      file; values() the same for every account. Operations are dicts turned into objects by parse.
+    o incomplete_accounts(): accounts whose 'window' lines don't cover their period up to the end in the 'fetched'
+      line, i.e. of a fetch that was interrupted or failed
+    """
+
+    def __init__(self, path, parse):
+        self.path = expanduser(path)
+        self.parse = parse
+        self.accounts = []
+        self.blocks = {}  # broker account ID -> list of (date of the first operation, offset) in file order
+        self.period_starts = {}  # broker account ID -> start of the fetched period, from the 'fetch' line
+        self.period_end = None  # end of the fetched period, from the 'fetched' line written when the fetch completed
+        self.windows = {}  # broker account ID -> list of (window start, window end) of the 'window' lines
+        with open(self.path, 'rb') as f:
+            block_account = None
+            offset = 0
+            for line in f:
+                try:
+                    item = json.loads(line) if line.strip() else {'type': None}
+                except json.JSONDecodeError:
+                    # A line cut by an interrupted fetch: the windows after it are missing anyway
+                    break
+                if item['type'] == 'fetch':
+                    self.period_starts = {broker_account_id: datetime.fromisoformat(period_start)
+                                          for broker_account_id, period_start in item['period_starts'].items()}
+                if item['type'] == 'fetched':
+                    self.period_end = datetime.fromisoformat(item['period_end'])
+                if item['type'] == 'window':
+                    self.windows.setdefault(item['broker_account_id'], []).append(
+                        (datetime.fromisoformat(item['window_start']), datetime.fromisoformat(item['window_end'])))
+                if item['type'] == 'account':
+                    self.accounts.append((item['broker_account_id'], item['broker_account_type']))
+                    self.blocks.setdefault(item['broker_account_id'], [])
+                if item['type'] == 'operation':
+                    if block_account != item['broker_account_id']:
+                        block_account = item['broker_account_id']
+                        self.blocks.setdefault(block_account, []).append(
+                            (datetime.fromisoformat(item['operation']['date']), offset))
+                else:
+                    block_account = None
+                offset += len(line)
+
+    def incomplete_accounts(self):
+        """Broker account IDs of the 'fetch' line whose windows leave a gap in their period. All of them if the
+        file has no 'fetched' line."""
+        incomplete = []
+        for broker_account_id, period_start in self.period_starts.items():
+            covered = period_start
+            for window_start, window_end in sorted(self.windows.get(broker_account_id, [])):
+                if window_start <= covered:
+                    covered = max(covered, window_end)
+            if self.period_end is None or covered < self.period_end:
+                incomplete.append(broker_account_id)
+        return incomplete
+
+    def read_block(self, f, broker_account_id, offset):
+        """Operations of the block at offset, in date order."""
+        f.seek(offset)
+        operations = []
+        for line in f:
+            item = json.loads(line) if line.strip() else {'type': None}
+            if item['type'] != 'operation' or item['broker_account_id'] != broker_account_id:
+                break
+            operations.append(self.parse(item['operation']))
+        return sorted(operations, key=lambda op: op.date)
+
+    def iter_account(self, broker_account_id):
+        with open(self.path, 'rb') as f:
+            for _, offset in sorted(self.blocks.get(broker_account_id, [])):
+                yield from self.read_block(f, broker_account_id, offset)
+
+    def __getitem__(self, broker_account_id):
+        return self.iter_account(broker_account_id)
+
+    def values(self):
+        return (self.iter_account(broker_account_id) for broker_account_id in self.blocks)
+# end class OperationsFile()
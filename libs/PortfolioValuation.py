@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+from datetime import date
+from .DuplicateIndex import zpdate_to_local_day
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# ZSECURITYPRICE.ZPDATE counts days since 1970-01-01
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def day_to_unix_day(day):
+    return day.toordinal() - UNIX_EPOCH_ORDINAL
+
+
+def unix_day_to_day(unix_day):
+    return date.fromordinal(int(unix_day) + UNIX_EPOCH_ORDINAL)
+
+
+class PortfolioValuation():
+    """Daily market value of the securities held in every account, computed with NumPy.
+
+    Holdings come from ZSECURITYLINEITEM.ZPSHARES of the security transactions, prices from the daily closes in
+    ZSECURITYPRICE. Both are laid out as dense matrices with a column per day:
+    o holdings: a row per (account, security) held at some point, the cumulative sum of the shares bought and sold
+    o prices: a row per security, days without a close carry the previous one forward
+    and the market value is holdings * prices * ZPPRICEMULTIPLIER (the par value for bonds, whose prices are
+    stored as a fraction of par).
+
+    Computed days are kept: asking for a range that extends the computed one only computes the new days, starting
+    from the holdings and prices of the last computed day. With a ReadModel, the days are also stored in its
+    valuation_snapshots, so the next run starts from the days computed before. The read model drops them when the
+    transactions or prices of the document change.
+    """
+
+    SQL_SECURITY_LINEITEMS = """
+    SELECT
+          li.ZPACCOUNT
+        , sli.ZPSECURITY
+        , t.ZPDATE
+        , sli.ZPSHARES
+        , sli.ZPPRICEMULTIPLIER
+    FROM
+        ZSECURITYLINEITEM sli
+    JOIN
+        ZLINEITEM li
+    ON (sli.ZPLINEITEM = li.Z_PK)
+    JOIN
+        ZTRANSACTION t
+    ON (li.ZPTRANSACTION = t.Z_PK)
+    WHERE
+        sli.ZPSHARES IS NOT NULL
+    ORDER BY
+        t.ZPDATE
+    """
+
+    def __init__(self, banktivity, read_model=None):
+        if np is None:
+            print("ERROR: NumPy is required for portfolio valuation (pip3 install numpy). Aborting.")
+            exit(1)
+        self.banktivity = banktivity
+        self.read_model = read_model
+        self.load_transactions()
+        self.load_prices()
+        self.first_day = None  # unix day of the first computed column
+        self.holdings = np.zeros((len(self.pairs), 0))
+        self.prices = np.zeros((len(self.securities), 0))
+        if read_model is not None:
+            self.load_snapshots()
+
+    def load_snapshots(self):
+        """Take the days stored in the read model by an earlier run, if they are a contiguous range of this
+        document's pairs and securities."""
+        snapshots = self.read_model.valuation_snapshots()
+        if not snapshots or snapshots[-1][0] - snapshots[0][0] != len(snapshots) - 1:
+            return
+        holdings = [np.frombuffer(holdings, dtype=np.float64) for _, holdings, _ in snapshots]
+        prices = [np.frombuffer(prices, dtype=np.float64) for _, _, prices in snapshots]
+        if len(holdings[0]) != len(self.pairs) or len(prices[0]) != len(self.securities):
+            return
+        self.first_day = snapshots[0][0]
+        self.holdings = np.stack(holdings, axis=1)
+        self.prices = np.stack(prices, axis=1)
+
+    def store_snapshots(self, first_column, replace=False):
+        """Store the computed days from column first_column on in the read model, if there is one."""
+        if self.read_model is None:
+            return
+        self.read_model.store_valuation_snapshots(
+            [(self.first_day + column, self.holdings[:, column].tobytes(), self.prices[:, column].tobytes())
+             for column in range(first_column, self.holdings.shape[1])], replace)
+
+    def load_transactions(self):
+        cur = self.banktivity.cur
+        cur.execute(self.SQL_SECURITY_LINEITEMS)
+        rows = cur.fetchall()
+        self.pairs = sorted({(zaccount_pk, zsecurity_pk) for zaccount_pk, zsecurity_pk, _, _, _ in rows})
+        pair_index = {pair: i for i, pair in enumerate(self.pairs)}
+        self.securities = sorted({zsecurity_pk for _, zsecurity_pk in self.pairs})
+        self.security_index = {zsecurity_pk: i for i, zsecurity_pk in enumerate(self.securities)}
+        self.pair_security = np.array([self.security_index[zsecurity_pk] for _, zsecurity_pk in self.pairs],
+                                      dtype=np.int64)
+
+        # Per security the multiplier of its latest transaction (rows are in date order)
+        self.multipliers = np.ones(len(self.securities))
+        for _, zsecurity_pk, _, _, zppricemultiplier in rows:
+            if zppricemultiplier:
+                self.multipliers[self.security_index[zsecurity_pk]] = zppricemultiplier
+
+        self.delta_pair = np.array([pair_index[(zaccount_pk, zsecurity_pk)] for zaccount_pk, zsecurity_pk, _, _, _ in rows],
+                                   dtype=np.int64)
+        self.delta_day = np.array([day_to_unix_day(zpdate_to_local_day(zpdate)) for _, _, zpdate, _, _ in rows],
+                                  dtype=np.int64)
+        self.delta_shares = np.array([zpshares for _, _, _, zpshares, _ in rows], dtype=np.float64)
+
+    def load_prices(self):
+        """Closes of the securities as (security row, unix day, close) arrays sorted by security and day."""
+        price_item_rows = {self.banktivity.get_zsecuritypriceitem_pk_by_zsecurity(zsecurity_pk): i
+                           for i, zsecurity_pk in enumerate(self.securities)}
+        price_item_rows.pop(None, None)
+        rows = []
+        if price_item_rows:
+            cur = self.banktivity.cur
+            cur.execute(
+                f"SELECT ZPSECURITYPRICEITEM, ZPDATE, ZPCLOSEPRICE FROM ZSECURITYPRICE "
+                f"WHERE ZPSECURITYPRICEITEM IN ({', '.join('?' * len(price_item_rows))}) AND ZPCLOSEPRICE IS NOT NULL",
+                list(price_item_rows))
+            rows = cur.fetchall()
+        security = np.array([price_item_rows[zsecuritypriceitem_pk] for zsecuritypriceitem_pk, _, _ in rows],
+                            dtype=np.int64)
+        day = np.array([zpdate for _, zpdate, _ in rows], dtype=np.int64)
+        close = np.array([zpcloseprice for _, _, zpcloseprice in rows], dtype=np.float64)
+        order = np.lexsort((day, security))
+        self.price_security, self.price_day, self.price_close = security[order], day[order], close[order]
+
+    def compute(self, first_day, last_day, opening_holdings, opening_prices):
+        """Holdings and prices matrices for unix days first_day..last_day, starting from the given values of the day
+        before."""
+        days = last_day - first_day + 1
+
+        deltas = np.zeros((len(self.pairs), days))
+        in_range = (self.delta_day >= first_day) & (self.delta_day <= last_day)
+        np.add.at(deltas, (self.delta_pair[in_range], self.delta_day[in_range] - first_day), self.delta_shares[in_range])
+        holdings = opening_holdings[:, None] + np.cumsum(deltas, axis=1)
+
+        # Forward fill: every cell takes the close of the latest day with a price, the opening price before that
+        prices = np.full((len(self.securities), days + 1), np.nan)
+        prices[:, 0] = opening_prices
+        in_range = (self.price_day >= first_day) & (self.price_day <= last_day)
+        prices[self.price_security[in_range], self.price_day[in_range] - first_day + 1] = self.price_close[in_range]
+        known = np.where(np.isnan(prices), 0, np.arange(days + 1))
+        prices = np.take_along_axis(prices, np.maximum.accumulate(known, axis=1), axis=1)[:, 1:]
+        return holdings, prices
+
+    def opening(self, first_day):
+        """Holdings and prices at the end of the day before the unix day first_day, from the transactions and
+        closes."""
+        holdings = np.zeros(len(self.pairs))
+        before = self.delta_day < first_day
+        np.add.at(holdings, self.delta_pair[before], self.delta_shares[before])
+
+        prices = np.full(len(self.securities), np.nan)
+        before = self.price_day < first_day
+        # Last close per security before the day: arrays are sorted by security and day
+        security = self.price_security[before]
+        if len(security):
+            last = np.r_[security[1:] != security[:-1], True]
+            prices[security[last]] = self.price_close[before][last]
+        return holdings, prices
+
+    def ensure(self, first_day, last_day):
+        """Make sure the unix days first_day..last_day are computed."""
+        if self.first_day is None or first_day < self.first_day:
+            # Nothing computed yet or the range starts earlier: compute from scratch
+            computed_last_day = self.first_day + self.holdings.shape[1] - 1 if self.first_day is not None else last_day
+            self.first_day = first_day
+            self.holdings, self.prices = self.compute(first_day, max(last_day, computed_last_day),
+                                                      *self.opening(first_day))
+            self.store_snapshots(0, replace=True)
+            return
+
+        computed_last_day = self.first_day + self.holdings.shape[1] - 1
+        if last_day > computed_last_day:
+            holdings, prices = self.compute(computed_last_day + 1, last_day,
+                                            self.holdings[:, -1], self.prices[:, -1])
+            self.holdings = np.concatenate((self.holdings, holdings), axis=1)
+            self.prices = np.concatenate((self.prices, prices), axis=1)
+            self.store_snapshots(computed_last_day - self.first_day + 1)
+
+    def values(self, first, last):
+        """Market values for the days first..last (dates): (list of days, list of (ZACCOUNT Z_PK, ZSECURITY Z_PK)
+        pairs, matrix of values with a row per pair and a column per day). Securities without a known price yet are
+        worth 0."""
+        first_day, last_day = day_to_unix_day(first), day_to_unix_day(last)
+        self.ensure(first_day, last_day)
+        columns = slice(first_day - self.first_day, last_day - self.first_day + 1)
+        values = self.holdings[:, columns] * self.prices[self.pair_security, columns] * \
+            self.multipliers[self.pair_security][:, None]
+        days = [unix_day_to_day(day) for day in range(first_day, last_day + 1)]
+        return days, self.pairs, np.nan_to_num(values)
+
+    def account_values(self, first, last):
+        """Dict of ZACCOUNT Z_PK -> array of the daily market value of its securities for the days first..last."""
+        _, pairs, values = self.values(first, last)
+        accounts = sorted({zaccount_pk for zaccount_pk, _ in pairs})
+        account_rows = np.array([accounts.index(zaccount_pk) for zaccount_pk, _ in pairs], dtype=np.int64)
+        totals = np.zeros((len(accounts), values.shape[1]))
+        np.add.at(totals, account_rows, values)
+        return dict(zip(accounts, totals))
+
+    def security_values(self, first, last):
+        """Dict of (ZACCOUNT Z_PK, ZSECURITY Z_PK) -> array of daily market values for the days first..last."""
+        _, pairs, values = self.values(first, last)
+        return dict(zip(pairs, values))
+# end class PortfolioValuation()
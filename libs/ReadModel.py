@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+from datetime import datetime
+from os.path import expanduser
+from pathlib import Path
+from .BalanceEngine import SQL_CASH_AMOUNT
+from .Banktivity import Banktivity
+import os
+import sqlite3
+
+
+def readmodel_path(banktivity_file):
+    """Path of the read model cache of a document: next to the .bank7 bundle, like the importer's sidecar."""
+    return expanduser(banktivity_file).rstrip('/') + '.readmodel.sqlite'
+
+
+def file_uri(path, mode=None):
+    """SQLite file: URI of a path, with the characters URIs reserve quoted, for connections opened with uri=True."""
+    uri = Path(os.path.abspath(path)).as_uri()
+    return f"{uri}?mode={mode}" if mode else uri
+
+
+# Local calendar day of ZTRANSACTION.ZPDATE, see DuplicateIndex.zpdate_to_local_day()
+SQL_LOCAL_DAY = "DATE(978307200 + t.ZPDATE, 'unixepoch', 'localtime')"
+
+
+class ReadModel():
+    """Pre-aggregated data of a Banktivity document for reports, cached in a sidecar SQLite file.
+
+    o monthly_totals: per account (categories are accounts too) and local month, the sum and number of line items.
+      Amounts are cash effects, with the ZPAMOUNT of Buy/Sell and the ZPINCOME of Investment Inc. security line
+      items (see BalanceEngine.SQL_CASH_AMOUNT)
+    o category_totals: per account, category and month, the sum of the transactions' category line items, from the
+      account's side (an expense is negative). A transaction with several PrimaryAccount line items (a transfer) is
+      counted for the first one only
+    o positions: per account, security and day with trades, the shares traded that day and the position after it
+    o valuation_snapshots: daily holdings and prices computed by PortfolioValuation, which fills it (here it's only
+      cleared when its entities change)
+
+    The document is attached read-only to the cache's connection and the models are built with INSERT ... SELECT.
+
+    Every query checks first that the cache is current, so stale data is never served. The fingerprint is the size
+    and modification time of core.sql (and of its WAL file, which takes the writes first in WAL mode) plus Z_MAX of
+    every entity in Z_PRIMARYKEY. When both are unchanged, nothing is read from the document. When the file changed,
+    each entity the models read is fingerprinted with its Z_MAX, COUNT(*), SUM(Z_OPT) and a checksum of the columns
+    the models read (ENTITY_COLUMNS): Z_MAX moves on inserts, the count on deletes, Core Data bumps Z_OPT on every
+    edit and the checksum catches in-place UPDATEs that don't bump Z_OPT (like the importer's). Only the models
+    reading a changed entity are rebuilt. If the file changed and no entity did, the change is in something the
+    fingerprints don't cover and all models are rebuilt.
+    """
+
+    SCHEMA = 'core'
+
+    # Model -> entities (Z_PRIMARYKEY.Z_NAME) it reads
+    MODELS = {
+        'monthly_totals': ('Account', 'LineItem', 'SecurityLineItem', 'Transaction'),
+        'category_totals': ('Account', 'LineItem', 'Transaction'),
+        'positions': ('LineItem', 'SecurityLineItem', 'Transaction'),
+        'valuation_snapshots': ('LineItem', 'SecurityLineItem', 'SecurityPrice', 'SecurityPriceItem', 'Transaction'),
+    }
+
+    # Entity -> numeric columns the models read, checksummed by entity_fingerprints()
+    ENTITY_COLUMNS = {
+        'Account': (),
+        'LineItem': ('ZPACCOUNT', 'Z1_PACCOUNT', 'ZPTRANSACTION', 'ZPTRANSACTIONAMOUNT'),
+        'SecurityLineItem': ('ZPLINEITEM', 'ZPSECURITY', 'ZPSHARES', 'ZPAMOUNT', 'ZPINCOME', 'ZPPRICEMULTIPLIER'),
+        'SecurityPrice': ('ZPSECURITYPRICEITEM', 'ZPDATE', 'ZPCLOSEPRICE'),
+        'SecurityPriceItem': (),
+        'Transaction': ('ZPDATE',),
+    }
+
+    SQL_MONTHLY_TOTALS = f"""
+    INSERT INTO monthly_totals (zaccount_pk, month, amount, lineitems)
+    SELECT
+          li.ZPACCOUNT
+        , SUBSTR({SQL_LOCAL_DAY}, 1, 7)
+        , SUM({SQL_CASH_AMOUNT})
+        , COUNT(*)
+    FROM
+        core.ZLINEITEM li
+    JOIN
+        core.ZTRANSACTION t
+    ON (li.ZPTRANSACTION = t.Z_PK)
+    LEFT JOIN
+        core.ZSECURITYLINEITEM sli
+    ON (sli.ZPLINEITEM = li.Z_PK)
+    WHERE
+        li.ZPACCOUNT IS NOT NULL
+    GROUP BY
+        1, 2
+    """
+
+    SQL_CATEGORY_TOTALS = f"""
+    INSERT INTO category_totals (zaccount_pk, category_zaccount_pk, month, amount, lineitems)
+    SELECT
+          li.ZPACCOUNT
+        , cli.ZPACCOUNT
+        , SUBSTR({SQL_LOCAL_DAY}, 1, 7)
+        , SUM(-COALESCE(cli.ZPTRANSACTIONAMOUNT, 0))
+        , COUNT(*)
+    FROM
+        core.ZLINEITEM cli
+    JOIN
+        core.ZTRANSACTION t
+    ON (cli.ZPTRANSACTION = t.Z_PK)
+    JOIN
+        core.ZLINEITEM li
+    ON (li.Z_PK = (SELECT MIN(Z_PK) FROM core.ZLINEITEM WHERE ZPTRANSACTION = t.Z_PK AND Z1_PACCOUNT = :primaryaccount))
+    WHERE
+            cli.Z1_PACCOUNT = :category
+        AND cli.ZPACCOUNT IS NOT NULL
+    GROUP BY
+        1, 2, 3
+    """
+
+    SQL_POSITIONS = f"""
+    INSERT INTO positions (zaccount_pk, zsecurity_pk, day, shares, position)
+    SELECT
+          zaccount_pk
+        , zsecurity_pk
+        , day
+        , shares
+        , SUM(shares) OVER (PARTITION BY zaccount_pk, zsecurity_pk ORDER BY day)
+    FROM (
+        SELECT
+              li.ZPACCOUNT AS zaccount_pk
+            , sli.ZPSECURITY AS zsecurity_pk
+            , {SQL_LOCAL_DAY} AS day
+            , SUM(sli.ZPSHARES) AS shares
+        FROM
+            core.ZSECURITYLINEITEM sli
+        JOIN
+            core.ZLINEITEM li
+        ON (sli.ZPLINEITEM = li.Z_PK)
+        JOIN
+            core.ZTRANSACTION t
+        ON (li.ZPTRANSACTION = t.Z_PK)
+        WHERE
+            sli.ZPSHARES IS NOT NULL
+        GROUP BY
+            1, 2, 3
+    )
+    """
+
+    def __init__(self, banktivity_file):
+        self.core_sql_path = expanduser(f"{banktivity_file}/StoreContent/core.sql")
+        # URI filenames are enabled by the connection, not left to SQLite's compile-time default: otherwise the
+        # document's URI would be taken as a file name and an empty database created under it
+        self.con = sqlite3.connect(file_uri(readmodel_path(banktivity_file)), uri=True, isolation_level=None)
+        self.con.execute(f"PRAGMA busy_timeout = {Banktivity.BUSY_TIMEOUT}")
+        self.con.execute(f"ATTACH DATABASE ? AS {self.SCHEMA}", (file_uri(self.core_sql_path, 'ro'),))
+        self.cur = self.con.cursor()
+        self.cur.execute("""
+        CREATE TABLE IF NOT EXISTS fingerprints (
+              name TEXT PRIMARY KEY
+            , value TEXT NOT NULL
+        )
+        """)
+        self.cur.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_totals (
+              zaccount_pk INTEGER NOT NULL
+            , month TEXT NOT NULL
+            , amount REAL NOT NULL
+            , lineitems INTEGER NOT NULL
+            , PRIMARY KEY (zaccount_pk, month)
+        ) WITHOUT ROWID
+        """)
+        self.cur.execute("""
+        CREATE TABLE IF NOT EXISTS category_totals (
+              zaccount_pk INTEGER NOT NULL
+            , category_zaccount_pk INTEGER NOT NULL
+            , month TEXT NOT NULL
+            , amount REAL NOT NULL
+            , lineitems INTEGER NOT NULL
+            , PRIMARY KEY (zaccount_pk, category_zaccount_pk, month)
+        ) WITHOUT ROWID
+        """)
+        self.cur.execute("""
+        CREATE TABLE IF NOT EXISTS positions (
+              zaccount_pk INTEGER NOT NULL
+            , zsecurity_pk INTEGER NOT NULL
+            , day TEXT NOT NULL
+            , shares REAL NOT NULL
+            , position REAL NOT NULL
+            , PRIMARY KEY (zaccount_pk, zsecurity_pk, day)
+        ) WITHOUT ROWID
+        """)
+        self.cur.execute("""
+        CREATE TABLE IF NOT EXISTS valuation_snapshots (
+              day INTEGER PRIMARY KEY
+            , holdings BLOB NOT NULL
+            , prices BLOB NOT NULL
+        )
+        """)
+
+    def close(self):
+        self.con.close()
+
+    def file_fingerprint(self):
+        """Size and modification time of core.sql and its WAL file."""
+        parts = []
+        for path in (self.core_sql_path, self.core_sql_path + '-wal'):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+        return '|'.join(parts)
+
+    def entity_fingerprints(self, entities):
+        """Dict of entity -> 'Z_MAX:COUNT(*):SUM(Z_OPT):checksums' of its table, one scan per entity. The checksum of
+        a column weighs every value with its row's Z_PK, so a value moved to another row changes it too."""
+        cur = self.cur
+        cur.execute(f"SELECT Z_NAME, Z_MAX FROM {self.SCHEMA}.Z_PRIMARYKEY")
+        z_max = dict(cur.fetchall())
+        fingerprints = {}
+        for entity in entities:
+            checksums = ''.join(f", TOTAL((Z_PK % 997 + 1) * COALESCE({column}, 0))"
+                                for column in self.ENTITY_COLUMNS[entity])
+            cur.execute(f"SELECT COUNT(*), TOTAL(Z_OPT){checksums} FROM {self.SCHEMA}.{Banktivity.Z_PK_TABLES[entity]}")
+            count, z_opt, *column_checksums = cur.fetchone()
+            fingerprints[entity] = ':'.join([str(z_max.get(entity)), str(count), str(int(z_opt))] +
+                                            [repr(checksum) for checksum in column_checksums])
+        return fingerprints
+
+    def refresh(self):
+        """Rebuild the models whose entities changed since they were built. Returns the list of rebuilt models."""
+        file_fingerprint = self.file_fingerprint()
+        cur = self.cur
+        cur.execute("BEGIN")
+        try:
+            cur.execute("SELECT name, value FROM fingerprints")
+            stored = dict(cur.fetchall())
+            cur.execute(f"SELECT Z_NAME, Z_MAX FROM {self.SCHEMA}.Z_PRIMARYKEY ORDER BY Z_NAME")
+            z_max = ','.join(f"{z_name}={value}" for z_name, value in cur.fetchall())
+            if stored.get('file') == file_fingerprint and stored.get('z_max') == z_max and \
+                    all(f"model:{model}" in stored for model in self.MODELS):
+                cur.execute("COMMIT")
+                return []
+
+            entities = sorted({entity for model_entities in self.MODELS.values() for entity in model_entities})
+            fingerprints = self.entity_fingerprints(entities)
+            # The file changed but none of the fingerprinted entities did: rebuild all rather than risk stale data
+            unexplained = 'file' in stored and stored['file'] != file_fingerprint and all(
+                stored.get(f"entity:{entity}") == fingerprint for entity, fingerprint in fingerprints.items())
+            rebuilt = []
+            for model, model_entities in self.MODELS.items():
+                if not unexplained and f"model:{model}" in stored and all(
+                        stored.get(f"entity:{entity}") == fingerprints[entity] for entity in model_entities):
+                    continue
+                cur.execute(f"DELETE FROM {model}")
+                if model == 'category_totals':
+                    cur.execute(
+                        f"SELECT Z_NAME, Z_ENT FROM {self.SCHEMA}.Z_PRIMARYKEY WHERE Z_NAME IN ('PrimaryAccount', 'Category')")
+                    z_ents = dict(cur.fetchall())
+                    cur.execute(self.SQL_CATEGORY_TOTALS,
+                                {'primaryaccount': z_ents.get('PrimaryAccount'), 'category': z_ents.get('Category')})
+                elif model == 'valuation_snapshots':
+                    pass  # filled by PortfolioValuation as it computes days
+                else:
+                    cur.execute(getattr(self, f"SQL_{model.upper()}"))
+                rebuilt.append(model)
+
+            updated_at = datetime.now().astimezone().isoformat()
+            cur.executemany("INSERT OR REPLACE INTO fingerprints (name, value) VALUES (?, ?)",
+                            [('file', file_fingerprint), ('z_max', z_max)] +
+                            [(f"entity:{entity}", fingerprint) for entity, fingerprint in fingerprints.items()] +
+                            [(f"model:{model}", updated_at) for model in rebuilt])
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        return rebuilt
+
+    def monthly_totals(self, zaccount_pk=None, first_month=None, last_month=None):
+        """List of (ZACCOUNT Z_PK, 'YYYY-MM', amount, line items) of the account (all if None) for the months
+        first_month..last_month ('YYYY-MM', inclusive, open if None)."""
+        self.refresh()
+        self.cur.execute("""
+        SELECT zaccount_pk, month, amount, lineitems FROM monthly_totals
+        WHERE (:zaccount_pk IS NULL OR zaccount_pk = :zaccount_pk)
+          AND (:first_month IS NULL OR month >= :first_month)
+          AND (:last_month IS NULL OR month <= :last_month)
+        ORDER BY zaccount_pk, month
+        """, {'zaccount_pk': zaccount_pk, 'first_month': first_month, 'last_month': last_month})
+        return self.cur.fetchall()
+
+    def category_totals(self, zaccount_pk=None, first_month=None, last_month=None):
+        """List of (ZACCOUNT Z_PK, category ZACCOUNT Z_PK, 'YYYY-MM', amount, line items), see monthly_totals()."""
+        self.refresh()
+        self.cur.execute("""
+        SELECT zaccount_pk, category_zaccount_pk, month, amount, lineitems FROM category_totals
+        WHERE (:zaccount_pk IS NULL OR zaccount_pk = :zaccount_pk)
+          AND (:first_month IS NULL OR month >= :first_month)
+          AND (:last_month IS NULL OR month <= :last_month)
+        ORDER BY zaccount_pk, category_zaccount_pk, month
+        """, {'zaccount_pk': zaccount_pk, 'first_month': first_month, 'last_month': last_month})
+        return self.cur.fetchall()
+
+    def position_series(self, zaccount_pk, zsecurity_pk):
+        """List of (day, shares traded, position after the day) of the security in the account, days are ISO
+        dates."""
+        self.refresh()
+        self.cur.execute("SELECT day, shares, position FROM positions WHERE zaccount_pk = ? AND zsecurity_pk = ? "
+                         "ORDER BY day", (zaccount_pk, zsecurity_pk))
+        return self.cur.fetchall()
+
+    def positions_at(self, day):
+        """Dict of (ZACCOUNT Z_PK, ZSECURITY Z_PK) -> shares held at the end of the day (a date), closed positions
+        left out."""
+        self.refresh()
+        self.cur.execute("""
+        SELECT zaccount_pk, zsecurity_pk, position FROM positions p
+        WHERE day = (SELECT MAX(day) FROM positions WHERE zaccount_pk = p.zaccount_pk AND zsecurity_pk = p.zsecurity_pk
+                                                     AND day <= ?)
+        """, (day.isoformat(),))
+        return {(zaccount_pk, zsecurity_pk): position for zaccount_pk, zsecurity_pk, position in self.cur.fetchall()
+                if abs(position) > 1e-9}
+
+    def valuation_snapshots(self):
+        """List of (unix day, holdings, prices) stored by store_valuation_snapshots() in day order, empty if the
+        document changed since."""
+        self.refresh()
+        self.cur.execute("SELECT day, holdings, prices FROM valuation_snapshots ORDER BY day")
+        return self.cur.fetchall()
+
+    def store_valuation_snapshots(self, snapshots, replace=False):
+        """Store (unix day, holdings, prices) snapshots, the arrays as bytes. With replace, the stored ones are
+        dropped first."""
+        cur = self.cur
+        cur.execute("BEGIN")
+        try:
+            if replace:
+                cur.execute("DELETE FROM valuation_snapshots")
+            cur.executemany("INSERT OR REPLACE INTO valuation_snapshots (day, holdings, prices) VALUES (?, ?, ?)",
+                            snapshots)
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+# end class ReadModel()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+from time import perf_counter
+import csv
+import json
+import math
+import os
+import sqlite3
+import sys
+
+
+LIBS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SQLProfiler():
+    """Collects execution statistics of SQL statements run through ProfilingCursor.
+
+    Statements are grouped by template (the SQL text with whitespace collapsed, parameters are bound separately) and
+    by the library method the statement was run from. For nested calls the outermost method of libs/ is used, e.g.
+    statements of zlineitem_values() called from add_transactions_bulk() count towards add_transactions_bulk().
+    Time includes fetching the rows.
+    """
+
+    def __init__(self):
+        self.samples = {}  # (method, template) -> list of [seconds, rows]
+        self.templates = {}  # SQL text -> template
+        self.library_code = {}  # code object -> True if it belongs to libs/
+
+    def cursor(self, con):
+        cur = con.cursor(ProfilingCursor)
+        cur.profiler = self
+        return cur
+
+    def is_library_code(self, code):
+        if code not in self.library_code:
+            self.library_code[code] = os.path.dirname(os.path.abspath(code.co_filename)) == LIBS_DIR
+        return self.library_code[code]
+
+    def calling_method(self):
+        # Skip frames of this module, then take the outermost of the consecutive libs/ frames
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename == __file__:
+            frame = frame.f_back
+        method = None
+        while frame is not None and self.is_library_code(frame.f_code):
+            method = frame.f_code.co_name
+            frame = frame.f_back
+        if method is None:
+            method = frame.f_code.co_name if frame is not None else '<unknown>'
+        return method
+
+    def start(self, sql):
+        """Register an execution of the statement and return its sample to be updated with time and rows."""
+        template = self.templates.get(sql)
+        if template is None:
+            template = self.templates[sql] = ' '.join(sql.split())
+        sample = [0.0, 0]
+        self.samples.setdefault((self.calling_method(), template), []).append(sample)
+        return sample
+
+    def statistics(self):
+        """List of dicts with statistics per (method, statement), the most expensive first."""
+        statistics = []
+        for (method, template), samples in self.samples.items():
+            seconds = sorted(sample[0] for sample in samples)
+            statistics.append({
+                'method': method,
+                'statement': template,
+                'calls': len(seconds),
+                'total_s': sum(seconds),
+                'mean_ms': 1000 * sum(seconds) / len(seconds),
+                'p95_ms': 1000 * seconds[max(math.ceil(0.95 * len(seconds)) - 1, 0)],
+                'rows': sum(sample[1] for sample in samples),
+            })
+        statistics.sort(key=lambda item: item['total_s'], reverse=True)
+        return statistics
+
+    def summary(self, limit=20):
+        statistics = self.statistics()
+        methods = {}
+        for item in statistics:
+            method = methods.setdefault(item['method'], {'calls': 0, 'total_s': 0.0, 'rows': 0})
+            for key in method:
+                method[key] += item[key]
+
+        lines = [f"SQL profile: {sum(item['calls'] for item in statistics)} statements, "
+                 f"{sum(item['total_s'] for item in statistics):.3f} s total", "", "By method:",
+                 f"{'total s':>10} {'calls':>8} {'rows':>10}  method"]
+        for name, method in sorted(methods.items(), key=lambda item: item[1]['total_s'], reverse=True):
+            lines.append(f"{method['total_s']:>10.3f} {method['calls']:>8} {method['rows']:>10}  {name}")
+
+        lines += ["", f"By statement (top {limit} by total time):",
+                  f"{'total s':>10} {'calls':>8} {'mean ms':>8} {'p95 ms':>8} {'rows':>10}  method: statement"]
+        for item in statistics[:limit]:
+            statement = item['statement'] if len(item['statement']) <= 120 else item['statement'][:117] + '...'
+            lines.append(f"{item['total_s']:>10.3f} {item['calls']:>8} {item['mean_ms']:>8.3f} {item['p95_ms']:>8.3f} "
+                         f"{item['rows']:>10}  {item['method']}: {statement}")
+        return "\n".join(lines)
+
+    def report(self, path=None):
+        """Print the summary or export statistics to a .csv or .json file."""
+        if not path:
+            print(self.summary())
+            return
+
+        statistics = self.statistics()
+        path = os.path.expanduser(path)
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.json'):
+                json.dump(statistics, f, ensure_ascii=False, indent=1)
+            else:
+                writer = csv.DictWriter(f, fieldnames=list(statistics[0].keys()) if statistics else ['method'])
+                writer.writeheader()
+                writer.writerows(statistics)
+        print(f"SQL profile written to {path}")
+# end class SQLProfiler()
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """sqlite3 cursor recording every statement and the rows fetched from it in SQLProfiler."""
+    profiler = None
+    sample = None
+
+    def execute(self, sql, parameters=()):
+        self.sample = self.profiler.start(sql)
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.sample[0] += perf_counter() - started
+            if self.description is None:
+                self.sample[1] += max(self.rowcount, 0)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sample = self.profiler.start(sql)
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.sample[0] += perf_counter() - started
+            self.sample[1] += max(self.rowcount, 0)
+
+    def fetchone(self):
+        started = perf_counter()
+        row = super().fetchone()
+        self.sample[0] += perf_counter() - started
+        if row is not None:
+            self.sample[1] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.sample[0] += perf_counter() - started
+        self.sample[1] += len(rows)
+        return rows
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = super().fetchall()
+        self.sample[0] += perf_counter() - started
+        self.sample[1] += len(rows)
+        return rows
+
+    def __next__(self):
+        started = perf_counter()
+        try:
+            row = super().__next__()
+        finally:
+            self.sample[0] += perf_counter() - started
+        self.sample[1] += 1
+        return row
+# end class ProfilingCursor()
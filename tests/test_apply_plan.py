@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import contextlib
+import importlib.util
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from benchmarks.generator import generate_document
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ACCOUNT = 'Тинькофф - Брокер RUB'
+BROKER_ACCOUNT_ID = 'A1'
+
+
+def load_importer():
+    """The importer script as a module, or None if its dependencies (keyring, pytz, the OpenAPI client) are missing.
+    It reads settings.ini from the working directory on import."""
+    spec = importlib.util.spec_from_file_location('importer_tinkoff_api', os.path.join(ROOT, 'importer-tinkoff-api.py'))
+    module = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError:
+        return None
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+importer = load_importer()
+
+
+def payin(operation_id, zpdate, amount):
+    """Plan item of a PayIn operation, as plan_operations() makes it."""
+    return {
+        'type': 'transaction', 'broker_account_id': BROKER_ACCOUNT_ID, 'operation_id': operation_id,
+        'operation_type': 'PayIn',
+        'data': {
+            'transaction_account_name': ACCOUNT,
+            'transaction_type': 'Deposit',
+            'transaction_category_name': None,
+            'zpnote': f"Test deposit ({amount} RUB)",
+            'transaction_currency_code': 'RUB',
+            'zpadjustment': None,
+            'zpchecknumber': 0,
+            'zpdate': zpdate,
+            'zptitle': None,
+            'zptransactionamount': amount,
+        },
+    }
+
+
+def watermark(operation_id, operation_date):
+    return {'type': 'watermark', 'broker_account_id': BROKER_ACCOUNT_ID, 'operation_id': operation_id,
+            'operation_date': operation_date}
+
+
+@unittest.skipIf(importer is None, "the importer's dependencies are not installed")
+class ApplyPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.document = os.path.join(self.directory.name, 'apply.bank7')
+        generate_document(self.document, transactions=500, securities=5, price_days=5)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def apply(self, plan, incremental=False):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            importer.apply_document(self.document, plan, False, None, incremental)
+        return output.getvalue()
+
+    def count_transactions(self, zpnote):
+        con = sqlite3.connect(os.path.join(self.document, 'StoreContent', 'core.sql'))
+        try:
+            return con.execute("SELECT COUNT(*) FROM ZTRANSACTION WHERE ZPNOTE = ?", (zpnote,)).fetchone()[0]
+        finally:
+            con.close()
+
+    def test_ledgered_transaction_is_not_a_duplicate_of_a_new_operation(self):
+        first = payin('100', '2026-04-01T12:00:00+03:00', 1000.0)
+        self.apply([first])
+        self.assertEqual(1, self.count_transactions(first['data']['zpnote']))
+
+        # A second deposit of the same amount on the same day: the first one is skipped by the ledger and its
+        # transaction must not be taken as the duplicate of the second
+        self.apply([first, payin('101', '2026-04-01T15:00:00+03:00', 1000.0)])
+        self.assertEqual(2, self.count_transactions(first['data']['zpnote']))
+
+    def test_existing_transaction_without_ledger_entry_is_a_duplicate(self):
+        # Operations with ID -1 are not in the ledger and are found by the duplicate check only
+        item = payin('-1', '2026-04-01T12:00:00+03:00', 1000.0)
+        self.apply([item])
+        output = self.apply([item])
+        self.assertIn('Possible duplicate found', output)
+        self.assertEqual(1, self.count_transactions(item['data']['zpnote']))
+
+    def test_watermarked_transaction_is_not_a_duplicate_of_a_new_operation(self):
+        # PayIns come with ID -1, so only the watermark tells the first one was imported
+        first = payin('-1', '2026-04-01T12:00:00+03:00', 1000.0)
+        self.apply([first, watermark('-1', first['data']['zpdate'])], incremental=True)
+        self.assertEqual(1, self.count_transactions(first['data']['zpnote']))
+
+        # The next incremental import sees the first one again in the overlap, then a new one of the same day
+        second = payin('-1', '2026-04-01T15:00:00+03:00', 1000.0)
+        output = self.apply([first, second, watermark('-1', second['data']['zpdate'])], incremental=True)
+        self.assertIn('not newer than the watermark', output)
+        self.assertEqual(2, self.count_transactions(first['data']['zpnote']))
+
+    def test_resume_after_a_failure(self):
+        first = payin('-1', '2026-04-01T10:00:00+03:00', 1000.0)
+        other = payin('200', '2026-04-01T11:00:00+03:00', 500.0)
+        third = payin('-1', '2026-04-01T12:00:00+03:00', 1000.0)
+        plan = [first, other, third]
+        resolve_transaction_data = importer.resolve_transaction_data
+
+        def fail_on_third(transaction_data):
+            if transaction_data['zpdate'] == third['data']['zpdate']:
+                raise RuntimeError("apply interrupted")
+            return resolve_transaction_data(transaction_data)
+
+        # A checkpoint after every transaction: the first two are committed before the third one fails
+        with mock.patch.object(importer, 'checkpoint_operations', 1), \
+                mock.patch.object(importer, 'resolve_transaction_data', fail_on_third):
+            with self.assertRaises(RuntimeError):
+                self.apply(plan)
+        self.assertEqual(1, self.count_transactions(first['data']['zpnote']))
+        self.assertEqual(1, self.count_transactions(other['data']['zpnote']))
+
+        # The resumed apply starts at the third one, which the first one (applied, not in the ledger) doesn't match
+        output = self.apply(plan)
+        self.assertIn('Resuming the plan from item 2', output)
+        self.assertEqual(2, self.count_transactions(first['data']['zpnote']))
+        self.assertEqual(1, self.count_transactions(other['data']['zpnote']))
+
+        # Applied completely: the cursor is cleared and the next apply checks every operation again
+        output = self.apply(plan)
+        self.assertNotIn('Resuming', output)
+        self.assertEqual(2, self.count_transactions(first['data']['zpnote']))
+
+
+if __name__ == '__main__':
+    unittest.main()
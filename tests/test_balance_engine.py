@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import os
+import random
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+from benchmarks.generator import generate_document
+from benchmarks.suite import INCOME_CATEGORY, deposit, security_transaction
+from libs.BalanceEngine import BalanceEngine
+from libs.Banktivity import Banktivity
+
+
+def reference_balances(banktivity):
+    """ZLINEITEM Z_PK -> running balance of every PrimaryAccount line item, summed row by row in register order."""
+    banktivity.cur.execute("""
+    SELECT li.Z_PK, li.ZPACCOUNT, t.ZPDATE, COALESCE(li.ZPINTRADAYSORTINDEX, 0), li.ZPTRANSACTIONAMOUNT, sli.ZPAMOUNT,
+           sli.ZPINCOME
+    FROM ZLINEITEM li
+    JOIN ZTRANSACTION t ON (li.ZPTRANSACTION = t.Z_PK)
+    LEFT JOIN ZSECURITYLINEITEM sli ON (sli.ZPLINEITEM = li.Z_PK)
+    WHERE li.Z1_PACCOUNT = ?
+    """, (banktivity.get_z_ent('PrimaryAccount'),))
+    balances = {}
+    running = {}
+    for z_pk, zaccount_pk, _, _, amount, security_amount, income in sorted(
+            banktivity.cur.fetchall(), key=lambda row: (row[1], row[2], row[3], row[0])):
+        # Buy/Sell and Investment Inc. line items have a zero amount, the cash is in the security line item
+        if security_amount is not None:
+            amount = (amount or 0) + security_amount
+        elif not amount and income is not None:
+            amount = income
+        running[zaccount_pk] = running.get(zaccount_pk, 0.0) + (amount or 0)
+        balances[z_pk] = running[zaccount_pk]
+    return balances, running
+
+
+class BalanceEngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.document = os.path.join(cls.directory.name, 'balances.bank7')
+        generate_document(cls.document, transactions=3000, securities=20, price_days=10)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        random.seed(1)
+        self.banktivity = Banktivity(self.document)
+
+    def tearDown(self):
+        self.banktivity.con.rollback()
+        self.banktivity.con.close()
+
+    def engine_balances(self, engine):
+        return dict(zip(engine.z_pk.tolist(), engine.balance.tolist()))
+
+    def assertBalances(self, expected, actual):
+        self.assertEqual(set(expected), set(actual))
+        for z_pk, balance in expected.items():
+            self.assertAlmostEqual(balance, actual[z_pk], places=6, msg=f"ZLINEITEM {z_pk}")
+
+    def test_load_matches_row_by_row(self):
+        engine = BalanceEngine(self.banktivity)
+        engine.load()
+        expected, final = reference_balances(self.banktivity)
+        self.assertBalances(expected, self.engine_balances(engine))
+        tomorrow = date.today() + timedelta(days=1)
+        self.assertBalances(final, engine.balances_at(tomorrow))
+
+    def test_trades_move_cash(self):
+        self.banktivity.cur.execute("""
+        SELECT COUNT(*) FROM ZLINEITEM li JOIN ZSECURITYLINEITEM sli ON (sli.ZPLINEITEM = li.Z_PK)
+        WHERE li.ZPTRANSACTIONAMOUNT = 0 AND sli.ZPAMOUNT != 0
+        """)
+        self.assertGreater(self.banktivity.cur.fetchone()[0], 0, "the document has no Buy/Sell line items")
+        engine = BalanceEngine(self.banktivity)
+        engine.load()
+        trade_cash = {z_pk: amount for z_pk, amount in zip(engine.z_pk.tolist(), engine.amount.tolist())}
+        self.banktivity.cur.execute("""
+        SELECT li.Z_PK, sli.ZPAMOUNT FROM ZLINEITEM li JOIN ZSECURITYLINEITEM sli ON (sli.ZPLINEITEM = li.Z_PK)
+        WHERE sli.ZPAMOUNT IS NOT NULL
+        """)
+        for z_pk, zpamount in self.banktivity.cur.fetchall():
+            self.assertAlmostEqual(zpamount, trade_cash[z_pk])
+
+    def test_dividends_move_cash(self):
+        dividend = security_transaction(self.banktivity, 1, 0, 20)
+        dividend.update(transaction_type='Investment Inc.', transaction_category_name=INCOME_CATEGORY,
+                        zptransactionamount=0, zpincome=1234.5, commission_amount=0)
+        coupon = dict(dividend, transaction_type='Interest Inc.', zptransactionamount=432.1, zpincome=432.1)
+        engine = BalanceEngine(self.banktivity)
+        engine.load()
+        tomorrow = date.today() + timedelta(days=1)
+        before = engine.balance_at(dividend['primaryaccount_zaccount_pk'], tomorrow)
+
+        self.banktivity.add_transactions_bulk([dividend, coupon])
+        engine.load()
+        # The dividend's cash is in ZPINCOME only, the coupon's in both ZPTRANSACTIONAMOUNT and ZPINCOME
+        self.assertAlmostEqual(before + 1234.5 + 432.1, engine.balance_at(dividend['primaryaccount_zaccount_pk'], tomorrow))
+        self.assertBalances(reference_balances(self.banktivity)[0], self.engine_balances(engine))
+
+    def test_recompute_since_without_load(self):
+        self.banktivity.cur.execute("SELECT ZPDATE FROM ZTRANSACTION ORDER BY ZPDATE LIMIT 1 OFFSET 2000")
+        since = self.banktivity.cur.fetchone()[0]
+        engine = BalanceEngine(self.banktivity)
+        engine.recompute(since)
+        expected, final = reference_balances(self.banktivity)
+        actual = self.engine_balances(engine)
+        self.assertLess(len(actual), len(expected))
+        self.assertBalances({z_pk: expected[z_pk] for z_pk in actual}, actual)
+        self.assertBalances(final, engine.balances_at(date.today() + timedelta(days=1)))
+
+    def test_recompute_after_adding_transactions(self):
+        engine = BalanceEngine(self.banktivity)
+        engine.load()
+        transactions = [deposit(self.banktivity, 1, n) for n in range(20)] + \
+                       [security_transaction(self.banktivity, 1, n, 20) for n in range(20)]
+        self.banktivity.add_transactions_bulk(transactions)
+        self.banktivity.cur.execute("SELECT MIN(ZPDATE) FROM ZTRANSACTION WHERE ZPNOTE LIKE 'Benchmark operation %'")
+        since = self.banktivity.cur.fetchone()[0]
+        engine.recompute(since)
+        self.assertBalances(reference_balances(self.banktivity)[0], self.engine_balances(engine))
+
+    def test_write_back(self):
+        engine = BalanceEngine(self.banktivity)
+        engine.load()
+        self.assertEqual(len(engine.z_pk), engine.write_back())
+        self.banktivity.cur.execute("SELECT Z_PK, ZPRUNNINGBALANCE FROM ZLINEITEM WHERE ZPRUNNINGBALANCE IS NOT NULL")
+        written = dict(self.banktivity.cur.fetchall())
+        self.assertBalances(reference_balances(self.banktivity)[0], written)
+
+
+if __name__ == '__main__':
+    unittest.main()
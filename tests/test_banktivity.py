@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from benchmarks.generator import generate_document
+from benchmarks.suite import deposit, security_transaction
+from libs.Banktivity import Banktivity
+
+
+class BulkWriteTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.document = os.path.join(cls.directory.name, 'bulk.bank7')
+        generate_document(cls.document, transactions=1000, securities=10, price_days=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        random.seed(1)
+        self.banktivity = Banktivity(self.document)
+        self.sidecar = os.path.join(self.directory.name, 'bulk.sidecar.sqlite')
+        self.banktivity.attach(self.sidecar, 'sidecar')
+        self.banktivity.cur.execute("CREATE TABLE IF NOT EXISTS sidecar.notes (note TEXT)")
+        self.banktivity.con.commit()
+
+    def tearDown(self):
+        self.banktivity.con.rollback()
+        self.banktivity.con.close()
+        os.remove(self.sidecar)
+
+    def transactions(self, count):
+        return [security_transaction(self.banktivity, 1, n, 10) if n % 2 else deposit(self.banktivity, 1, n)
+                for n in range(count)]
+
+    def max_z_pk(self, table):
+        self.banktivity.cur.execute(f"SELECT MAX(Z_PK) FROM {table}")
+        return self.banktivity.cur.fetchone()[0]
+
+    def test_reserved_z_pks_link_the_rows(self):
+        first_z_pk = self.banktivity.reserve_z_pks('Transaction', 0)
+        ztransaction_pks = self.banktivity.add_transactions_bulk(self.transactions(20))
+        self.assertEqual(list(range(first_z_pk, first_z_pk + 20)), ztransaction_pks)
+
+        cur = self.banktivity.cur
+        cur.execute("""
+        SELECT li.ZPTRANSACTION, COUNT(*), COUNT(sli.Z_PK), SUM(li.ZPSECURITYLINEITEM = sli.Z_PK)
+        FROM ZLINEITEM li LEFT JOIN ZSECURITYLINEITEM sli ON (sli.ZPLINEITEM = li.Z_PK)
+        WHERE li.ZPTRANSACTION >= ? GROUP BY li.ZPTRANSACTION
+        """, (ztransaction_pks[0],))
+        rows = cur.fetchall()
+        self.assertEqual(ztransaction_pks, [row[0] for row in rows])
+        for n, (_, line_items, security_line_items, linked) in enumerate(rows):
+            self.assertEqual(2, line_items)
+            # Security transactions have one ZSECURITYLINEITEM referenced back by its PrimaryAccount line item
+            self.assertEqual(n % 2, security_line_items)
+            self.assertEqual(n % 2, linked or 0)
+
+    def test_commit_stores_z_max(self):
+        # Committed, so on a copy of the document
+        document = os.path.join(self.directory.name, 'commit.bank7')
+        shutil.copytree(self.document, document)
+        banktivity = Banktivity(document)
+        random.seed(1)
+        banktivity.add_transactions_bulk([security_transaction(banktivity, 1, n, 10) for n in range(4)])
+        banktivity.commit()
+        banktivity.con.close()
+
+        con = sqlite3.connect(banktivity.core_sql_path)
+        for z_name, table in (('Transaction', 'ZTRANSACTION'), ('LineItem', 'ZLINEITEM'),
+                              ('SecurityLineItem', 'ZSECURITYLINEITEM')):
+            z_max = con.execute("SELECT Z_MAX FROM Z_PRIMARYKEY WHERE Z_NAME = ?", (z_name,)).fetchone()[0]
+            self.assertEqual(con.execute(f"SELECT MAX(Z_PK) FROM {table}").fetchone()[0], z_max, z_name)
+        con.close()
+        shutil.rmtree(document)
+
+    def test_failed_savepoint_keeps_the_earlier_batch(self):
+        kept = self.banktivity.add_transactions_bulk(self.transactions(3))
+        self.banktivity.defer("INSERT INTO sidecar.notes VALUES (?)", [('kept',)])
+        with self.assertRaises(RuntimeError):
+            with self.banktivity.savepoint('checkpoint'):
+                rolled_back = self.banktivity.add_transactions_bulk(self.transactions(3))
+                self.banktivity.defer("INSERT INTO sidecar.notes VALUES (?)", [('rolled back',)])
+                raise RuntimeError("batch failed")
+
+        self.assertEqual(kept[-1], self.max_z_pk('ZTRANSACTION'))
+        self.banktivity.cur.execute("SELECT COUNT(*) FROM ZLINEITEM WHERE ZPTRANSACTION IN (?, ?, ?)", rolled_back)
+        self.assertEqual(0, self.banktivity.cur.fetchone()[0])
+        self.assertEqual([[('kept',)]], [rows for _, rows in self.banktivity.deferred])
+
+        # The Z_PKs of the failed batch stay reserved, the next batch doesn't reuse them
+        after = self.banktivity.add_transactions_bulk(self.transactions(1))
+        self.assertGreater(after[0], rolled_back[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
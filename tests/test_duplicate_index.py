@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import os
+import random
+import tempfile
+import unittest
+from datetime import date
+
+from benchmarks.generator import generate_document
+from benchmarks.suite import deposit, security_transaction
+from libs.Banktivity import Banktivity
+from libs.DuplicateIndex import DuplicateIndex
+
+
+DAY = date(2026, 4, 1)
+# An amount the generated transactions don't have
+AMOUNT = 987654.32
+
+
+class DuplicateIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.document = os.path.join(cls.directory.name, 'duplicates.bank7')
+        generate_document(cls.document, transactions=2000, securities=10, price_days=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        random.seed(1)
+        self.banktivity = Banktivity(self.document)
+
+    def tearDown(self):
+        self.banktivity.con.rollback()
+        self.banktivity.con.close()
+
+    def deposit(self, zpdate, amount=AMOUNT):
+        transaction_data = deposit(self.banktivity, 1, 0)
+        transaction_data.update(transaction_type='Deposit', zpdate=zpdate, zptransactionamount=amount)
+        return transaction_data
+
+    def buy(self, zpdate):
+        transaction_data = security_transaction(self.banktivity, 1, 0, 10)
+        transaction_data.update(transaction_type='Buy', zpdate=zpdate, zpshares=7, zppricepershare=AMOUNT,
+                                zpsecurity=self.banktivity.get_zsecurity_by_symbol('RU0000000001')['Z_PK'],
+                                commission_amount=-1.0, zpamount=-7 * AMOUNT - 1.0, zptransactionamount=0)
+        return transaction_data
+
+    def add(self, *transactions):
+        """Write the transactions as the apply stage does, then open a new duplicate index on the document."""
+        ztransaction_pks = self.banktivity.add_transactions_bulk(list(transactions))
+        self.banktivity.duplicate_index = DuplicateIndex(self.banktivity.cur)
+        return ztransaction_pks
+
+    def test_every_check_takes_one_match(self):
+        self.add(self.deposit('2026-04-01T10:00:00'), self.deposit('2026-04-01T18:00:00'))
+        self.banktivity.preload_duplicates(DAY, DAY)
+        # Three identical operations of the day: two are in the document, the third one is new
+        found = [self.banktivity.find_primaryaccount_transaction_duplicate(self.deposit('2026-04-01T12:00:00'))
+                 for _ in range(3)]
+        self.assertEqual([True, True, False], found)
+
+    def test_key_includes_amount_and_day(self):
+        self.add(self.deposit('2026-04-01T10:00:00'))
+        self.banktivity.preload_duplicates(DAY, DAY)
+        find = self.banktivity.find_primaryaccount_transaction_duplicate
+        self.assertFalse(find(self.deposit('2026-04-01T10:00:00', amount=AMOUNT + 0.01)))
+        self.assertFalse(find(self.deposit('2026-04-02T10:00:00')))
+        self.assertTrue(find(self.deposit('2026-04-01T23:59:00')))
+
+    def test_security_transactions(self):
+        self.add(self.buy('2026-04-01T10:00:00'))
+        self.banktivity.preload_duplicates(DAY, DAY)
+        buy = self.buy('2026-04-01T11:00:00')
+        self.assertTrue(self.banktivity.find_security_transaction_duplicate(buy))
+        self.assertFalse(self.banktivity.find_security_transaction_duplicate(buy))
+        # A deposit of the same amount is not a security line item
+        self.assertFalse(self.banktivity.find_primaryaccount_transaction_duplicate(self.deposit('2026-04-01T11:00:00')))
+
+    def test_days_outside_the_preload_are_loaded_on_demand(self):
+        self.add(self.deposit('2026-04-01T10:00:00'), self.deposit('2026-05-01T10:00:00'))
+        index = self.banktivity.duplicate_index
+        self.banktivity.preload_duplicates(DAY, DAY)
+        self.assertNotIn(date(2026, 5, 1), index.loaded_days)
+        self.assertTrue(self.banktivity.find_primaryaccount_transaction_duplicate(self.deposit('2026-05-01T12:00:00')))
+        self.assertIn(date(2026, 5, 1), index.loaded_days)
+        # The day is loaded once, the match taken stays taken
+        self.assertFalse(self.banktivity.find_primaryaccount_transaction_duplicate(self.deposit('2026-05-01T12:00:00')))
+
+    def test_excluded_transactions_are_not_matched(self):
+        ledgered, _ = self.add(self.deposit('2026-04-01T10:00:00'), self.buy('2026-04-01T10:00:00'))
+        self.banktivity.preload_duplicates(DAY, DAY, {ledgered, ledgered + 1})
+        self.assertFalse(self.banktivity.find_primaryaccount_transaction_duplicate(self.deposit('2026-04-01T12:00:00')))
+        self.assertFalse(self.banktivity.find_security_transaction_duplicate(self.buy('2026-04-01T12:00:00')))
+
+
+if __name__ == '__main__':
+    unittest.main()
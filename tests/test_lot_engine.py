@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import os
+import random
+import tempfile
+import unittest
+
+from benchmarks.generator import generate_document
+from benchmarks.suite import security_transaction
+from libs.Banktivity import Banktivity
+from libs.LotEngine import LotEngine, Trade
+
+
+class LotEngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.document = os.path.join(cls.directory.name, 'lots.bank7')
+        generate_document(cls.document, accounts=3, transactions=3000, securities=5, price_days=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        random.seed(1)
+        self.banktivity = Banktivity(self.document)
+
+    def tearDown(self):
+        self.banktivity.con.rollback()
+        self.banktivity.con.close()
+
+    def median_zpdate(self):
+        self.banktivity.cur.execute("SELECT ZPDATE FROM ZTRANSACTION ORDER BY ZPDATE LIMIT 1 OFFSET 1500")
+        return self.banktivity.cur.fetchone()[0]
+
+    def test_fifo(self):
+        engine = LotEngine(self.banktivity)
+        pair = (1, 1)
+        engine.trades[pair] = [
+            Trade(1, 10.0, 10, -1000.0),  # 10 at 100
+            Trade(2, 20.0, 5, -600.0),  # 5 at 120
+            Trade(3, 30.0, -12, 1800.0),  # 12 at 150: 10 at 100 and 2 at 120
+            Trade(4, 40.0, -5, 500.0),  # 3 left at 120, 2 not covered
+        ]
+        engine.replay(pair, 0)
+        first, second = engine.realized_gains()
+        self.assertEqual([(1, 10), (2, 2)], first.matches)
+        self.assertAlmostEqual(1240.0, first.cost)
+        self.assertAlmostEqual(560.0, first.gain)
+        self.assertEqual([(2, 3)], second.matches)
+        self.assertEqual(2, second.uncovered_shares)
+        self.assertAlmostEqual(360.0, second.cost)
+        self.assertEqual([], engine.open_lots())
+
+    def test_recompute_since_without_load(self):
+        loaded = LotEngine(self.banktivity)
+        loaded.load()
+        since = self.median_zpdate()
+        engine = LotEngine(self.banktivity)
+        engine.recompute(since)
+        self.assertTrue(engine.realized_gains(since))
+        self.assertEqual(loaded.realized_gains(since), engine.realized_gains(since))
+        traded_pairs = set(engine.trades)
+        self.assertEqual(sorted(lot for lot in loaded.open_lots()
+                                if (lot.zaccount_pk, lot.zsecurity_pk) in traded_pairs), sorted(engine.open_lots()))
+
+    def test_recompute_after_adding_trades(self):
+        engine = LotEngine(self.banktivity)
+        engine.load()
+        since = self.median_zpdate()
+        partial = LotEngine(self.banktivity)
+        partial.recompute(since)
+        self.banktivity.add_transactions_bulk([security_transaction(self.banktivity, 1, n, 5) for n in range(50)])
+        self.banktivity.cur.execute("SELECT MIN(ZPDATE) FROM ZTRANSACTION WHERE ZPNOTE LIKE 'Benchmark operation %'")
+        added_since = self.banktivity.cur.fetchone()[0]
+        engine.recompute(added_since)
+        partial.recompute(added_since)
+
+        reloaded = LotEngine(self.banktivity)
+        reloaded.load()
+        self.assertEqual(reloaded.realized_gains(), engine.realized_gains())
+        self.assertEqual(sorted(reloaded.open_lots()), sorted(engine.open_lots()))
+        since = max(since, added_since)
+        self.assertEqual(reloaded.realized_gains(since), partial.realized_gains(since))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from libs.OperationsFile import OperationsFile
+
+
+PERIOD_START = '2026-01-01T00:00:00+03:00'
+WINDOWS = [('2026-01-01T00:00:00+03:00', '2026-01-31T00:00:00+03:00'),
+           ('2026-01-31T00:00:00+03:00', '2026-03-02T00:00:00+03:00'),
+           ('2026-03-02T00:00:00+03:00', '2026-03-15T00:00:00+03:00')]
+PERIOD_END = WINDOWS[-1][1]
+
+
+def parse(value):
+    return SimpleNamespace(id=value['id'], date=value['date'])
+
+
+def fetch_lines(windows, fetched=True):
+    """Lines of a file written by fetch_operations_to_file() for account A1, with an operation per window written
+    in the order of windows."""
+    lines = [{'type': 'fetch', 'window_days': 30, 'period_starts': {'A1': PERIOD_START}},
+             {'type': 'account', 'broker_account_id': 'A1', 'broker_account_type': 'Tinkoff'}]
+    for window_start, window_end in windows:
+        lines.append({'type': 'operation', 'broker_account_id': 'A1',
+                      'operation': {'id': window_start, 'date': window_start}})
+        lines.append({'type': 'window', 'broker_account_id': 'A1', 'window_start': window_start,
+                      'window_end': window_end})
+    if fetched:
+        lines.append({'type': 'fetched', 'period_end': PERIOD_END})
+    return [json.dumps(line) + "\n" for line in lines]
+
+
+class OperationsFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'operations.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, lines):
+        with open(self.path, 'w') as f:
+            f.writelines(lines)
+        return OperationsFile(self.path, parse)
+
+    def test_complete_fetch(self):
+        operations = self.open(fetch_lines(WINDOWS))
+        self.assertEqual([], operations.incomplete_accounts())
+        self.assertEqual([window_start for window_start, _ in WINDOWS], [op.id for op in operations['A1']])
+
+    def test_windows_written_out_of_order(self):
+        operations = self.open(fetch_lines([WINDOWS[2], WINDOWS[0], WINDOWS[1]]))
+        self.assertEqual([], operations.incomplete_accounts())
+        self.assertEqual([window_start for window_start, _ in WINDOWS], [op.id for op in operations['A1']])
+
+    def test_missing_window(self):
+        operations = self.open(fetch_lines([WINDOWS[0], WINDOWS[2]]))
+        self.assertEqual(['A1'], operations.incomplete_accounts())
+
+    def test_interrupted_fetch(self):
+        self.assertEqual(['A1'], self.open(fetch_lines(WINDOWS, fetched=False)).incomplete_accounts())
+        # The last line cut in the middle
+        lines = fetch_lines(WINDOWS[:2], fetched=False)
+        lines[-1] = lines[-1][:20]
+        self.assertEqual(['A1'], self.open(lines).incomplete_accounts())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timedelta
+
+from benchmarks.generator import generate_document
+from benchmarks.suite import security_transaction
+from libs.Banktivity import Banktivity
+from libs.PortfolioValuation import PortfolioValuation
+from libs.ReadModel import ReadModel
+
+DAY = date(2026, 1, 5)
+STOCK, UNPRICED, BOND = 'RU0000000001', 'RU0000000002', 'RU0000000003'
+
+
+def trade(banktivity, symbol, day, shares, price, multiplier=1):
+    transaction_data = security_transaction(banktivity, 1, 0, 3)
+    transaction_data.update({
+        'transaction_type': 'Buy' if shares > 0 else 'Sell',
+        'zpdate': datetime.combine(day, datetime.min.time()).replace(hour=12).astimezone().isoformat(),
+        'zpsecurity': banktivity.get_zsecurity_by_symbol(symbol)['Z_PK'],
+        'zpshares': shares,
+        'zppricepershare': price,
+        'zppricemultiplier': multiplier,
+        'commission_amount': 0,
+        'zpamount': -shares * price * multiplier,
+        'zptransactionamount': 0,
+        'transaction_category_name': None,
+    })
+    transaction_data.pop('zpincome', None)
+    banktivity.add_security_transaction(transaction_data)
+
+
+def close(banktivity, symbol, day, price):
+    banktivity.add_zsecurityprices([{'zpsecurity_pk': banktivity.get_zsecurity_by_symbol(symbol)['Z_PK'],
+                                     'zpdate': day.isoformat(), 'o': price, 'h': price, 'l': price, 'c': price,
+                                     'v': 0}])
+
+
+class PortfolioValuationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.document = os.path.join(self.directory.name, 'valuation.bank7')
+        generate_document(self.document, transactions=0, securities=3, price_days=0)
+        self.banktivity = Banktivity(self.document)
+        trade(self.banktivity, STOCK, DAY, 10, 100)
+        trade(self.banktivity, BOND, DAY + timedelta(days=1), 5, 98, multiplier=10)
+        trade(self.banktivity, UNPRICED, DAY + timedelta(days=1), 1, 50)
+        trade(self.banktivity, STOCK, DAY + timedelta(days=3), -4, 110)
+        # No closes on DAY + 1 (and none of the bond on DAY + 2): the previous ones are carried forward
+        close(self.banktivity, STOCK, DAY, 100)
+        close(self.banktivity, BOND, DAY, 98)
+        close(self.banktivity, STOCK, DAY + timedelta(days=2), 110)
+        close(self.banktivity, BOND, DAY + timedelta(days=3), 99)
+        self.banktivity.commit()
+        self.account = self.banktivity.get_zaccount_pk('Тинькофф - Брокер RUB')
+
+    def tearDown(self):
+        self.banktivity.con.close()
+        self.directory.cleanup()
+
+    def test_values(self):
+        valuation = PortfolioValuation(self.banktivity)
+        symbols = {zsecurity['Z_PK']: symbol for symbol, zsecurity in self.banktivity.zsecurities.items()}
+        values = {symbols[zsecurity_pk]: security_values.tolist() for (_, zsecurity_pk), security_values
+                  in valuation.security_values(DAY, DAY + timedelta(days=3)).items()}
+        self.assertEqual([1000, 1000, 1100, 660], values[STOCK])
+        # Bond prices are a fraction of par: shares * price * ZPPRICEMULTIPLIER
+        self.assertEqual([0, 4900, 4900, 4950], values[BOND])
+        self.assertEqual([0, 0, 0, 0], values[UNPRICED])
+        self.assertEqual([1000, 5900, 6000, 5610],
+                         valuation.account_values(DAY, DAY + timedelta(days=3))[self.account].tolist())
+
+    def test_extending_the_range(self):
+        valuation = PortfolioValuation(self.banktivity)
+        first = valuation.account_values(DAY, DAY + timedelta(days=1))[self.account].tolist()
+        extended = valuation.account_values(DAY, DAY + timedelta(days=3))[self.account].tolist()
+        earlier = valuation.account_values(DAY - timedelta(days=1), DAY + timedelta(days=3))[self.account].tolist()
+        self.assertEqual([1000, 5900], first)
+        self.assertEqual([1000, 5900, 6000, 5610], extended)
+        self.assertEqual([0] + extended, earlier)
+
+    def test_snapshots_persist_until_the_document_changes(self):
+        read_model = ReadModel(self.document)
+        try:
+            PortfolioValuation(self.banktivity, read_model).account_values(DAY, DAY + timedelta(days=2))
+            self.assertEqual(3, len(read_model.valuation_snapshots()))
+
+            valuation = PortfolioValuation(self.banktivity, read_model)
+            self.assertEqual(3, valuation.holdings.shape[1])
+            self.assertEqual([1000, 5900, 6000, 5610],
+                             valuation.account_values(DAY, DAY + timedelta(days=3))[self.account].tolist())
+            self.assertEqual(4, len(read_model.valuation_snapshots()))
+
+            close(self.banktivity, STOCK, DAY + timedelta(days=1), 105)
+            self.banktivity.commit()
+            self.assertEqual([], read_model.valuation_snapshots())
+            valuation = PortfolioValuation(self.banktivity, read_model)
+            self.assertEqual([1000, 5950, 6000, 5610],
+                             valuation.account_values(DAY, DAY + timedelta(days=3))[self.account].tolist())
+        finally:
+            read_model.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
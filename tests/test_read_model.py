@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from benchmarks.generator import generate_document
+from libs.BalanceEngine import BalanceEngine
+from libs.Banktivity import Banktivity
+from libs.ReadModel import ReadModel
+
+
+class ReadModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.document = os.path.join(self.directory.name, 'readmodel.bank7')
+        generate_document(self.document, transactions=2000, securities=10, price_days=10)
+        self.read_model = ReadModel(self.document)
+        self.core = sqlite3.connect(os.path.join(self.document, 'StoreContent', 'core.sql'))
+
+    def tearDown(self):
+        self.core.close()
+        self.read_model.close()
+        self.directory.cleanup()
+
+    def monthly_totals(self):
+        return {(zaccount_pk, month): amount for zaccount_pk, month, amount, _ in self.read_model.monthly_totals()}
+
+    def test_current_cache_is_not_rebuilt(self):
+        self.assertEqual(sorted(ReadModel.MODELS), sorted(self.read_model.refresh()))
+        self.assertEqual([], self.read_model.refresh())
+
+    def test_update_without_z_opt_invalidates(self):
+        before = self.monthly_totals()
+        # An in-place UPDATE like the importer's: Z_OPT and Z_MAX stay as they were
+        z_pk, zaccount_pk = self.core.execute(
+            "SELECT Z_PK, ZPACCOUNT FROM ZLINEITEM WHERE ZPACCOUNT IS NOT NULL ORDER BY Z_PK LIMIT 1").fetchone()
+        self.core.execute("UPDATE ZLINEITEM SET ZPTRANSACTIONAMOUNT = ZPTRANSACTIONAMOUNT + 100 WHERE Z_PK = ?", (z_pk,))
+        self.core.commit()
+
+        self.assertEqual(['monthly_totals', 'category_totals', 'positions', 'valuation_snapshots'],
+                         self.read_model.refresh())
+        after = self.monthly_totals()
+        changed = {key for key in before if abs(before[key] - after[key]) > 1e-6}
+        self.assertEqual(1, len(changed))
+        key, = changed
+        self.assertEqual(zaccount_pk, key[0])
+        self.assertAlmostEqual(100, after[key] - before[key])
+
+    def test_unexplained_change_rebuilds_all(self):
+        self.read_model.refresh()
+        banktivity = Banktivity(self.document)
+        try:
+            # ZPRUNNINGBALANCE isn't read by the models, so no entity fingerprint changes
+            engine = BalanceEngine(banktivity)
+            engine.load()
+            engine.write_back()
+            banktivity.commit()
+        finally:
+            banktivity.con.close()
+        self.assertEqual(sorted(ReadModel.MODELS), sorted(self.read_model.refresh()))
+        self.assertEqual([], self.read_model.refresh())
+
+    def assertMonthlyTotals(self):
+        expected = {}
+        for zaccount_pk, month, amount, security_amount, income in self.core.execute("""
+        SELECT li.ZPACCOUNT, STRFTIME('%Y-%m', 978307200 + t.ZPDATE, 'unixepoch', 'localtime'),
+               li.ZPTRANSACTIONAMOUNT, sli.ZPAMOUNT, sli.ZPINCOME
+        FROM ZLINEITEM li
+        JOIN ZTRANSACTION t ON (li.ZPTRANSACTION = t.Z_PK)
+        LEFT JOIN ZSECURITYLINEITEM sli ON (sli.ZPLINEITEM = li.Z_PK)
+        WHERE li.ZPACCOUNT IS NOT NULL
+        """):
+            # Buy/Sell and Investment Inc. line items have a zero amount, the cash is in the security line item
+            if security_amount is not None:
+                amount = (amount or 0) + security_amount
+            elif not amount and income is not None:
+                amount = income
+            expected[(zaccount_pk, month)] = expected.get((zaccount_pk, month), 0.0) + (amount or 0)
+        actual = self.monthly_totals()
+        self.assertEqual(set(expected), set(actual))
+        for key, amount in expected.items():
+            self.assertAlmostEqual(amount, actual[key], places=6)
+
+    def test_trade_cash_in_monthly_totals(self):
+        self.assertMonthlyTotals()
+
+    def test_dividend_cash_in_monthly_totals(self):
+        # Investment Inc. line items keep the cash in ZSECURITYLINEITEM.ZPINCOME only
+        self.core.execute("""
+        UPDATE ZLINEITEM SET ZPTRANSACTIONAMOUNT = 0
+        WHERE Z_PK IN (SELECT ZPLINEITEM FROM ZSECURITYLINEITEM WHERE ZPAMOUNT IS NULL AND ZPINCOME > 0)
+        """)
+        self.core.commit()
+        self.assertMonthlyTotals()
+
+        # An in-place change of a ZPINCOME alone invalidates the monthly totals too
+        self.core.execute("""
+        UPDATE ZSECURITYLINEITEM SET ZPINCOME = ZPINCOME + 50
+        WHERE Z_PK = (SELECT MIN(Z_PK) FROM ZSECURITYLINEITEM WHERE ZPAMOUNT IS NULL AND ZPINCOME > 0)
+        """)
+        self.core.commit()
+        self.assertIn('monthly_totals', self.read_model.refresh())
+        self.assertMonthlyTotals()
+
+    def test_transfer_counted_once(self):
+        z_ents = dict(self.core.execute("SELECT Z_NAME, Z_ENT FROM Z_PRIMARYKEY"))
+        (first_account,), (second_account,) = self.core.execute(
+            "SELECT Z_PK FROM ZACCOUNT WHERE Z_ENT = ? ORDER BY Z_PK LIMIT 2", (z_ents['PrimaryAccount'],))
+        category, = self.core.execute("SELECT Z_PK FROM ZACCOUNT WHERE Z_ENT = ? ORDER BY Z_PK LIMIT 1",
+                                      (z_ents['Category'],)).fetchone()
+        z_pk = self.core.execute("SELECT MAX(Z_PK) + 1 FROM ZTRANSACTION").fetchone()[0]
+        li_pk = self.core.execute("SELECT MAX(Z_PK) + 1 FROM ZLINEITEM").fetchone()[0]
+        self.core.execute("INSERT INTO ZTRANSACTION (Z_PK, Z_ENT, Z_OPT, ZPDATE) VALUES (?, ?, 1, 0)",
+                          (z_pk, z_ents['Transaction']))
+        # A transfer of 300 with a fee of 10 filed to a category
+        self.core.executemany(
+            "INSERT INTO ZLINEITEM (Z_PK, Z_ENT, Z_OPT, ZPACCOUNT, Z1_PACCOUNT, ZPTRANSACTION, ZPTRANSACTIONAMOUNT) "
+            "VALUES (?, ?, 1, ?, ?, ?, ?)",
+            [(li_pk, z_ents['LineItem'], first_account, z_ents['PrimaryAccount'], z_pk, -310),
+             (li_pk + 1, z_ents['LineItem'], second_account, z_ents['PrimaryAccount'], z_pk, 300),
+             (li_pk + 2, z_ents['LineItem'], category, z_ents['Category'], z_pk, 10)])
+        self.core.execute("UPDATE Z_PRIMARYKEY SET Z_MAX = ? WHERE Z_NAME = 'LineItem'", (li_pk + 2,))
+        self.core.commit()
+
+        month = self.core.execute(
+            "SELECT STRFTIME('%Y-%m', 978307200, 'unixepoch', 'localtime')").fetchone()[0]
+        self.assertEqual([(first_account, category, month, -10.0, 1)],
+                         self.read_model.category_totals(first_month=month, last_month=month))
+
+
+if __name__ == '__main__':
+    unittest.main()